@@ -0,0 +1,202 @@
+"""
+End to end benchmark of the addon's actions.
+
+Each action is run as Kodi would run it, in a fresh Python process, against
+stand-ins for the xbmc* modules and a fake bluetoothctl. For each action the
+wall time, number of bluetoothctl processes started, peak memory, number of
+directory items and of calls adding them are reported, along with the addon's
+own measurement of its startup time from its metrics file.
+
+By default each command starts its own bluetoothctl process; with --session
+the commands of each action share one interactive bluetoothctl process.
+
+    python benchmarks/bench_actions.py [--devices N] [--latency S] ...
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, NamedTuple
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADDON = os.path.join(HERE, os.pardir, 'plugin.program.bluetoothctl')
+FAKE_BLUETOOTHCTL = os.path.join(HERE, 'fake_bluetoothctl.py')
+STUBS = os.path.join(HERE, 'stubs')
+
+# Run addon.py with sys.argv as Kodi sets it
+RUNNER = ("import runpy, sys; sys.argv = sys.argv[1:]; "
+          "sys.path.insert(0, ''); runpy.run_path('addon.py', "
+          "run_name='__main__')")
+
+# Address of the first fake device, which is paired
+ADDRESS = '00:1A:7D:00:00:00'
+
+# Actions and their query string parameters
+ACTIONS: list[tuple[str, dict[str, str]]] = [
+    ('root', {}),
+    ('paired_devices', {'action': 'paired_devices'}),
+    ('available_devices', {'action': 'available_devices'}),
+    # A later page of the same listing, without scanning again
+    ('available_page', {'action': 'available_devices', 'page': '1'}),
+    ('device', {'action': 'device', 'device': 'JBL Flip',
+                'address': ADDRESS, 'paired': 'True'}),
+    ('info', {'action': 'info', 'device': 'JBL Flip', 'address': ADDRESS}),
+    ('connect', {'action': 'connect', 'address': ADDRESS}),
+    ('disconnect', {'action': 'disconnect', 'address': ADDRESS}),
+    ('pair', {'action': 'pair', 'address': ADDRESS}),
+    ('setup', {'action': 'setup', 'address': ADDRESS}),
+    ('trust', {'action': 'trust', 'address': ADDRESS}),
+    ('untrust', {'action': 'untrust', 'address': ADDRESS}),
+    ('remove', {'action': 'remove', 'address': ADDRESS}),
+    # Every paired device, with the command chosen by BENCH_SELECT
+    ('batch', {'action': 'batch', 'paired': 'True'}),
+]
+
+
+class Result(NamedTuple):
+    """Measurements of one run of an action."""
+    action: str
+    returncode: int
+    wall: float
+    processes: int
+    peak_rss_kb: int
+    items: int
+    item_calls: int
+    startup: float
+
+
+def run_action(name: str, params: dict[str, str], env: dict[str, str],
+               workdir: str) -> Result:
+    """Run an action in a fresh interpreter and measure it."""
+    spawn_log = os.path.join(workdir, 'spawns.log')
+    items_file = os.path.join(workdir, 'items')
+    for path in (spawn_log, items_file):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    env = dict(env, FAKE_BT_LOG=spawn_log, BENCH_ITEMS=items_file)
+    query = '?' + urllib.parse.urlencode(params) if params else ''
+    # Kodi passes the plugin url, handle and query string as sys.argv
+    command = [sys.executable, '-c', RUNNER,
+               'plugin://plugin.program.bluetoothctl/', '1', query]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ADDON, env=env,
+                               stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                          else -os.WTERMSIG(status))
+
+    processes = 0
+    if os.path.exists(spawn_log):
+        with open(spawn_log) as log_file:
+            processes = sum(1 for _ in log_file)
+    items = item_calls = 0
+    if os.path.exists(items_file):
+        with open(items_file) as count_file:
+            items, item_calls = map(int, count_file.read().split())
+    startup = float('nan')
+    metrics = os.path.join(env['BENCH_PROFILE'], 'metrics.jsonl')
+    if os.path.exists(metrics):
+        with open(metrics) as metrics_file:
+            lines = metrics_file.readlines()
+        if lines:
+            startup = json.loads(lines[-1]).get('startup', startup)
+
+    return Result(name, process.returncode, wall, processes,
+                  usage.ru_maxrss, items, item_calls, startup)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--devices', type=int, default=20,
+                        help='number of devices the fake knows')
+    parser.add_argument('--paired', type=int, default=3,
+                        help='number of paired devices')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='fake bluetoothctl start up delay (s)')
+    parser.add_argument('--output-size', type=int, default=0,
+                        help='extra lines of output per command')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='probability that a command fails')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each action, the best is reported')
+    parser.add_argument('--session', action='store_true',
+                        help='run commands in one bluetoothctl session')
+    parser.add_argument('--setting', action='append', default=[],
+                        metavar='ID=VALUE', help='override an addon setting')
+    parser.add_argument('--action', action='append', default=[],
+                        help='only run these actions')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON lines')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail if any action\'s startup exceeds this')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-bluetoothctl-')
+    settings: dict[str, Any] = {
+        'bluetoothctl_path': FAKE_BLUETOOTHCTL,
+        # Keep the background service out of the measurements
+        'service_enabled': 'false',
+        # Startup time is read from the metrics file
+        'metrics_enabled': 'true',
+        'bluetoothctl_session': 'true' if args.session else 'false',
+    }
+    for setting in args.setting:
+        key, _, value = setting.partition('=')
+        settings[key] = value
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(
+            [STUBS] + os.environ.get('PYTHONPATH', '').split(os.pathsep)
+        ).rstrip(os.pathsep),
+        BENCH_PROFILE=os.path.join(workdir, 'profile'),
+        BENCH_SETTINGS=json.dumps(settings),
+        FAKE_BT_DEVICES=str(args.devices),
+        FAKE_BT_PAIRED=str(args.paired),
+        FAKE_BT_LATENCY=str(args.latency),
+        FAKE_BT_OUTPUT_SIZE=str(args.output_size),
+        FAKE_BT_FAILURE_RATE=str(args.failure_rate),
+    )
+
+    if not args.json:
+        print(f'{"action":<20} {"status":>6} {"wall ms":>9} '
+              f'{"startup ms":>10} {"processes":>9} {"peak KiB":>9} '
+              f'{"items":>6} {"calls":>5}')
+    over_budget = []
+    try:
+        for name, params in ACTIONS:
+            if args.action and name not in args.action:
+                continue
+            best = min((run_action(name, params, env, workdir)
+                        for _ in range(args.repeat)),
+                       key=lambda result: result.wall)
+            if args.json:
+                print(json.dumps(best._asdict()))
+            else:
+                print(f'{best.action:<20} {best.returncode:>6} '
+                      f'{best.wall * 1e3:>9.1f} {best.startup * 1e3:>10.1f} '
+                      f'{best.processes:>9} {best.peak_rss_kb:>9} '
+                      f'{best.items:>6} {best.item_calls:>5}')
+            if (args.budget_ms is not None
+                    and not best.startup * 1e3 <= args.budget_ms):
+                over_budget.append(best.action)
+    finally:
+        shutil.rmtree(workdir)
+
+    if over_budget:
+        sys.exit(f'startup over {args.budget_ms} ms budget: '
+                 f'{", ".join(over_budget)}')
+
+
+if __name__ == '__main__':
+    main()
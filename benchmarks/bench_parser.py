@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of the bluetoothctl output parsers.
+
+Times parsing of synthetic 'devices' and 'info' output, comparing the
+device list parser against the previous split-based one.
+
+    python benchmarks/bench_parser.py [--devices N] [--repeat N]
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'plugin.program.bluetoothctl'))
+
+from resources.lib.parser import parse_devices, parse_info  # noqa: E402
+
+NAMES = ['JBL Flip', 'Xbox Wireless Controller', 'LE-Bose QC35', 'Pixel 6',
+         'Mi Band']
+
+
+def devices_output(count: int) -> str:
+    """Create 'devices' output listing count devices."""
+    return ''.join(
+        f'Device {i >> 16 & 255:02X}:{i >> 8 & 255:02X}:{i & 255:02X}:'
+        f'00:00:01 {NAMES[i % len(NAMES)]}\n'
+        for i in range(count)
+    )
+
+
+def info_output(uuids: int) -> str:
+    """Create 'info' output with uuids UUID lines."""
+    lines = [
+        'Device 00:00:00:00:00:01 (public)',
+        '\tName: JBL Flip 5',
+        '\tAlias: JBL Flip 5',
+        '\tClass: 0x00240414',
+        '\tIcon: audio-card',
+        '\tPaired: yes',
+        '\tTrusted: yes',
+        '\tBlocked: no',
+        '\tConnected: yes',
+        '\tLegacyPairing: no',
+    ]
+    lines += [f'\tUUID: Vendor specific           '
+              f'({i:08x}-0000-1000-8000-00805f9b34fb)' for i in range(uuids)]
+    lines += ['\tRSSI: 0xffffffc2 (-62)', '\tBattery Percentage: 0x50 (80)']
+    return ''.join(f'{line}\n' for line in lines)
+
+
+def split_parser(stdout: str) -> dict[str, str]:
+    """The original split-based device list parser."""
+    return {
+        item[2]: item[1] for item in
+        (line.split() for line in stdout.splitlines())
+    }
+
+
+def report(name: str, lines: int, seconds: float, repeat: int) -> None:
+    per_call = seconds / repeat
+    print(f'{name:<28} {lines:>8} lines {per_call * 1e3:10.3f} ms/call '
+          f'{lines / per_call / 1e6:8.2f} Mlines/s')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    devices = devices_output(args.devices)
+    info = info_output(args.devices)
+    count = len(parse_devices(devices))
+    print(f'{count} devices parsed from {args.devices} lines, '
+          f'{len(split_parser(devices))} with the split parser')
+
+    for name, func, text in [
+        ('split devices (old)', split_parser, devices),
+        ('parse_devices', parse_devices, devices),
+        ('parse_info', parse_info, info),
+    ]:
+        seconds = timeit.timeit(lambda: func(text), number=args.repeat)
+        report(name, text.count('\n'), seconds, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+A scriptable stand-in for bluetoothctl.
+
+Behaves like bluetoothctl closely enough to drive the addon, both for
+one-shot commands (bluetoothctl devices) and interactively (commands on
+stdin). It is configured with environment variables,
+
+    FAKE_BT_LATENCY      Start up delay in seconds (default 0.05)
+    FAKE_BT_DEVICES      Number of known devices (default 20)
+    FAKE_BT_PAIRED       Number of those devices which are paired (default 3)
+    FAKE_BT_OUTPUT_SIZE  Extra lines of noise printed per command (default 0)
+    FAKE_BT_FAILURE_RATE Probability that a command fails (default 0)
+    FAKE_BT_SCAN_SPREAD  Time over which a scan finds devices (default 0.5)
+    FAKE_BT_ADAPTERS     Number of controllers (default 1). Every fifth device
+                         only reaches one, and the signal of the others is
+                         strongest at a different controller for each device
+    FAKE_BT_RESULT_DELAY Delay in seconds before commands such as connect
+                         report their outcome interactively, after the
+                         prompt has returned (default 0)
+    FAKE_BT_LOG          File to append one line to per process started
+"""
+from __future__ import annotations
+import os
+import random
+import shlex
+import sys
+import time
+
+PROMPT = '\x01\x1b[0;94m\x02[bluetooth]\x01\x1b[0m\x02# '
+NAMES = ['JBL Flip', 'Xbox Wireless Controller', 'LE-Bose QC35', 'Pixel 6',
+         'Mi Band']
+
+
+def setting(name: str, default: float) -> float:
+    return float(os.environ.get(f'FAKE_BT_{name}', default))
+
+
+DEVICES = int(setting('DEVICES', 20))
+PAIRED = int(setting('PAIRED', 3))
+OUTPUT_SIZE = int(setting('OUTPUT_SIZE', 0))
+FAILURE_RATE = setting('FAILURE_RATE', 0)
+SCAN_SPREAD = setting('SCAN_SPREAD', 0.5)
+ADAPTERS = max(1, int(setting('ADAPTERS', 1)))
+RESULT_DELAY = setting('RESULT_DELAY', 0)
+
+# Index of the controller selected interactively
+selected = 0
+
+
+def address(index: int) -> str:
+    return f'00:1A:7D:{index >> 16 & 255:02X}:{index >> 8 & 255:02X}:' \
+           f'{index & 255:02X}'
+
+
+def name(index: int) -> str:
+    return NAMES[index % len(NAMES)]
+
+
+def rssi(index: int) -> int:
+    return -40 - index % 50 - 15 * ((index + selected) % ADAPTERS)
+
+
+def controller(index: int) -> str:
+    return f'00:1A:7D:DA:71:{0x13 + index:02X}'
+
+
+def reaches(index: int) -> bool:
+    """Whether a device reaches the selected controller."""
+    return index % 5 != 4 or index % ADAPTERS == selected
+
+
+def index_of(device_address: str) -> int:
+    try:
+        parts = device_address.upper().split(':')
+        index = int(''.join(parts[3:]), 16)
+    except ValueError:
+        return -1
+    return index if device_address.upper() == address(index) else -1
+
+
+def out(text: str) -> None:
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def noise() -> str:
+    return ''.join(f'[CHG] Device {address(i % max(DEVICES, 1))} '
+                   f'ManufacturerData Value: 0x{i:04x}\n'
+                   for i in range(OUTPUT_SIZE))
+
+
+def info(index: int) -> str:
+    paired = 'yes' if index < PAIRED else 'no'
+    return (
+        f'Device {address(index)} (public)\n'
+        f'\tName: {name(index)}\n'
+        f'\tAlias: {name(index)}\n'
+        '\tClass: 0x00240414\n'
+        '\tIcon: audio-card\n'
+        f'\tPaired: {paired}\n'
+        f'\tTrusted: {paired}\n'
+        '\tBlocked: no\n'
+        f'\tConnected: {"yes" if index == 0 else "no"}\n'
+        '\tLegacyPairing: no\n'
+        '\tUUID: Audio Sink                (0000110b-0000-1000-8000-'
+        '00805f9b34fb)\n'
+        f'\tRSSI: {rssi(index)}\n'
+        '\tBattery Percentage: 0x50 (80)\n'
+    )
+
+
+# Output of successful device commands, and of their failure
+RESULTS = {
+    'connect': ('Attempting to connect to {0}\n[CHG] Device {0} Connected: '
+                'yes\nConnection successful\n',
+                'Attempting to connect to {0}\nFailed to connect: '
+                'org.bluez.Error.Failed\n'),
+    'disconnect': ('Attempting to disconnect from {0}\n'
+                   'Successful disconnected\n',
+                   'Failed to disconnect: org.bluez.Error.Failed\n'),
+    'pair': ('Attempting to pair with {0}\nPairing successful\n',
+             'Attempting to pair with {0}\nFailed to pair: '
+             'org.bluez.Error.InProgress\n'),
+    'remove': ('Device has been removed\n',
+               'Failed to remove device: org.bluez.Error.Failed\n'),
+    'trust': ('Changing {0} trust succeeded\n',
+              'Failed to set trusted: org.bluez.Error.Failed\n'),
+    'untrust': ('Changing {0} untrust succeeded\n',
+                'Failed to set trusted: org.bluez.Error.Failed\n'),
+}
+
+
+def run(command: list[str]) -> tuple[int, str]:
+    """Run a command, returning its exit status and output."""
+    if not command:
+        return 0, ''
+    verb, args = command[0], command[1:]
+
+    global selected
+    if verb == 'devices':
+        return 0, noise() + ''.join(f'Device {address(i)} {name(i)}\n'
+                                    for i in range(DEVICES) if reaches(i))
+    if verb == 'paired-devices':
+        return 0, ''.join(f'Device {address(i)} {name(i)}\n'
+                          for i in range(min(PAIRED, DEVICES)))
+    if verb == 'list':
+        return 0, ''.join(
+            f'Controller {controller(k)} kodi{" #%d" % k if k else ""}'
+            f'{" [default]" if k == 0 else ""}\n'
+            for k in range(ADAPTERS)
+        )
+    if verb == 'select':
+        controllers = [controller(k) for k in range(ADAPTERS)]
+        if not args or args[0].upper() not in controllers:
+            return 1, f'Controller {" ".join(args)} not available\n'
+        selected = controllers.index(args[0].upper())
+        return 0, ''
+    if verb in ('scan', 'menu', 'back', 'transport', 'rssi',
+                'uuids', 'pattern', 'duplicate-data', 'clear'):
+        return 0, ''
+    if verb not in RESULTS and verb != 'info':
+        return 1, 'Invalid command\n'
+
+    if not args:
+        return 1, 'Missing device address argument\n'
+    index = index_of(args[0])
+    if not 0 <= index < DEVICES or not reaches(index):
+        return 1, f'Device {args[0]} not available\n'
+    if random.random() < FAILURE_RATE:
+        return 1, RESULTS.get(verb, ('', 'Failed to get info\n'))[1].format(
+            args[0])
+    if verb == 'info':
+        return 0, info(index)
+    if verb == 'pair' and index < PAIRED:
+        return 1, (f'Attempting to pair with {args[0]}\nFailed to pair: '
+                   'org.bluez.Error.AlreadyExists\n')
+    return 0, RESULTS[verb][0].format(args[0])
+
+
+def scan(duration: float) -> None:
+    """Report each device over the scan spread, then wait out the scan."""
+    start = time.monotonic()
+    out('Discovery started\n')
+    for i in range(DEVICES):
+        time.sleep(SCAN_SPREAD / max(DEVICES, 1))
+        if not reaches(i):
+            continue
+        out(f'[\x1b[0;92mNEW\x1b[0m] Device {address(i)} {name(i)}\n'
+            f'[CHG] Device {address(i)} RSSI: {rssi(i)}\n')
+    time.sleep(max(0.0, duration - (time.monotonic() - start)))
+
+
+def interactive() -> None:
+    out('Agent registered\n' + PROMPT)
+    # Discovery filter set with the scan menu, as in 'rssi -60'
+    filters: dict[str, str] = {}
+    for line in sys.stdin:
+        # bluetoothctl splits commands as a shell would
+        command = shlex.split(line)
+        if command[:1] == ['quit']:
+            return
+        if command[:1] in (['rssi'], ['pattern']) and len(command) > 1:
+            filters[command[0]] = command[1]
+        if command == ['scan', 'on']:
+            out('Discovery started\n' + PROMPT)
+            for i in range(DEVICES):
+                if (not reaches(i) or int(filters.get('rssi', -127)) > rssi(i)
+                        or not name(i).startswith(filters.get('pattern',
+                                                              ''))):
+                    continue
+                out(f'[NEW] Device {address(i)} {name(i)}\n'
+                    f'[CHG] Device {address(i)} RSSI: {rssi(i)}\n')
+            continue
+        _, output = run(command)
+        if command and command[0] in RESULTS and output.startswith('Attempt'):
+            # The outcome arrives asynchronously, after a fresh prompt
+            attempt, _, output = output.partition('\n')
+            out(f'{attempt}\n{PROMPT}')
+            time.sleep(RESULT_DELAY)
+        out(output + PROMPT)
+
+
+def main() -> None:
+    log = os.environ.get('FAKE_BT_LOG')
+    if log:
+        with open(log, 'a') as log_file:
+            log_file.write(' '.join(sys.argv[1:]) + '\n')
+    time.sleep(setting('LATENCY', 0.05))
+
+    args = sys.argv[1:]
+    duration = None
+    if args[:1] == ['--timeout']:
+        duration = float(args[1])
+        args = args[2:]
+
+    if not args:
+        interactive()
+        return
+    if args == ['scan', 'on']:
+        scan(duration if duration is not None else 0)
+        return
+
+    status, output = run(args)
+    out(output)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Minimal stand-in for Kodi's xbmc module, for benchmarks."""
+from __future__ import annotations
+import os
+import sys
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGWARNING = 2
+LOGERROR = 3
+LOGFATAL = 4
+
+# Messages at or above this level are written to stderr
+_LOG_LEVEL = int(os.environ.get('BENCH_LOG_LEVEL', LOGFATAL + 1))
+
+
+def log(msg: str, level: int = LOGDEBUG) -> None:
+    if level >= _LOG_LEVEL:
+        print(msg, file=sys.stderr)
+
+
+def executebuiltin(function: str, wait: bool = False) -> None:
+    pass
+
+
+def getCondVisibility(condition: str) -> bool:
+    return condition == 'System.GetBool(debug.showloginfo)' \
+        and _LOG_LEVEL <= LOGDEBUG
+
+
+def sleep(time: int) -> None:
+    pass
+
+
+class Monitor:
+    def abortRequested(self) -> bool:
+        return False
+
+    def waitForAbort(self, timeout: float = -1) -> bool:
+        return False
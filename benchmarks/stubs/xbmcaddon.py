@@ -0,0 +1,56 @@
+"""
+Minimal stand-in for Kodi's xbmcaddon module, for benchmarks.
+
+Settings take their defaults from the addon's settings.xml, overridden by the
+JSON object in the BENCH_SETTINGS environment variable.
+"""
+from __future__ import annotations
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+_ADDON_PATH = os.path.abspath(os.environ.get(
+    'BENCH_ADDON_PATH',
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                 'plugin.program.bluetoothctl')
+))
+
+
+def _settings() -> dict[str, str]:
+    root = ElementTree.parse(
+        os.path.join(_ADDON_PATH, 'resources', 'settings.xml')
+    ).getroot()
+    settings = {setting.get('id', ''): setting.get('default', '')
+                for setting in root.iter('setting')}
+    settings.update(json.loads(os.environ.get('BENCH_SETTINGS', '{}')))
+    return settings
+
+
+class Addon:
+    def __init__(self, id: str = 'plugin.program.bluetoothctl') -> None:
+        self._settings = _settings()
+        self._info = {
+            'id': id,
+            'name': 'Bluetoothctl',
+            'icon': os.path.join(_ADDON_PATH, 'resources', 'icon.png'),
+            'path': _ADDON_PATH,
+            'profile': os.environ.get('BENCH_PROFILE', '/tmp/bench-profile'),
+        }
+
+    def getAddonInfo(self, id: str) -> str:
+        return self._info.get(id, '')
+
+    def getSetting(self, id: str) -> str:
+        return self._settings.get(id, '')
+
+    def getSettingBool(self, id: str) -> bool:
+        return self.getSetting(id) == 'true'
+
+    def getSettingInt(self, id: str) -> int:
+        return int(self.getSetting(id) or 0)
+
+    def setSetting(self, id: str, value: str) -> None:
+        self._settings[id] = value
+
+    def getLocalizedString(self, id: int) -> str:
+        return f'#{id}'
@@ -0,0 +1,90 @@
+"""Minimal stand-in for Kodi's xbmcgui module, for benchmarks."""
+from __future__ import annotations
+from typing import Any, Optional
+import os
+
+NOTIFICATION_INFO = 'info'
+NOTIFICATION_WARNING = 'warning'
+NOTIFICATION_ERROR = 'error'
+
+
+class ListItem:
+    def __init__(self, label: str = '', label2: str = '', path: str = '',
+                 offscreen: bool = False) -> None:
+        self._label = label
+        self._label2 = label2
+        self._properties: dict[str, str] = {}
+
+    def getLabel(self) -> str:
+        return self._label
+
+    def setLabel(self, label: str) -> None:
+        self._label = label
+
+    def setLabel2(self, label: str) -> None:
+        self._label2 = label
+
+    def setArt(self, values: dict[str, str]) -> None:
+        pass
+
+    def setInfo(self, type: str, infoLabels: dict[str, Any]) -> None:
+        pass
+
+    def setProperty(self, key: str, value: str) -> None:
+        self._properties[key] = value
+
+
+class Dialog:
+    def notification(self, heading: str, message: str, icon: str = '',
+                     time: int = 5000, sound: bool = True) -> None:
+        pass
+
+    def textviewer(self, heading: str, text: str,
+                   usemono: bool = False) -> None:
+        pass
+
+    def ok(self, heading: str, message: str) -> bool:
+        return True
+
+    def yesno(self, heading: str, message: str, *args: Any,
+              **kwargs: Any) -> bool:
+        return True
+
+    def input(self, heading: str, *args: Any, **kwargs: Any) -> str:
+        return os.environ.get('BENCH_INPUT', '')
+
+    def select(self, heading: str, options: list[Any],
+               *args: Any, **kwargs: Any) -> int:
+        return int(os.environ.get('BENCH_SELECT', '0'))
+
+    def multiselect(self, heading: str, options: list[Any],
+                    *args: Any, **kwargs: Any) -> Optional[list[int]]:
+        return list(range(len(options)))
+
+
+class DialogProgress:
+    def create(self, heading: str, message: str = '') -> None:
+        pass
+
+    def update(self, percent: int, message: str = '') -> None:
+        pass
+
+    def iscanceled(self) -> bool:
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+class Window:
+    def __init__(self, existingWindowId: int = -1) -> None:
+        self._properties: dict[str, str] = {}
+
+    def getProperty(self, key: str) -> str:
+        return self._properties.get(key, '')
+
+    def setProperty(self, key: str, value: str) -> None:
+        self._properties[key] = value
+
+    def clearProperty(self, key: str) -> None:
+        self._properties.pop(key, None)
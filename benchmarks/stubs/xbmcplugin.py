@@ -0,0 +1,58 @@
+"""
+Minimal stand-in for Kodi's xbmcplugin module, for benchmarks.
+
+Counts the directory items added, reported on exit to the file named by the
+BENCH_ITEMS environment variable.
+"""
+from __future__ import annotations
+import atexit
+import os
+from typing import Any
+
+SORT_METHOD_NONE = 0
+SORT_METHOD_LABEL = 1
+SORT_METHOD_UNSORTED = 40
+
+_items = 0
+_calls = 0
+
+
+def addDirectoryItem(handle: int, url: str, listitem: Any,
+                     isFolder: bool = False, totalItems: int = 0) -> bool:
+    global _items, _calls
+    _items += 1
+    _calls += 1
+    return True
+
+
+def addDirectoryItems(handle: int, items: list[Any],
+                      totalItems: int = 0) -> bool:
+    global _items, _calls
+    _items += len(items)
+    _calls += 1
+    return True
+
+
+def endOfDirectory(handle: int, succeeded: bool = True,
+                   updateListing: bool = False,
+                   cacheToDisc: bool = True) -> None:
+    pass
+
+
+def setContent(handle: int, content: str) -> None:
+    pass
+
+
+def addSortMethod(handle: int, sortMethod: int,
+                  labelMask: str = '', label2Mask: str = '') -> None:
+    pass
+
+
+def _report() -> None:
+    path = os.environ.get('BENCH_ITEMS')
+    if path:
+        with open(path, 'w') as items_file:
+            items_file.write(f'{_items} {_calls}\n')
+
+
+atexit.register(_report)
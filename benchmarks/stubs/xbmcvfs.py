@@ -0,0 +1,16 @@
+"""Minimal stand-in for Kodi's xbmcvfs module, for benchmarks."""
+from __future__ import annotations
+import os
+
+
+def translatePath(path: str) -> str:
+    return path
+
+
+def exists(path: str) -> bool:
+    return os.path.exists(path)
+
+
+def mkdirs(path: str) -> bool:
+    os.makedirs(path, exist_ok=True)
+    return True
@@ -1,21 +1,145 @@
-from functools import wraps
-from subprocess import CompletedProcess
-from typing import Any, Callable, Dict
+from collections.abc import Generator
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache, wraps
+import os
+from typing import (
+    TYPE_CHECKING, Callable, ContextManager, Dict, Iterable, List, Optional,
+    Tuple
+)
+import xbmc  # type: ignore
 import xbmcplugin  # type: ignore
-from resources.lib.plugin import Plugin, Action, LOGDEBUG
+from resources.lib.plugin import Plugin, Action, Listing, LOGDEBUG
 from resources.lib.plugin import NOTIFICATION_INFO, NOTIFICATION_ERROR
-from resources.lib.bluetoothctl import Bluetoothctl
-from resources.lib.busy_dialog import busy_dialog
+from resources.lib.busy_dialog import Progress, progress_dialog
+
+if TYPE_CHECKING:
+    from resources.lib.bluetoothctl import Bluetoothctl
+    from resources.lib.coordination import Coordinator
+    from resources.lib.device_store import DeviceFilter, DeviceStore
+    from resources.lib.history import DeviceHistory
+    from resources.lib.output import Capture
+    from resources.lib.prefetch import ScanPrefetch
+    from resources.lib.parser import DeviceIndex, DeviceInfo
+    from resources.lib.result import CommandResult
+
+# Device types to filter by, in the order of the filter_device_type setting
+DEVICE_TYPES = ('', 'audio', 'input', 'phone', 'computer')
+
+# Time (in seconds) from constructing the plugin to running an action, above
+# which a warning is logged
+STARTUP_BUDGET = 0.05
 
 plugin = Plugin()
 
-bluetoothctl_path = plugin.get_setting('bluetoothctl_path')
-plugin.log(LOGDEBUG, f'fetched bluetoothctl path {bluetoothctl_path}')
-bluetoothctl_timeout = int(plugin.get_setting('bluetoothctl_timeout'))
-plugin.log(LOGDEBUG, f'fetched bluetoothctl timeout {bluetoothctl_timeout}')
+# Resources to release when the invocation ends, such as a bluetoothctl
+# session
+resources = ExitStack()
+
+
+def setting_enabled(setting_id: str) -> bool:
+    """
+    Return whether a boolean setting is enabled.
+    """
+    return plugin.get_setting(setting_id) == 'true'
+
+
+@lru_cache(maxsize=None)
+def get_bt() -> 'Bluetoothctl':
+    """
+    Construct the bluetooth backend from the addon settings.
+
+    The backend, and the modules it needs, are only loaded by actions which
+    use it, and only once per invocation.
+    """
+    from resources.lib.backend import create_backend
+    from resources.lib.cache import DeviceCache
+
+    cache_ttl = int(plugin.get_setting('cache_ttl'))
+    plugin.log(LOGDEBUG, 'fetched cache ttl %s', cache_ttl)
+    cache = None
+    if cache_ttl > 0:
+        cache = DeviceCache(
+            os.path.join(plugin.profile, 'devices.json'), ttl=cache_ttl,
+            log=lambda message: plugin.log(LOGDEBUG, message)
+        )
+
+    bt = create_backend(plugin.get_setting, cache=cache)
+    plugin.log(LOGDEBUG, 'created backend %s', type(bt).__name__)
+    # Share queries with, and take turns scanning with, other invocations
+    # and the service
+    bt.coordinator = get_coordinator()
+    # Commands are recorded by the backend which runs them, this one when
+    # the service is not running, otherwise the service's
+    bt.history = get_history()
+
+    if setting_enabled('service_enabled'):
+        from resources.lib.ipc import SOCKET_NAME, ServiceClient
+        # Use the service when it is running, otherwise run commands directly
+        bt = ServiceClient(os.path.join(plugin.profile, SOCKET_NAME),
+                           fallback=bt)
+    bt.recorder = plugin.recorder
 
-bt = Bluetoothctl(executable=bluetoothctl_path,
-                  scan_timeout=bluetoothctl_timeout)
+    if setting_enabled('bluetoothctl_session'):
+        # Share one bluetoothctl process between all commands of the action
+        resources.enter_context(bt.session())
+
+    return bt
+
+
+@lru_cache(maxsize=None)
+def get_coordinator() -> 'Coordinator':
+    """
+    Construct the coordinator shared with other invocations and the service.
+    """
+    from resources.lib.coordination import LOCK_DIRECTORY, Coordinator
+    return Coordinator(os.path.join(plugin.profile, LOCK_DIRECTORY))
+
+
+@lru_cache(maxsize=None)
+def get_history() -> 'Optional[DeviceHistory]':
+    """
+    Construct the history of each device from the addon settings, or None if
+    the history is disabled.
+    """
+    if not setting_enabled('history_enabled'):
+        return None
+
+    from resources.lib.history import HISTORY_NAME, DeviceHistory
+    history = DeviceHistory(
+        os.path.join(plugin.profile, HISTORY_NAME),
+        adaptive_timeouts=setting_enabled('adaptive_timeouts'),
+        log=lambda message: plugin.log(LOGDEBUG, message)
+    )
+    resources.callback(history.close)
+    return history
+
+
+@lru_cache(maxsize=None)
+def get_prefetch() -> 'Optional[ScanPrefetch]':
+    """
+    Construct the scan prefetch from the addon settings, or None if
+    prefetching is disabled.
+
+    A prefetch scans with one controller, so is not used when scanning with
+    every controller.
+    """
+    if (not setting_enabled('scan_prefetch')
+            or setting_enabled('scan_all_adapters')):
+        return None
+
+    from resources.lib.backend import create_discovery_filter
+    from resources.lib.prefetch import PREFETCH_NAME, ScanPrefetch
+    return ScanPrefetch(
+        os.path.join(plugin.profile, PREFETCH_NAME),
+        # BlueZ is shared, so a bluetoothctl scan also serves the D-Bus
+        # backend
+        plugin.get_setting('bluetoothctl_path'),
+        int(plugin.get_setting('bluetoothctl_timeout')),
+        max_age=int(plugin.get_setting('scan_prefetch_max_age')),
+        coordinator=get_coordinator(),
+        discovery_filter=create_discovery_filter(plugin.get_setting),
+        adapter=plugin.get_setting('adapter').strip().upper() or None
+    )
 
 
 @plugin.action()
@@ -26,54 +150,206 @@ def root(params: Dict[str, str]) -> None:
     params: Dictionary of query string parameters passed to the plugin. Uses
         none.
     """
-    xbmcplugin.addDirectoryItem(
-        handle=plugin.handle,
-        url=plugin.build_url(action='paired_devices'),
-        listitem=plugin.list_item(plugin.localise(30201)),
-        isFolder=True
-    )
-    xbmcplugin.addDirectoryItem(
-        handle=plugin.handle,
-        url=plugin.build_url(action='available_devices'),
-        listitem=plugin.list_item(plugin.localise(30202)),
-        isFolder=True
-    )
+    with plugin.listing() as listing:
+        listing.add(plugin.build_url(action='paired_devices'),
+                    plugin.localise(30201), is_folder=True)
+        listing.add(plugin.build_url(action='available_devices'),
+                    plugin.localise(30202), is_folder=True)
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    # Scan now so that available devices are ready if the user asks for them
+    prefetch = get_prefetch()
+    if prefetch is not None and prefetch.start():
+        plugin.log(LOGDEBUG, 'started prefetch scan')
 
 
 @plugin.action()
 def available_devices(params: Dict[str, str]) -> None:
     """
-    Show available, unpaired devices.
+    Show available, unpaired devices, a page at a time.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        none.
+        'page', the number of the page to show, without which devices are
+        scanned for first, and optionally 'name', 'min_rssi', 'type',
+        'named' and 'sort', which override the filter and sort settings.
     """
-    with busy_dialog():
-        process = bt.scan()
+    from resources.lib.device_store import SORT_ORDERS
+    store = get_device_store()
+    if 'page' not in params:
+        scan_devices(store)
+    page = int(params.get('page', 0))
+
+    device_filter = get_device_filter(params)
+    order = params.get('sort') or SORT_ORDERS[
+        int(plugin.get_setting('device_sort') or 0)
+    ]
+    devices, more = store.page(device_filter, order, page,
+                               int(plugin.get_setting('page_size')))
+
+    # Only the page's devices are queried, each through the controller which
+    # found it
+    infos = get_device_info(
+        (device.address for device in devices),
+        {device.address: device.adapter for device in devices
+         if device.adapter is not None}
+    )
+    if infos:
+        store.update_info(infos.values())
+
+    # Create a list of devices
+    with device_listing() as listing:
+        if page == 0:
+            listing.add(
+                plugin.build_url(action='search_devices', sort=order),
+                plugin.localise(30211), is_folder=True
+            ).setProperty('SpecialSort', 'top')
+            listing.add(
+                plugin.build_url(action='batch', paired=False, sort=order,
+                                 **filter_params(device_filter)),
+                plugin.localise(30214)
+            ).setProperty('SpecialSort', 'top')
+
+        for device in devices:
+            info = infos.get(device.address)
+            summary = [] if info is None else [summarise(info)]
+            if device.rssi is not None:
+                summary.append(f'{device.rssi} dBm')
+            listing.add(
+                plugin.build_url(action='device', device=device.name,
+                                 address=device.address, paired=False,
+                                 **adapter_params(device.adapter)),
+                device.name, ', '.join(filter(None, summary)),
+                is_folder=True
+            )
+
+        if more:
+            listing.add(
+                plugin.build_url(action='available_devices', page=page + 1,
+                                 sort=order, **filter_params(device_filter)),
+                plugin.localise(30212), is_folder=True
+            ).setProperty('SpecialSort', 'bottom')
+
+
+@plugin.action()
+def search_devices(params: Dict[str, str]) -> None:
+    """
+    Ask for part of a device name and show the available devices with names
+    containing it, from the last scan.
+
+    params: Dictionary of query string parameters passed to the plugin. Uses
+        'sort'.
+    """
+    name = plugin.dialog.input(plugin.localise(30211))
+    if not name:
+        xbmcplugin.endOfDirectory(plugin.handle, succeeded=False)
+        return
+    available_devices(dict(params, name=name, page='0'))
 
-    log_completed_process(process)
 
-    # Get available devices
-    devices = get_available_devices(bt)
+def scan_devices(store: 'DeviceStore') -> None:
+    """
+    Scan for available devices and replace the devices in the store with
+    them.
+    """
+    from resources.lib.bluetoothctl import DiscoveredDevice
+    bt = get_bt()
+    scan_idle_timeout = int(plugin.get_setting('scan_idle_timeout'))
+    # Stop scanning once discovery goes quiet rather than always waiting for
+    # the full timeout
+    idle = scan_idle_timeout / 1000 if scan_idle_timeout > 0 else None
+    # Controllers to scan with, None for the selected one
+    adapters: List[Optional[str]] = [None]
+    if setting_enabled('scan_all_adapters'):
+        adapters = [adapter.address
+                    for adapter in bt.get_adapter_list()] or [None]
+        plugin.log(LOGDEBUG, 'scanning with adapters %s', adapters)
+    prefetch = get_prefetch()
+    discovered: Dict[str, DiscoveredDevice] = {}
+    with cancellable(30202, bt.scan_timeout):
+        if prefetch is not None and prefetch.wait(bt.cancel):
+            # A scan started from the root menu has found the devices, only
+            # results from before it are stale
+            plugin.log(LOGDEBUG, 'using prefetch scan')
+            bt.invalidate_discovered()
+        else:
+            if len(adapters) > 1:
+                # Every controller scans at once
+                devices_found = bt.discover_all(
+                    [adapter for adapter in adapters if adapter is not None],
+                    idle=idle, cancel=bt.cancel
+                )
+            else:
+                devices_found = bt.discover(idle=idle, cancel=bt.cancel)
+            for device in devices_found:
+                plugin.log(LOGDEBUG, 'discovered %s', device)
+                discovered[device.address] = device
+
+    # Get available and paired devices together, from every controller
+    # scanned with
+    from resources.lib.fetch import fetch_device_lists
+    devices_process, paired_process = fetch_device_lists(bt, adapters[0])
+    devices = parse_devices_process(devices_process)
+    paired_devices = parse_devices_process(paired_process)
+    for adapter in adapters[1:]:
+        devices_process, paired_process = fetch_device_lists(bt, adapter)
+        for listed in parse_devices_process(devices_process):
+            if listed.address not in devices:
+                devices.add(listed)
+        for listed in parse_devices_process(paired_process):
+            paired_devices.add(listed)
 
     # Remove paired devices from list
-    paired_devices = get_paired_devices(bt)
-    for device in paired_devices.keys():
-        devices.pop(device, None)
+    for address in paired_devices.by_address:
+        devices.discard(address)
+
+    history = get_history()
+    store.replace(devices, discovered,
+                  None if history is None else history.stats(
+                      device.address for device in devices
+                  ))
+
+
+@lru_cache(maxsize=None)
+def get_device_store() -> 'DeviceStore':
+    """
+    Construct the store of available devices, shared by the pages of a
+    listing.
+    """
+    from resources.lib.device_store import STORE_NAME, DeviceStore
+    return DeviceStore(os.path.join(plugin.profile, STORE_NAME))
 
-    # Create a list of devices
-    for device, address in devices.items():
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            url=plugin.build_url(action='device', device=device,
-                                 address=address, paired=False),
-            listitem=plugin.list_item(device),
-            isFolder=True
-        )
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+def get_device_filter(params: Dict[str, str]) -> 'DeviceFilter':
+    """
+    Create the filter for a device listing from the addon settings,
+    overridden by query string parameters.
+    """
+    from resources.lib.device_store import DeviceFilter
+    min_rssi = int(params.get('min_rssi')
+                   or plugin.get_setting('filter_min_rssi') or -100)
+    return DeviceFilter(
+        name=params.get('name', ''),
+        # The lowest setting lets every device through, even those whose
+        # signal strength is unknown
+        min_rssi=min_rssi if min_rssi > -100 else None,
+        device_type=params.get('type', DEVICE_TYPES[
+            int(plugin.get_setting('filter_device_type') or 0)
+        ]),
+        named_only=params.get(
+            'named', plugin.get_setting('filter_named_only')
+        ) == 'true',
+    )
+
+
+def filter_params(device_filter: 'DeviceFilter') -> Dict[str, str]:
+    """
+    Return the query string parameters which recreate a filter.
+    """
+    return {
+        'name': device_filter.name,
+        'min_rssi': str(device_filter.min_rssi or -100),
+        'type': device_filter.device_type,
+        'named': 'true' if device_filter.named_only else 'false',
+    }
 
 
 @plugin.action()
@@ -84,64 +360,176 @@ def paired_devices(param: Dict[str, str]) -> None:
     params: Dictionary of query string parameters passed to the plugin. Uses
         none.
     """
-    devices = get_paired_devices(bt)
+    devices = get_paired_devices(get_bt())
+    details = get_device_details(devices.by_address)
 
     # Create a list of devices
-    for device, address in devices.items():
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            url=plugin.build_url(action='device', device=device,
-                                 address=address, paired=True),
-            listitem=plugin.list_item(device),
-            isFolder=True
-        )
+    with device_listing() as listing:
+        listing.add(plugin.build_url(action='batch', paired=True),
+                    plugin.localise(30214)).setProperty('SpecialSort', 'top')
+        for device in devices:
+            listing.add(
+                plugin.build_url(action='device', device=device.name,
+                                 address=device.address, paired=True),
+                device.name, details.get(device.address), is_folder=True
+            )
+
+
+def device_listing() -> ContextManager[Listing]:
+    """
+    Build a listing of devices, sortable by name.
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    Device lists reflect the current state so are not cached by Kodi.
+    """
+    return plugin.listing(
+        content='files',
+        sort_methods=(xbmcplugin.SORT_METHOD_UNSORTED,
+                      xbmcplugin.SORT_METHOD_LABEL),
+        cache_to_disc=False
+    )
 
 
-def log_completed_process(process: CompletedProcess[Any]) -> None:
+@contextmanager
+def cancellable(
+    message: int, duration: Optional[float] = None
+) -> Generator['Progress', None, None]:
+    """
+    Display a progress dialog while running commands. The commands are stopped
+    if the user cancels the dialog or Kodi exits.
+
+    message: ID of the dialog message.
+    duration: Longest time (in seconds) the commands may take, over which the
+        progress bar fills.
+
+    Yields: The dialog's Progress, whose message may be updated.
+    """
+    bt = get_bt()
+    monitor = xbmc.Monitor()
+    with progress_dialog(plugin.name, plugin.localise(message),
+                         duration) as progress:
+        bt.cancel = lambda: progress() or monitor.abortRequested()
+        try:
+            yield progress
+        finally:
+            bt.cancel = None
+
+
+@lru_cache(maxsize=None)
+def get_capture() -> 'Optional[Capture]':
+    """
+    Construct the capture of command output from the addon settings, or None
+    if capturing is disabled.
+    """
+    if not setting_enabled('capture_output'):
+        return None
+
+    from resources.lib.output import CAPTURE_NAME, Capture
+    return Capture(os.path.join(plugin.profile, CAPTURE_NAME),
+                   max_bytes=int(plugin.get_setting('capture_size')) * 1024)
+
+
+def log_completed_process(process: 'CommandResult') -> None:
+    """
+    Log the result of a command, when debug logging is enabled, with its
+    output shortened to the log output setting. The full output is captured
+    if capturing is enabled.
+    """
+    capture = get_capture()
+    if capture is not None:
+        capture.write(process)
+    if not plugin.debug_enabled:
+        return
+
+    from resources.lib.output import truncate
+    budget = int(plugin.get_setting('log_output_budget'))
     command = ' '.join(process.args)
     if process.returncode == 0:
-        plugin.log(LOGDEBUG, f'{command} successful')
-        plugin.log(LOGDEBUG, f'stdout:\n{process.stdout}')
+        plugin.log(LOGDEBUG, '%s successful', command)
+        plugin.log(LOGDEBUG, 'stdout:\n%s', truncate(process.stdout, budget))
     else:
-        plugin.log(LOGDEBUG, f'{command} failed')
-        plugin.log(LOGDEBUG,
-                   f'return code: {process.returncode}\n'
-                   f'stdout:\n{process.stdout}\n'
-                   f'stderr:\n{process.stderr}')
+        plugin.log(LOGDEBUG, '%s failed', command)
+        plugin.log(LOGDEBUG, 'return code: %s\nstdout:\n%s\nstderr:\n%s',
+                   process.returncode, truncate(process.stdout, budget),
+                   truncate(process.stderr, budget))
+    if process.retries or process.timed_out or process.cancelled:
+        plugin.log(LOGDEBUG, 'retries: %s, timed out: %s, cancelled: %s',
+                   process.retries, process.timed_out, process.cancelled)
 
 
-def get_available_devices(bt: Bluetoothctl) -> Dict[str, str]:
+def parse_devices_process(process: 'CommandResult') -> 'DeviceIndex':
     """
-    Create a dictionary of device name: device address for available devices.
+    Create an index of devices, by address, from the result of a device list
+    command.
     """
-    process = bt.get_devices()
-
     log_completed_process(process)
 
     if process.returncode == 0:
-        devices = bt.parse_devices_list(process.stdout)
+        devices = get_bt().parse_devices(process.stdout)
     else:
-        devices = {}
+        from resources.lib.parser import DeviceIndex
+        devices = DeviceIndex()
 
     return devices
 
 
-def get_paired_devices(bt: Bluetoothctl) -> Dict[str, str]:
+def get_paired_devices(bt: 'Bluetoothctl') -> 'DeviceIndex':
     """
-    Create a dictionary of device name: device address for paired devices.
+    Create an index of paired devices, by address.
     """
-    process = bt.get_paired_devices()
+    return parse_devices_process(bt.get_paired_devices())
 
-    log_completed_process(process)
 
-    if process.returncode == 0:
-        devices = bt.parse_devices_list(process.stdout)
-    else:
-        devices = {}
+def get_device_info(
+    addresses: Iterable[str], adapters: Optional[Dict[str, str]] = None
+) -> Dict[str, 'DeviceInfo']:
+    """
+    Create a dictionary of device address: information on the device.
 
-    return devices
+    Information on all devices is fetched concurrently, from the controller
+    given in adapters for those in it. Returns an empty dictionary if device
+    details are disabled.
+    """
+    if not setting_enabled('show_device_details'):
+        return {}
+
+    from resources.lib.fetch import fetch_info
+    bt = get_bt()
+    fetch_workers = int(plugin.get_setting('fetch_workers'))
+
+    infos = {}
+    for address, process in fetch_info(bt, addresses,
+                                       max_workers=fetch_workers,
+                                       adapters=adapters).items():
+        log_completed_process(process)
+        if process.returncode == 0:
+            infos[address] = bt.parse_info(process.stdout)
+    return infos
+
+
+def get_device_details(addresses: Iterable[str]) -> Dict[str, str]:
+    """
+    Create a dictionary of device address: summary of the device's state, for
+    example 'Connected, 80%, audio-headset'.
+
+    Returns an empty dictionary if device details are disabled.
+    """
+    return {address: summarise(info)
+            for address, info in get_device_info(addresses).items()}
+
+
+def summarise(info: 'DeviceInfo') -> str:
+    """
+    Return a summary of a device's state, for example
+    'Connected, 80%, audio-headset'.
+    """
+    summary = []
+    if info.connected:
+        summary.append(plugin.localise(30210))
+    if info.battery is not None:
+        summary.append(f'{info.battery}%')
+    if info.icon is not None:
+        summary.append(info.icon)
+    return ', '.join(summary)
 
 
 @plugin.action()
@@ -151,220 +539,360 @@ def device(params: Dict[str, str]) -> None:
     device is paired or not.
 
     params: Dictionary of query string parameters passed to the plugin. Expects
-        'device', 'address' and 'paired'.
+        'device', 'address' and 'paired', and optionally 'adapter', the
+        controller which reaches the device, passed on to the actions.
     """
     # Unpack parameters
     device = params['device']
     address = params['address']
     paired = params['paired']
+    adapter = params.get('adapter')
 
     if paired == str(True):
         # List actions for paired devices
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30203)),
-            url=plugin.build_url(action='connect', device=device,
-                                 address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30204)),
-            url=plugin.build_url(action='disconnect', device=device,
-                                 address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30206)),
-            url=plugin.build_url(action='unpair', device=device,
-                                 address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30207)),
-            url=plugin.build_url(action='trust', device=device,
-                                 address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30208)),
-            url=plugin.build_url(action='untrust', device=device,
-                                 address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30209)),
-            url=plugin.build_url(action='info', device=device, address=address)
-        )
+        actions = [('connect', 30203), ('disconnect', 30204),
+                   ('unpair', 30206), ('trust', 30207), ('untrust', 30208),
+                   ('info', 30209)]
     elif paired == str(False):
         # List actions for unpaired devices
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30205)),
-            url=plugin.build_url(action='pair', device=device, address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30203)),
-            url=plugin.build_url(action='connect', device=device,
-                                 address=address)
-        )
-        xbmcplugin.addDirectoryItem(
-            handle=plugin.handle,
-            listitem=plugin.list_item(plugin.localise(30209)),
-            url=plugin.build_url(action='info', device=device, address=address)
-        )
+        actions = [('setup', 30213), ('pair', 30205), ('connect', 30203),
+                   ('info', 30209)]
+    else:
+        actions = []
 
-    xbmcplugin.endOfDirectory(plugin.handle)
+    with plugin.listing() as listing:
+        for action, string_id in actions:
+            listing.add(plugin.build_url(action=action, device=device,
+                                         address=address,
+                                         **adapter_params(adapter)),
+                        plugin.localise(string_id))
 
 
+def adapter_params(adapter: Optional[str]) -> Dict[str, str]:
+    """
+    Return the query string parameters which pass on the controller
+    reaching a device, none for the selected controller.
+    """
+    return {'adapter': adapter} if adapter else {}
+
+
+# Dialog message and failure notification IDs of each setup step
+SETUP_LABELS = {'pair': (30205, 30331), 'trust': (30207, 30351),
+                'connect': (30203, 30311)}
+
 # Type signature for device action functions
-DeviceAction = Callable[[Dict[str, str]], CompletedProcess[str]]
+DeviceAction = Callable[[Dict[str, str]], 'CommandResult']
 
 
-def device_action(success: str,
-                  failure: str) -> Callable[[DeviceAction], Action]:
+def device_action(success: int,
+                  failure: int) -> Callable[[DeviceAction], Action]:
     """
     Decorator factory for actions which only call a bluetoothctl function on a
     device.
 
-    success: Notification message upon success
-    failure: Notification message upon failure
+    success: ID of the notification message upon success
+    failure: ID of the notification message upon failure
     """
     def decorator(func: DeviceAction) -> Action:
-        nonlocal success
-        nonlocal failure
-
         @wraps(func)
         def wrapper(params: Dict[str, str]) -> None:
-            nonlocal success
-            nonlocal failure
-
             process = func(params)
 
             log_completed_process(process)
-
-            if process.returncode == 0:
-                plugin.notification(success, NOTIFICATION_INFO)
-            else:
-                plugin.notification(failure, NOTIFICATION_ERROR)
+            notify_result(process, success, failure)
         return wrapper
     return decorator
 
 
+def notify_result(process: 'CommandResult', success: int,
+                  failure: int) -> None:
+    """
+    Notify the user of the outcome of a command.
+
+    success: ID of the notification message upon success
+    failure: ID of the notification message upon failure
+    """
+    # Messages are only localised once the outcome is known
+    if process.returncode == 0:
+        plugin.notification(plugin.localise(success), NOTIFICATION_INFO)
+    elif process.cancelled:
+        plugin.notification(plugin.localise(30381), NOTIFICATION_INFO)
+    elif process.timed_out:
+        plugin.notification(f'{plugin.localise(failure)}, '
+                            f'{plugin.localise(30380)}',
+                            NOTIFICATION_ERROR)
+    else:
+        plugin.notification(plugin.localise(failure), NOTIFICATION_ERROR)
+
+
 @plugin.action()
-@device_action(success=plugin.localise(30310), failure=plugin.localise(30311))
-def connect(params: Dict[str, str]) -> CompletedProcess[str]:
+@device_action(success=30310, failure=30311)
+def connect(params: Dict[str, str]) -> 'CommandResult':
     """
     Connect to a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'address'.
+        'address', and optionally 'adapter', the controller to use.
     """
     address = params['address']
 
-    with busy_dialog():
-        process = bt.connect(address)
+    bt = get_bt()
+    with cancellable(30203, bt.command_timeout(['connect'])):
+        process = bt.connect(address, adapter=params.get('adapter'))
 
     return process
 
 
 @plugin.action()
-@device_action(success=plugin.localise(30320), failure=plugin.localise(30321))
-def disconnect(params: Dict[str, str]) -> CompletedProcess[str]:
+@device_action(success=30320, failure=30321)
+def disconnect(params: Dict[str, str]) -> 'CommandResult':
     """
     Disconnect from a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'address'.
+        'address', and optionally 'adapter', the controller to use.
     """
     address = params['address']
 
-    with busy_dialog():
-        process = bt.disconnect(address)
+    bt = get_bt()
+    with cancellable(30204, bt.command_timeout(['disconnect'])):
+        process = bt.disconnect(address, adapter=params.get('adapter'))
 
     return process
 
 
 @plugin.action()
-@device_action(success=plugin.localise(30330), failure=plugin.localise(30331))
-def pair(params: Dict[str, str]) -> CompletedProcess[str]:
+@device_action(success=30330, failure=30331)
+def pair(params: Dict[str, str]) -> 'CommandResult':
     """
     Pair with a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'address'.
+        'address', and optionally 'adapter', the controller to use.
     """
     address = params['address']
 
-    with busy_dialog():
-        process = bt.pair(address)
+    bt = get_bt()
+    with cancellable(30205, bt.command_timeout(['pair'])):
+        process = bt.pair(address, adapter=params.get('adapter'))
 
     return process
 
 
 @plugin.action()
-@device_action(success=plugin.localise(30340), failure=plugin.localise(30341))
-def remove(params: Dict[str, str]) -> CompletedProcess[str]:
+def setup(params: Dict[str, str]) -> None:
+    """
+    Pair with, trust and connect to a device in one operation, stopping at
+    the first step which fails.
+
+    params: Dictionary of query string parameters passed to the plugin. Uses
+        'address', and optionally 'adapter', the controller to use.
+    """
+    from resources.lib.bluetoothctl import SETUP_STEPS
+
+    address = params['address']
+
+    bt = get_bt()
+    duration = sum(bt.command_timeout([step]) or 0 for step in SETUP_STEPS)
+    with cancellable(30213, duration) as progress:
+        def on_step(step: str) -> None:
+            number = SETUP_STEPS.index(step) + 1
+            progress.update(f'{plugin.localise(SETUP_LABELS[step][0])} '
+                            f'({number}/{len(SETUP_STEPS)})')
+        process = bt.setup(address, on_step=on_step,
+                           adapter=params.get('adapter'))
+
+    log_completed_process(process)
+    # A failure is reported as that of the step which failed
+    failure = SETUP_LABELS[process.failed][1] if process.failed else 30391
+    notify_result(process, success=30390, failure=failure)
+
+
+@plugin.action()
+@device_action(success=30340, failure=30341)
+def remove(params: Dict[str, str]) -> 'CommandResult':
     """
     Remove (unpair) a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'address'.
+        'address', and optionally 'adapter', the controller to use.
     """
     address = params['address']
 
-    with busy_dialog():
-        process = bt.remove(address)
+    bt = get_bt()
+    with cancellable(30206, bt.command_timeout(['remove'])):
+        process = bt.remove(address, adapter=params.get('adapter'))
 
     return process
 
 
 @plugin.action()
-@device_action(success=plugin.localise(30350), failure=plugin.localise(30351))
-def trust(params: Dict[str, str]) -> CompletedProcess[str]:
+@device_action(success=30350, failure=30351)
+def trust(params: Dict[str, str]) -> 'CommandResult':
     """
     Trust a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'address'.
+        'address', and optionally 'adapter', the controller to use.
     """
     address = params['address']
 
-    with busy_dialog():
-        process = bt.trust(address)
+    bt = get_bt()
+    with cancellable(30207, bt.command_timeout(['trust'])):
+        process = bt.trust(address, adapter=params.get('adapter'))
 
     return process
 
 
 @plugin.action()
-@device_action(success=plugin.localise(30360), failure=plugin.localise(30361))
-def untrust(params: Dict[str, str]) -> CompletedProcess[str]:
+@device_action(success=30360, failure=30361)
+def untrust(params: Dict[str, str]) -> 'CommandResult':
     """
     Revoke trust in a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'address'.
+        'address', and optionally 'adapter', the controller to use.
     """
     address = params['address']
 
-    with busy_dialog():
-        process = bt.trust(address)
+    bt = get_bt()
+    with cancellable(30208, bt.command_timeout(['untrust'])):
+        process = bt.untrust(address, adapter=params.get('adapter'))
 
     return process
 
 
+# Dialog message, success and failure notification IDs of each command which
+# may be run on several devices
+BATCH_LABELS = {
+    'connect': (30203, 30310, 30311), 'disconnect': (30204, 30320, 30321),
+    'pair': (30205, 30330, 30331), 'setup': (30213, 30390, 30391),
+    'remove': (30206, 30340, 30341), 'trust': (30207, 30350, 30351),
+    'untrust': (30208, 30360, 30361),
+}
+# Commands offered for several paired and several available devices
+BATCH_PAIRED = ('connect', 'disconnect', 'remove', 'trust', 'untrust')
+BATCH_AVAILABLE = ('setup', 'pair', 'connect')
+
+
+@plugin.action()
+def batch(params: Dict[str, str]) -> None:
+    """
+    Ask for a command and the devices to run it on, run it on all of them at
+    once and notify the user of the outcome for all of them together.
+
+    params: Dictionary of query string parameters passed to the plugin. Uses
+        'paired', and for available devices optionally 'name', 'min_rssi',
+        'type', 'named' and 'sort', which choose the devices offered as in
+        the listing.
+    """
+    from resources.lib.batch import run_batch
+    from resources.lib.bluetoothctl import SETUP_STEPS
+
+    commands = (BATCH_PAIRED if params['paired'] == str(True)
+                else BATCH_AVAILABLE)
+    choice = plugin.dialog.select(
+        plugin.localise(30214),
+        [plugin.localise(BATCH_LABELS[command][0]) for command in commands]
+    )
+    if choice < 0:
+        return
+    command = commands[choice]
+    message, success, failure = BATCH_LABELS[command]
+
+    bt = get_bt()
+    names, adapters = get_batch_devices(bt, params)
+    selected = plugin.dialog.multiselect(plugin.localise(message),
+                                         list(names.values()))
+    if not selected:
+        return
+    addresses = [list(names)[index] for index in selected]
+
+    # Commands in a session run one at a time anyway, so are run in order
+    workers = 1 if setting_enabled('bluetoothctl_session') else max(
+        1, int(plugin.get_setting('fetch_workers'))
+    )
+    steps = SETUP_STEPS if command == 'setup' else (command,)
+    rounds = -(-len(addresses) // workers)
+    duration = rounds * sum(bt.command_timeout([step]) or 0
+                            for step in steps)
+    with cancellable(message, duration) as progress:
+        finished = 0
+
+        def on_result(address: str, process: 'CommandResult') -> None:
+            nonlocal finished
+            finished += 1
+            progress.update(f'{plugin.localise(message)} '
+                            f'({finished}/{len(addresses)})')
+        results = run_batch(bt, command, addresses, max_workers=workers,
+                            adapters=adapters, on_result=on_result)
+
+    for process in results.values():
+        log_completed_process(process)
+    notify_batch(results, names, success, failure)
+
+
+def get_batch_devices(
+    bt: 'Bluetoothctl', params: Dict[str, str]
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Return dictionaries of device address: name and of device address:
+    controller which reaches the device, of the devices offered to a batch.
+
+    Paired devices are listed afresh, available devices are those of the
+    last scan, filtered and sorted as in the listing.
+    """
+    if params['paired'] == str(True):
+        return {device.address: device.name
+                for device in get_paired_devices(bt)}, {}
+
+    from resources.lib.device_store import SORT_ORDERS
+    store = get_device_store()
+    order = params.get('sort') or SORT_ORDERS[
+        int(plugin.get_setting('device_sort') or 0)
+    ]
+    devices, _ = store.page(get_device_filter(params), order, size=0)
+    return ({device.address: device.name for device in devices},
+            {device.address: device.adapter for device in devices
+             if device.adapter is not None})
+
+
+def notify_batch(results: Dict[str, 'CommandResult'], names: Dict[str, str],
+                 success: int, failure: int) -> None:
+    """
+    Notify the user of the outcome of a command on several devices, in one
+    notification naming the devices it succeeded and failed on.
+
+    success: ID of the notification message upon success
+    failure: ID of the notification message upon failure
+    """
+    succeeded = [names[address] for address, process in results.items()
+                 if process.returncode == 0]
+    failed = [names[address] for address, process in results.items()
+              if process.returncode != 0 and not process.cancelled]
+    summary = []
+    if succeeded:
+        summary.append(f'{plugin.localise(success)}: {", ".join(succeeded)}')
+    if failed:
+        summary.append(f'{plugin.localise(failure)}: {", ".join(failed)}')
+    if any(process.cancelled for process in results.values()):
+        summary.append(plugin.localise(30381))
+    plugin.notification('; '.join(summary),
+                        NOTIFICATION_ERROR if failed else NOTIFICATION_INFO)
+
+
 @plugin.action()
 def info(params: Dict[str, str]) -> None:
     """
     Show information about a device.
 
     params: Dictionary of query string parameters passed to the plugin. Uses
-        'device', 'address'.
+        'device', 'address', and optionally 'adapter', the controller to use.
     """
     device = params['device']
     address = params['address']
 
-    process = bt.info(address)
+    process = get_bt().info(address, adapter=params.get('adapter'))
 
     log_completed_process(process)
 
@@ -383,4 +911,11 @@ def info(params: Dict[str, str]) -> None:
 
 
 if __name__ == "__main__":
-    plugin.run()
+    try:
+        with resources:
+            plugin.run(startup_budget=STARTUP_BUDGET)
+    finally:
+        if setting_enabled('metrics_enabled'):
+            plugin.recorder.append_to(
+                os.path.join(plugin.profile, 'metrics.jsonl')
+            )
@@ -0,0 +1,726 @@
+from __future__ import annotations
+from collections.abc import AsyncGenerator, Iterable
+from contextlib import ExitStack, asynccontextmanager
+from typing import Callable, Optional, TypeVar
+import asyncio
+import concurrent.futures
+import threading
+import time
+from .bluetoothctl import (
+    SETUP_STEPS, Bluetoothctl, BluetoothctlBase, DiscoveredDevice,
+    DiscoveryFilter
+)
+from .cache import DeviceCache
+from .parser import Adapter
+from .result import CommandResult, PipelineResult, RetryPolicy
+from .session import BluetoothctlSession
+
+T = TypeVar('T')
+
+
+class AsyncBluetoothctl(BluetoothctlBase):
+    """
+    Interact with the 'bluetoothctl' utility from asyncio code.
+
+    The asynchronous counterpart of Bluetoothctl, with the same methods as
+    coroutines, so that commands for several devices can be gathered and
+    overlapped with other work. Each command runs in its own bluetoothctl
+    process. Commands on a particular controller, other than scans, run in a
+    thread as bluetoothctl only selects a controller interactively.
+
+    Results are cached, and commands coordinated with other processes, as by
+    Bluetoothctl, so both may share a cache and a coordinator.
+
+    Cancelling a command's task stops its process.
+    """
+
+    def __init__(self, executable: str = '/usr/bin/bluetoothctl',
+                 scan_timeout: int = 5,
+                 cache: Optional[DeviceCache] = None,
+                 timeouts: Optional[dict[str, float]] = None,
+                 retry: RetryPolicy = RetryPolicy(),
+                 discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+                 adapter: Optional[str] = None) -> None:
+        """
+        Construct an AsyncBluetoothctl instance.
+
+        executable: Path to the bluetoothctl executable on the host.
+        scan_timeout: Time (in seconds) to spend scanning for available
+            devices.
+        cache: Cache for device lists and information. Entries are
+            invalidated when a command changes device state.
+        timeouts: Dictionary of command: time (in seconds) after which the
+            command is stopped, as for Bluetoothctl.
+        retry: Policy for repeating commands which fail transiently.
+        discovery_filter: Which devices scans report, unless a scan is given
+            its own filter.
+        adapter: Address of the controller commands run on, unless a
+            command is given its own. By default the default controller.
+        """
+        super().__init__(executable=executable, scan_timeout=scan_timeout,
+                         cache=cache, timeouts=timeouts, retry=retry,
+                         discovery_filter=discovery_filter, adapter=adapter)
+
+    @classmethod
+    def like(cls, bt: Bluetoothctl) -> AsyncBluetoothctl:
+        """
+        Construct an AsyncBluetoothctl instance with the same executable,
+        cache, timeouts, retry policy, discovery filter, controller,
+        coordinator and history as a Bluetoothctl instance.
+        """
+        like = cls(executable=bt.executable, scan_timeout=bt.scan_timeout,
+                   cache=bt.cache, timeouts=bt.timeouts, retry=bt.retry,
+                   discovery_filter=bt.discovery_filter, adapter=bt.adapter)
+        like.coordinator = bt.coordinator
+        like.history = bt.history
+        return like
+
+    async def _run(self, command: list[str],
+                   duration: Optional[float] = None,
+                   adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, timing it and using the cache.
+
+        command: bluetoothctl command and its arguments.
+        duration: Time (in seconds) to let the command run for, for commands
+            which do not finish on their own such as 'scan on'.
+        adapter: Address of the controller to run the command on, by default
+            adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        adapter = self.command_adapter(command, adapter)
+        with self._span('command', self.command_key(command, adapter)) as span:
+            process = await self._run_cached(command, duration, adapter)
+            self._record_span(span, process)
+        return process
+
+    async def _run_cached(self, command: list[str],
+                          duration: Optional[float] = None,
+                          adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, using and maintaining the cache.
+        """
+        cached = self.cached_result(command, adapter)
+        if cached is not None:
+            return cached
+        process = await self._coordinated(command, duration, adapter)
+        self.cache_result(command, adapter, process)
+        return process
+
+    async def _coordinated(self, command: list[str],
+                           duration: Optional[float] = None,
+                           adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, coordinating with other processes and
+        other backends if a coordinator is set, as Bluetoothctl does.
+
+        Queries already in flight elsewhere are not repeated, their result is
+        shared. Scans, and commands changing the same device, take turns.
+        """
+        if self.coordinator is None:
+            return await self._attempt(command, duration, adapter)
+        if self._is_query(command):
+            return await self._single_flight(command, duration, adapter)
+        async with self._exclusive(self._lock_name(command, adapter)):
+            return await self._attempt(command, duration, adapter)
+
+    async def _single_flight(self, command: list[str],
+                             duration: Optional[float],
+                             adapter: Optional[str]) -> CommandResult:
+        """
+        Run a query, or share the result of an identical one in flight.
+
+        The coordinator waits for the query's lock in a thread, the query
+        itself runs in the event loop.
+        """
+        coordinator = self.coordinator
+        assert coordinator is not None
+        loop = asyncio.get_event_loop()
+
+        def single_flight(cancel: Callable[[], bool]) -> CommandResult:
+            def run() -> CommandResult:
+                attempt = asyncio.run_coroutine_threadsafe(
+                    self._attempt(command, duration, adapter), loop
+                )
+                while True:
+                    try:
+                        return attempt.result(timeout=coordinator.poll)
+                    except concurrent.futures.TimeoutError:
+                        if cancel():
+                            attempt.cancel()
+                            return self._cancelled(command)
+
+            process = coordinator.single_flight(
+                self.command_key(command, adapter), run, cancel
+            )
+            return process if process is not None else self._cancelled(command)
+
+        return await self._in_thread(single_flight)
+
+    @asynccontextmanager
+    async def _exclusive(self, name: str) -> AsyncGenerator[None, None]:
+        """
+        Hold a named lock of the coordinator, if set, waiting in a thread for
+        any other holder to release it.
+        """
+        coordinator = self.coordinator
+        with ExitStack() as stack:
+            if coordinator is not None:
+                await self._in_thread(
+                    lambda cancel: stack.enter_context(
+                        coordinator.exclusive(name, cancel)
+                    )
+                )
+            yield
+
+    @staticmethod
+    async def _in_thread(call: Callable[[Callable[[], bool]], T]) -> T:
+        """
+        Run a blocking call, such as waiting for a lock, in its own thread,
+        so that it never waits for a command queued in the default executor.
+
+        call: Function given a function which returns True once the task
+            awaiting the call is cancelled, so that it stops waiting.
+        """
+        loop = asyncio.get_event_loop()
+        future: asyncio.Future[T] = loop.create_future()
+        cancelled = threading.Event()
+
+        def run() -> None:
+            try:
+                result = call(cancelled.is_set)
+            except BaseException as exc:
+                loop.call_soon_threadsafe(future.set_exception, exc)
+            else:
+                loop.call_soon_threadsafe(future.set_result, result)
+
+        threading.Thread(target=run, daemon=True).start()
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled.set()
+            # The call stops soon after, wait for it so that nothing it
+            # takes, such as a lock, is left behind
+            await asyncio.wait([future])
+            raise
+
+    async def _attempt(self, command: list[str],
+                       duration: Optional[float] = None,
+                       adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, repeating it with increasing delays while
+        it fails transiently, as set by the retry policy.
+        """
+        attempts = 0
+        while True:
+            started = time.monotonic()
+            process = await self._execute(command, duration, adapter)
+            self._record_run(command, started, process)
+            attempts += process.attempts
+            process.attempts = attempts
+            if not self.retry.should_retry(process, attempts):
+                return process
+            await asyncio.sleep(self.retry.delay(attempts))
+
+    async def _execute(self, command: list[str],
+                       duration: Optional[float] = None,
+                       adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command in a new process.
+
+        The process is killed if it outlasts its timeout, which for commands
+        with a duration starts once the duration has passed, or if the task
+        is cancelled.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        args = [self.executable]
+        timeout = self.command_timeout(command)
+        discovery_filter = self._scan_filter(command, adapter)
+        if discovery_filter is None and adapter is not None:
+            return await self._execute_selected(command, duration, timeout,
+                                                adapter)
+        if discovery_filter is None:
+            if duration is not None:
+                args += ['--timeout', str(int(duration))]
+                if timeout is not None:
+                    timeout += duration
+            args += command
+
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=(None if discovery_filter is None
+                   else asyncio.subprocess.PIPE),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        if discovery_filter is not None:
+            args += command
+        stop = None
+        try:
+            if discovery_filter is not None:
+                # A filter only lasts as long as the process which set it, so
+                # filtered scans, like those on a particular controller, run
+                # interactively
+                self._send(process, [
+                    *self._scan_script(discovery_filter, adapter),
+                    'scan on'
+                ])
+                await asyncio.sleep(duration or 0)
+                stop = b'scan off\nquit\n'
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(stop), timeout
+            )
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return CommandResult(args, process.returncode or -1, '',
+                                 'timed out\n', timed_out=True)
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+        return CommandResult(args, process.returncode or 0,
+                             stdout.decode('utf8', errors='replace'),
+                             stderr.decode('utf8', errors='replace'))
+
+    async def _execute_selected(self, command: list[str],
+                                duration: Optional[float],
+                                timeout: Optional[float],
+                                adapter: str) -> CommandResult:
+        """
+        Run a bluetoothctl command on a controller, in an interactive process
+        run from a thread.
+
+        Cancelling the task stops waiting for the result, and the process.
+        """
+        cancelled = threading.Event()
+
+        def run() -> CommandResult:
+            with BluetoothctlSession(self.executable) as session:
+                return session.run(command, duration=duration,
+                                   timeout=timeout, cancel=cancelled.is_set,
+                                   adapter=adapter)
+
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, run)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    @staticmethod
+    def _send(process: asyncio.subprocess.Process,
+              lines: list[str]) -> None:
+        """Write commands to an interactive bluetoothctl process."""
+        if process.stdin is not None:
+            process.stdin.write(
+                ''.join(f'{line}\n' for line in lines).encode()
+            )
+
+    async def stream(self, command: list[str],
+                     duration: Optional[float] = None,
+                     adapter: Optional[str] = None
+                     ) -> AsyncGenerator[str, None]:
+        """
+        Run a bluetoothctl command, yielding its output line by line as it
+        arrives. Results are not cached.
+
+        The process is stopped when the generator is closed or its task is
+        cancelled.
+
+        command: bluetoothctl command and its arguments. A filtered
+            'scan on' runs interactively, stopping after the duration.
+        duration: Time (in seconds) to let the command run for, for commands
+            which do not finish on their own such as 'scan on'.
+        adapter: Address of the controller to scan with, by default the
+            default controller. Only scans may be given a controller.
+
+        Yields: Lines of output, including their line ending.
+        """
+        args = [self.executable]
+        discovery_filter = self._scan_filter(command, adapter)
+        if discovery_filter is None:
+            if duration is not None:
+                args += ['--timeout', str(int(duration))]
+            args += command
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=(None if discovery_filter is None
+                   else asyncio.subprocess.PIPE),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        assert process.stdout is not None
+        deadline = None
+        if discovery_filter is not None:
+            self._send(process, [
+                *self._scan_script(discovery_filter, adapter),
+                'scan on'
+            ])
+            deadline = time.monotonic() + (duration or 0)
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(
+                        process.stdout.readline(),
+                        None if deadline is None
+                        else max(0, deadline - time.monotonic())
+                    )
+                except asyncio.TimeoutError:
+                    self._send(process, ['scan off', 'quit'])
+                    deadline = None
+                    continue
+                if not line:
+                    break
+                yield line.decode('utf8', errors='replace')
+        finally:
+            if process.returncode is None:
+                process.terminate()
+            await process.wait()
+
+    async def scan(self, discovery_filter: Optional[DiscoveryFilter] = None,
+                   adapter: Optional[str] = None) -> CommandResult:
+        """
+        Scan for available devices.
+
+        discovery_filter: Which devices the scan reports, by default
+            discovery_filter.
+        adapter: Address of the controller to scan with, by default
+            adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        if discovery_filter is None:
+            discovery_filter = self.discovery_filter
+        return await self._run(['scan', 'on', *discovery_filter.arguments()],
+                               duration=self.scan_timeout, adapter=adapter)
+
+    async def discover(
+        self,
+        until: Optional[Callable[[DiscoveredDevice], bool]] = None,
+        idle: Optional[float] = None,
+        discovery_filter: Optional[DiscoveryFilter] = None,
+        adapter: Optional[str] = None,
+    ) -> AsyncGenerator[DiscoveredDevice, None]:
+        """
+        Scan for available devices, yielding them as they are found.
+
+        The scan lasts at most scan_timeout seconds but stops as soon as a
+        stop condition is met, or the generator is closed or cancelled.
+
+        until: Stop after yielding a device for which this returns True.
+        idle: Stop when no new device has been found for this long (in
+            seconds).
+        discovery_filter: Which devices the scan reports, by default
+            discovery_filter.
+        adapter: Address of the controller to scan with, by default
+            adapter. Devices are reported with it.
+
+        Yields: A DiscoveredDevice for each new device and each change to a
+            device's name or RSSI.
+        """
+        if discovery_filter is None:
+            discovery_filter = self.discovery_filter
+        adapter = adapter or self.adapter
+        self.invalidate_discovered()
+
+        # Wait for any other scan to finish rather than race it
+        async with self._exclusive(self._lock_name(['scan'], adapter)):
+            async for device in self._discover(until, idle, discovery_filter,
+                                               adapter):
+                yield device
+
+    async def _discover(
+        self,
+        until: Optional[Callable[[DiscoveredDevice], bool]],
+        idle: Optional[float],
+        discovery_filter: DiscoveryFilter,
+        adapter: Optional[str],
+    ) -> AsyncGenerator[DiscoveredDevice, None]:
+        """
+        Scan for available devices, yielding them as they are found, see
+        discover.
+        """
+        seen: dict[str, DiscoveredDevice] = {}
+        lines = self.stream(['scan', 'on', *discovery_filter.arguments()],
+                            duration=self.scan_timeout, adapter=adapter)
+        last_new = time.monotonic()
+        try:
+            while True:
+                wait = (None if idle is None
+                        else max(0, last_new + idle - time.monotonic()))
+                try:
+                    line = await asyncio.wait_for(lines.__anext__(), wait)
+                except (StopAsyncIteration, asyncio.TimeoutError):
+                    return
+
+                device = self._parse_discovery(line, seen)
+                if device is not None and adapter is not None:
+                    device = device._replace(adapter=adapter)
+                if device is None or device == seen.get(device.address):
+                    continue
+                if device.address not in seen:
+                    last_new = time.monotonic()
+                seen[device.address] = device
+                yield device
+                if until is not None and until(device):
+                    return
+        finally:
+            await lines.aclose()
+            if self.history is not None:
+                self.history.record_seen(seen.values())
+
+    async def discover_all(
+        self,
+        adapters: Optional[Iterable[str]] = None,
+        until: Optional[Callable[[DiscoveredDevice], bool]] = None,
+        idle: Optional[float] = None,
+        discovery_filter: Optional[DiscoveryFilter] = None,
+    ) -> AsyncGenerator[DiscoveredDevice, None]:
+        """
+        Scan for available devices with several controllers at once,
+        yielding them as they are found, as Bluetoothctl.discover_all.
+
+        adapters: Addresses of the controllers to scan with, by default every
+            controller listed.
+
+        Yields: A DiscoveredDevice for each new device and each change to a
+            device's name, best RSSI or the controller receiving it.
+        """
+        if adapters is None:
+            adapters = [adapter.address
+                        for adapter in await self.get_adapter_list()]
+        adapters = list(adapters)
+        if len(adapters) <= 1:
+            async for device in self.discover(
+                until, idle, discovery_filter,
+                adapters[0] if adapters else None
+            ):
+                yield device
+            return
+
+        events: asyncio.Queue[Optional[DiscoveredDevice]] = asyncio.Queue()
+
+        async def scan(adapter: str) -> None:
+            try:
+                async for device in self.discover(
+                    discovery_filter=discovery_filter, adapter=adapter
+                ):
+                    events.put_nowait(device)
+            finally:
+                # Marks the end of this controller's scan
+                events.put_nowait(None)
+
+        tasks = [asyncio.ensure_future(scan(adapter)) for adapter in adapters]
+        # Last reported state of each device, by each controller
+        reports: dict[str, dict[Optional[str], DiscoveredDevice]] = {}
+        merged: dict[str, DiscoveredDevice] = {}
+        running = len(tasks)
+        last_new = time.monotonic()
+        try:
+            while running:
+                wait = (None if idle is None
+                        else max(0, last_new + idle - time.monotonic()))
+                try:
+                    report = await asyncio.wait_for(events.get(), wait)
+                except asyncio.TimeoutError:
+                    return
+                if report is None:
+                    running -= 1
+                    continue
+
+                reports.setdefault(report.address, {})[report.adapter] = report
+                device = self._merge_discovered(
+                    reports[report.address].values()
+                )
+                if device == merged.get(device.address):
+                    continue
+                if device.address not in merged:
+                    last_new = time.monotonic()
+                merged[device.address] = device
+                yield device
+                if until is not None and until(device):
+                    return
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def get_adapters(self) -> CommandResult:
+        """
+        List controllers.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['list'])
+
+    async def get_adapter_list(self) -> list[Adapter]:
+        """
+        List controllers, none if they can not be listed.
+
+        Returns: List of Adapter, in the order listed.
+        """
+        process = await self.get_adapters()
+        if process.returncode != 0:
+            return []
+        return self.parse_adapters(process.stdout)
+
+    async def select(self, adapter: Optional[str]) -> bool:
+        """
+        Run later commands on a controller, unless they are given their own,
+        as bluetoothctl's `select` does.
+
+        adapter: Address of the controller, None for the default controller.
+
+        Returns: Whether the controller is available, otherwise the
+            selection is unchanged.
+        """
+        if adapter is not None:
+            adapter = adapter.upper()
+            if all(listed.address != adapter
+                   for listed in await self.get_adapter_list()):
+                return False
+        self.adapter = adapter
+        return True
+
+    async def get_devices(self,
+                          adapter: Optional[str] = None) -> CommandResult:
+        """
+        List available devices.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['devices'], adapter=adapter)
+
+    async def get_paired_devices(self, adapter: Optional[str] = None
+                                 ) -> CommandResult:
+        """
+        List paired devices
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['paired-devices'], adapter=adapter)
+
+    async def connect(self, address: str,
+                      adapter: Optional[str] = None) -> CommandResult:
+        """
+        Connect to a device.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['connect', address], adapter=adapter)
+
+    async def disconnect(self, address: str,
+                         adapter: Optional[str] = None) -> CommandResult:
+        """
+        Disconnect from a device.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['disconnect', address], adapter=adapter)
+
+    async def pair(self, address: str,
+                   adapter: Optional[str] = None) -> CommandResult:
+        """
+        Pair with a device.
+
+        This method only support non-interactive pairing.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['pair', address], adapter=adapter)
+
+    async def remove(self, address: str,
+                     adapter: Optional[str] = None) -> CommandResult:
+        """
+        Remove (unpair) a device.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['remove', address], adapter=adapter)
+
+    async def trust(self, address: str,
+                    adapter: Optional[str] = None) -> CommandResult:
+        """
+        Trust a device.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['trust', address], adapter=adapter)
+
+    async def untrust(self, address: str,
+                      adapter: Optional[str] = None) -> CommandResult:
+        """
+        Revoke trust in a device.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['untrust', address], adapter=adapter)
+
+    async def info(self, address: str,
+                   adapter: Optional[str] = None) -> CommandResult:
+        """
+        Get device information.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return await self._run(['info', address], adapter=adapter)
+
+    async def setup(self, address: str,
+                    on_step: Optional[Callable[[str], None]] = None,
+                    adapter: Optional[str] = None) -> PipelineResult:
+        """
+        Pair with, trust and connect to a device, as one operation.
+
+        The steps stop at the first which fails. Pairing a device which is
+        paired already does not stop the setup.
+
+        on_step: Function called with the name of each step, one of
+            SETUP_STEPS, before it runs, for example to show progress.
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A PipelineResult instance containing the results of the
+            steps run.
+        """
+        steps: list[tuple[str, CommandResult]] = []
+        for step in SETUP_STEPS:
+            if on_step is not None:
+                on_step(step)
+            process: CommandResult = await getattr(self, step)(
+                address, adapter=adapter
+            )
+            steps.append((step, process))
+            if self._setup_failed(step, process):
+                break
+        return PipelineResult([self.executable, 'setup', address], steps)
@@ -0,0 +1,65 @@
+from __future__ import annotations
+from typing import Callable, Optional
+from .bluetoothctl import AUDIO_UUIDS, Bluetoothctl, DiscoveryFilter
+from .cache import DeviceCache
+from .result import RetryPolicy
+
+# Commands with their own timeout setting, command: setting id
+_TIMEOUT_SETTINGS = {
+    'default': 'command_timeout',
+    'connect': 'connect_timeout',
+    'pair': 'pair_timeout',
+}
+
+
+def create_discovery_filter(
+    get_setting: Callable[[str], str]
+) -> DiscoveryFilter:
+    """
+    Construct the discovery filter chosen in the addon settings.
+
+    get_setting: Function returning the value of an addon setting.
+    """
+    uuids = [uuid.strip() for uuid in get_setting('scan_uuids').split(',')
+             if uuid.strip()]
+    if get_setting('scan_audio_only') == 'true':
+        uuids += AUDIO_UUIDS
+    # The lowest setting lets every device through
+    rssi = int(get_setting('scan_rssi') or -100)
+    return DiscoveryFilter(
+        transport=get_setting('scan_transport') or 'auto',
+        rssi=rssi if rssi > -100 else None,
+        uuids=tuple(dict.fromkeys(uuids)),
+        pattern=get_setting('scan_pattern'),
+        duplicate_data=get_setting('scan_duplicate_data') != 'false',
+    )
+
+
+def create_backend(get_setting: Callable[[str], str],
+                   cache: Optional[DeviceCache] = None) -> Bluetoothctl:
+    """
+    Construct the Bluetooth backend chosen in the addon settings.
+
+    get_setting: Function returning the value of an addon setting.
+    cache: Cache for device lists and information.
+    """
+    scan_timeout = int(get_setting('bluetoothctl_timeout'))
+    # A timeout of 0 lets commands run indefinitely
+    timeouts = {command: float(get_setting(setting_id))
+                for command, setting_id in _TIMEOUT_SETTINGS.items()}
+    retry = RetryPolicy(attempts=max(1, int(get_setting('retry_attempts'))))
+    discovery_filter = create_discovery_filter(get_setting)
+    # An empty setting leaves commands on the default controller
+    adapter = get_setting('adapter').strip().upper() or None
+
+    if get_setting('backend') == 'dbus':
+        # Only import dbus-python when it is needed
+        from .bluez_dbus import BluezDBus
+        return BluezDBus(scan_timeout=scan_timeout, cache=cache,
+                         timeouts=timeouts, retry=retry,
+                         discovery_filter=discovery_filter, adapter=adapter)
+
+    return Bluetoothctl(executable=get_setting('bluetoothctl_path'),
+                        scan_timeout=scan_timeout, cache=cache,
+                        timeouts=timeouts, retry=retry,
+                        discovery_filter=discovery_filter, adapter=adapter)
@@ -0,0 +1,74 @@
+from __future__ import annotations
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional
+from .bluetoothctl import Bluetoothctl
+from .result import CommandResult
+
+# Device commands which may be run on several devices at once
+BATCH_COMMANDS = ('connect', 'disconnect', 'pair', 'setup', 'remove', 'trust',
+                  'untrust')
+
+
+class BatchException(Exception):
+    """
+    Exception for run_batch function.
+    """
+    pass
+
+
+def run_batch(bt: Bluetoothctl, command: str, addresses: Iterable[str],
+              max_workers: int = 4,
+              adapters: Optional[Mapping[str, str]] = None,
+              on_result: Optional[Callable[[str, CommandResult], None]] = None
+              ) -> dict[str, CommandResult]:
+    """
+    Run a device command on several devices.
+
+    Commands run concurrently, up to max_workers at once. With one worker
+    they run in order in the calling thread, so a session the backend is in
+    runs them all in its one process. Devices not started on by the time
+    the backend's cancel function returns True are skipped.
+
+    command: One of BATCH_COMMANDS.
+    addresses: Addresses of the devices.
+    max_workers: Maximum number of commands to run at once.
+    adapters: Dict of device_address: address of the controller to use,
+        devices missing from it use the backend's.
+    on_result: Function called with each device's address and result as it
+        finishes, in the calling thread, for example to show progress.
+
+    Returns: Dict of device_address: CommandResult instance, in the order of
+        addresses.
+    """
+    if command not in BATCH_COMMANDS:
+        raise BatchException(f'{command} cannot be run on several devices')
+
+    addresses = list(dict.fromkeys(addresses))
+    controllers = adapters if adapters is not None else {}
+
+    def run(address: str) -> CommandResult:
+        if bt.cancel is not None and bt.cancel():
+            return CommandResult([bt.executable, command, address], 1, '',
+                                 'cancelled\n', cancelled=True)
+        process: CommandResult = getattr(bt, command)(
+            address, adapter=controllers.get(address)
+        )
+        return process
+
+    results: dict[str, CommandResult] = {}
+    workers = max(1, min(max_workers, len(addresses)))
+    if workers == 1:
+        for address in addresses:
+            results[address] = run(address)
+            if on_result is not None:
+                on_result(address, results[address])
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run, address): address
+                       for address in addresses}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if on_result is not None:
+                    on_result(futures[future], results[futures[future]])
+    return {address: results[address] for address in addresses}
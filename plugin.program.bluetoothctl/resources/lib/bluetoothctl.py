@@ -1,155 +1,1214 @@
 from __future__ import annotations
-from typing import Any
+from collections.abc import Generator, Iterable
+from contextlib import ExitStack, closing, contextmanager
+from typing import Any, Callable, NamedTuple, Optional
+import queue
+import re
+import shlex
 import subprocess
-from subprocess import CompletedProcess
+import threading
+import time
+from .cache import DeviceCache
+from .coordination import Coordinator
+from .history import DeviceHistory
+from .parser import (
+    Adapter, DeviceIndex, DeviceInfo, parse_adapters, parse_devices,
+    parse_info
+)
+from .result import CommandResult, PipelineResult, RetryPolicy, wait
+from .session import BluetoothctlSession
+from .timing import Recorder, Span
 
+# Terminal colour sequences
+_ANSI = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+# Discovery output, for example
+# [NEW] Device AA:BB:CC:DD:EE:FF JBL Flip
+# [CHG] Device AA:BB:CC:DD:EE:FF RSSI: -62
+_DISCOVERY = re.compile(
+    r'\[(NEW|CHG)\] Device ((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}) (.*)'
+)
 
-class Bluetoothctl:
-    """Interact with the 'bluetoothctl' utility."""
+# Commands whose successful results may be cached
+_CACHED = {'devices', 'paired-devices', 'info', 'list'}
+# Commands which change device state, invalidating all cached results
+_MUTATING = {'pair', 'remove', 'trust', 'untrust', 'connect', 'disconnect'}
+# Commands which do not run on a controller
+_UNSELECTED = {'list'}
+# Cached results made stale by discovery
+_DISCOVERED = ('devices', 'info')
+# Every command the backends run, which are all the service runs for
+# plugin invocations
+COMMANDS = frozenset({*_CACHED, *_MUTATING, 'scan'})
+
+# Steps of setting up a new device, in order
+SETUP_STEPS = ('pair', 'trust', 'connect')
+# Output of pairing with a device which is paired already
+_ALREADY_PAIRED = 'org.bluez.Error.AlreadyExists'
+
+# Service UUIDs of audio devices, to discover only them: audio sink (A2DP),
+# headset, hands-free and published audio capabilities (LE Audio)
+AUDIO_UUIDS = (
+    '0000110b-0000-1000-8000-00805f9b34fb',
+    '00001108-0000-1000-8000-00805f9b34fb',
+    '0000111e-0000-1000-8000-00805f9b34fb',
+    '00001850-0000-1000-8000-00805f9b34fb',
+)
+
+
+class DiscoveredDevice(NamedTuple):
+    """A device reported during discovery."""
+    address: str
+    name: Optional[str] = None
+    rssi: Optional[int] = None
+    device_class: Optional[int] = None
+    icon: Optional[str] = None
+    # Address of the controller which reported the device, when scanning
+    # with a particular one
+    adapter: Optional[str] = None
+
+
+class DiscoveryFilter(NamedTuple):
+    """
+    Which devices a scan reports, as set by bluetoothctl's `menu scan`
+    commands. Devices are filtered by BlueZ and the controller, so those
+    left out are never reported or remembered.
+    """
+    # 'auto', 'bredr' (classic only) or 'le' (low energy only)
+    transport: str = 'auto'
+    # Only devices with at least this RSSI (in dBm)
+    rssi: Optional[int] = None
+    # Only devices advertising any of these service UUIDs
+    uuids: tuple[str, ...] = ()
+    # Only devices whose address or name starts with this
+    pattern: str = ''
+    # Whether to report repeated advertisements with unchanged data
+    duplicate_data: bool = True
+
+    @property
+    def empty(self) -> bool:
+        """Return whether the filter lets every device through"""
+        return self == DiscoveryFilter()
+
+    def arguments(self) -> list[str]:
+        """
+        Return the filter as arguments to 'scan on', for example
+        ['transport=le', 'rssi=-70'], as read by from_arguments.
+        """
+        arguments = []
+        if self.transport != 'auto':
+            arguments.append(f'transport={self.transport}')
+        if self.rssi is not None:
+            arguments.append(f'rssi={self.rssi}')
+        if self.uuids:
+            arguments.append(f'uuids={",".join(self.uuids)}')
+        if self.pattern:
+            arguments.append(f'pattern={self.pattern}')
+        if not self.duplicate_data:
+            arguments.append('duplicate-data=off')
+        return arguments
+
+    @classmethod
+    def from_arguments(cls, arguments: Iterable[str]) -> DiscoveryFilter:
+        """
+        Construct a DiscoveryFilter from the arguments to 'scan on' made by
+        arguments. Unknown arguments are ignored.
+        """
+        fields: dict[str, Any] = {}
+        for argument in arguments:
+            key, _, value = argument.partition('=')
+            if key == 'transport':
+                fields['transport'] = value
+            elif key == 'rssi':
+                fields['rssi'] = int(value)
+            elif key == 'uuids':
+                fields['uuids'] = tuple(value.split(','))
+            elif key == 'pattern':
+                fields['pattern'] = value
+            elif key == 'duplicate-data':
+                fields['duplicate_data'] = value != 'off'
+        return cls(**fields)
+
+    def script(self) -> list[str]:
+        """
+        Return the interactive bluetoothctl commands which set the filter,
+        starting and ending in the main menu.
+        """
+        script = ['menu scan', f'transport {self.transport}']
+        if self.rssi is not None:
+            script.append(f'rssi {self.rssi}')
+        if self.uuids:
+            script.append(f'uuids {" ".join(self.uuids)}')
+        if self.pattern:
+            script.append(f'pattern {shlex.quote(self.pattern)}')
+        script.append(
+            f'duplicate-data {"on" if self.duplicate_data else "off"}'
+        )
+        script.append('back')
+        return script
 
-    # Default arguments to pass to subprocess.run
-    _run_args: dict[str, Any] = {
-        'capture_output': True,
-        'encoding': 'utf8',
-    }
+
+class BluetoothctlBase:
+    """
+    What the synchronous and asynchronous backends share: their settings, and
+    the policy deciding which controller commands run on, the keys their
+    results are cached and shared under, which cached results they use and
+    make stale, how long they may run and how they are recorded.
+    """
 
     def __init__(self, executable: str = '/usr/bin/bluetoothctl',
-                 scan_timeout: int = 5) -> None:
+                 scan_timeout: int = 5,
+                 cache: Optional[DeviceCache] = None,
+                 timeouts: Optional[dict[str, float]] = None,
+                 retry: RetryPolicy = RetryPolicy(),
+                 discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+                 adapter: Optional[str] = None) -> None:
         """
-        Construct a Bluetoothctl instance.
+        Construct a BluetoothctlBase instance.
 
         executable: Path to the bluetoothctl executable on the host.
         scan_timeout: Time (in seconds) to spend scanning for available
             devices.
+        cache: Cache for device lists and information. Entries are
+            invalidated when a command changes device state.
+        timeouts: Dictionary of command: time (in seconds) after which the
+            command is stopped, for example {'pair': 30}. The entry 'default'
+            applies to commands without their own. Commands without a timeout
+            may run indefinitely.
+        retry: Policy for repeating commands which fail transiently.
+        discovery_filter: Which devices scans report, unless a scan is given
+            its own filter.
+        adapter: Address of the controller commands run on, unless a
+            command is given its own. By default the default controller.
         """
         self._executable = executable
         self.scan_timeout = scan_timeout
+        self.cache = cache
+        self.timeouts = timeouts if timeouts is not None else {}
+        self.retry = retry
+        self.discovery_filter = discovery_filter
+        self.adapter = adapter
+        # Records the timing of each command, when set
+        self.recorder: Optional[Recorder] = None
+        # Coordinates commands with other processes, when set
+        self.coordinator: Optional[Coordinator] = None
+        # Records the outcome of commands on devices and when devices were
+        # seen, and may fit timeouts to each device, when set
+        self.history: Optional[DeviceHistory] = None
 
     @property
     def executable(self) -> str:
         """Return the path to the bluetoothctl executable"""
         return self._executable
 
-    def scan(self) -> CompletedProcess[str]:
+    def command_timeout(self, command: list[str]) -> Optional[float]:
         """
-        Scan for available devices.
+        Return the time (in seconds) after which a command is stopped, or
+        None if it may run indefinitely.
 
-        Returns: A CompletedProcess instance containing the result of the
-            command.
+        command: bluetoothctl command and its arguments.
         """
-        command = [self.executable, '--timeout', str(self.scan_timeout),
-                   'scan', 'on']
-        return subprocess.run(command, **self._run_args)
+        timeout = self.timeouts.get(command[0], self.timeouts.get('default'))
+        if self.history is not None:
+            return self.history.timeout(command, timeout or None)
+        return timeout if timeout else None
 
-    def get_devices(self) -> CompletedProcess[Any]:
+    def command_adapter(self, command: list[str],
+                        adapter: Optional[str] = None) -> Optional[str]:
         """
-        List available devices.
+        Return the controller a command runs on: none for commands which do
+        not run on one, otherwise the one given or by default adapter.
+        """
+        if command[0] in _UNSELECTED:
+            return None
+        return adapter or self.adapter
+
+    @staticmethod
+    def command_key(command: list[str], adapter: Optional[str] = None) -> str:
+        """
+        Return the key under which a command's result is cached and shared,
+        the command line followed by the controller it ran on, if given.
+        """
+        key = ' '.join(command)
+        return key if adapter is None else f'{key} @{adapter}'
+
+    def cached_result(
+        self, command: list[str], adapter: Optional[str] = None
+    ) -> Optional[CommandResult]:
+        """
+        Return the cached result of a query, or None if there is none or the
+        command is not a query. Results which a scan may change are removed
+        before it runs.
+
+        command: bluetoothctl command and its arguments.
+        adapter: Address of the controller the command runs on.
+        """
+        if self.cache is None:
+            return None
+        if command[0] in _CACHED:
+            cached = self.cache.get(self.command_key(command, adapter))
+            return None if cached is None else CommandResult(**cached)
+        if command[0] == 'scan':
+            self.invalidate_discovered()
+        return None
+
+    def cache_result(self, command: list[str], adapter: Optional[str],
+                     process: CommandResult) -> None:
+        """
+        Cache the result of a query which succeeded, or remove the cached
+        results which a command that succeeded may have changed.
+
+        command: bluetoothctl command and its arguments.
+        adapter: Address of the controller the command ran on.
+        process: Result of the command.
+        """
+        if self.cache is None or process.returncode != 0:
+            return
+        if command[0] in _CACHED:
+            self.cache.set(self.command_key(command, adapter), {
+                'args': process.args,
+                'returncode': process.returncode,
+                'stdout': process.stdout,
+                'stderr': process.stderr,
+            })
+        else:
+            self.invalidate_changed(command)
+
+    def invalidate_discovered(self) -> None:
+        """Remove cached results which discovery may change."""
+        if self.cache is not None:
+            for prefix in _DISCOVERED:
+                self.cache.invalidate(prefix)
+
+    def invalidate_changed(self, command: list[str]) -> None:
+        """
+        Remove cached results which a command may have changed, all of them
+        after a command changing a device.
+
+        command: bluetoothctl command and its arguments, which succeeded.
+        """
+        if self.cache is not None and command[0] in _MUTATING:
+            self.cache.invalidate()
+
+    @contextmanager
+    def _span(self, name: str, command: str) -> Generator[Span, None, None]:
+        """Time the enclosed block if a recorder is set."""
+        if self.recorder is None:
+            yield Span(name, command)
+            return
+        with self.recorder.span(name, command) as span:
+            yield span
+
+    @staticmethod
+    def _record_span(span: Span, process: CommandResult) -> None:
+        """Record the outcome of a command in its span."""
+        span.returncode = process.returncode
+        span.output_size = (len(process.stdout or '')
+                            + len(process.stderr or ''))
+        if process.retries:
+            span.retries = process.retries
+        if process.timed_out:
+            span.timed_out = True
+        if process.cancelled:
+            span.cancelled = True
+
+    def _record_run(self, command: list[str], started: float,
+                    process: CommandResult) -> None:
+        """
+        Record the outcome of an attempt at a command, started at a time
+        from time.monotonic, in the history, if set.
+        """
+        if self.history is not None:
+            self.history.record(command, time.monotonic() - started, process)
+
+    def _cancelled(self, command: list[str]) -> CommandResult:
+        """Return the result of a command cancelled before it ran."""
+        return CommandResult([self.executable, *command], 1, '',
+                             'cancelled\n', cancelled=True)
+
+    @staticmethod
+    def _is_query(command: list[str]) -> bool:
+        """
+        Return whether a command only reads state, so that its result may be
+        cached and shared with identical commands.
+        """
+        return command[0] in _CACHED
+
+    @staticmethod
+    def _lock_name(command: list[str], adapter: Optional[str] = None) -> str:
+        """
+        Return the name of the lock to hold while running a command which is
+        not a query.
+        """
+        if command[0] == 'scan':
+            # Scans compete for the adapter's discovery state, controllers
+            # discover independently
+            return 'scan' if adapter is None else f'scan {adapter}'
+        # Commands changing a device, or anything else, by their target
+        return ' '.join(['device', *command[1:2]])
+
+    @staticmethod
+    def _setup_failed(step: str, process: CommandResult) -> bool:
+        """
+        Return whether a setup step failed, stopping the setup. Pairing a
+        device which is paired already does not.
+        """
+        return process.returncode != 0 and not (
+            step == 'pair'
+            and _ALREADY_PAIRED in f'{process.stdout}{process.stderr}'
+        )
+
+    @staticmethod
+    def _scan_filter(command: list[str],
+                     adapter: Optional[str] = None
+                     ) -> Optional[DiscoveryFilter]:
+        """
+        Return the discovery filter of a 'scan on' command which runs
+        interactively, because it is filtered or on a particular controller,
+        or None for any other command.
+        """
+        if command[:2] != ['scan', 'on'] or (len(command) == 2
+                                             and adapter is None):
+            return None
+        return DiscoveryFilter.from_arguments(command[2:])
+
+    @staticmethod
+    def _scan_script(discovery_filter: DiscoveryFilter,
+                     adapter: Optional[str] = None) -> list[str]:
+        """
+        Return the interactive bluetoothctl commands which prepare a scan,
+        selecting the controller and setting the filter, if given.
+        """
+        script = [] if adapter is None else [f'select {adapter}']
+        if not discovery_filter.empty:
+            script += discovery_filter.script()
+        return script
+
+    @staticmethod
+    def _parse_discovery(
+        line: str, devices: dict[str, DiscoveredDevice]
+    ) -> Optional[DiscoveredDevice]:
+        """
+        Parse a line of discovery output into the updated device state.
+
+        line: Line of 'scan on' output.
+        devices: Last known state of each device.
+        """
+        match = _DISCOVERY.search(_ANSI.sub('', line))
+        if match is None:
+            return None
+        event, address, rest = match.groups()
+        address = address.upper()
+        device = devices.get(address, DiscoveredDevice(address))
+
+        if event == 'NEW':
+            return device._replace(name=rest.strip())
+
+        key, _, value = rest.partition(': ')
+        if key == 'RSSI':
+            # Newer versions print 'RSSI: 0xffffffc2 (-62)'
+            value = value.rsplit('(', 1)[-1].rstrip(')')
+            try:
+                return device._replace(rssi=int(value))
+            except ValueError:
+                return None
+        if key in ('Name', 'Alias'):
+            return device._replace(name=value.strip())
+        if key == 'Class':
+            try:
+                return device._replace(device_class=int(value.split()[0], 0))
+            except (ValueError, IndexError):
+                return None
+        if key == 'Icon':
+            return device._replace(icon=value.strip())
+        return None
+
+    @staticmethod
+    def _merge_discovered(
+        reports: Iterable[DiscoveredDevice]
+    ) -> DiscoveredDevice:
+        """
+        Merge the reports of a device from several controllers, keeping the
+        strongest signal and the controller receiving it. Properties missing
+        from the strongest report are taken from the others.
+        """
+        ranked = sorted(reports, key=lambda report: (report.rssi is None,
+                                                     -(report.rssi or 0)))
+        best = ranked[0]
+        return best._replace(
+            name=next((report.name for report in ranked
+                       if report.name is not None), None),
+            device_class=next((report.device_class for report in ranked
+                               if report.device_class is not None), None),
+            icon=next((report.icon for report in ranked
+                       if report.icon is not None), None),
+        )
+
+    @staticmethod
+    def parse_adapters(stdout: str) -> list[Adapter]:
+        """
+        Identify controllers from bluetoothctl `list` output.
+
+        Returns: List of Adapter, in the order listed.
+        """
+        return parse_adapters(stdout)
+
+    @staticmethod
+    def parse_devices(stdout: str) -> DeviceIndex:
+        """
+        Identify devices from bluetoothctl `devices` or `paired-devices`
+        output.
+
+        Returns: DeviceIndex of the devices, keyed by address.
+        """
+        return parse_devices(stdout)
+
+    @staticmethod
+    def parse_info(stdout: str) -> DeviceInfo:
+        """
+        Identify device properties from bluetoothctl `info` output.
+
+        Returns: DeviceInfo of the device.
+        """
+        return parse_info(stdout)
+
+
+class Bluetoothctl(BluetoothctlBase):
+    """Interact with the 'bluetoothctl' utility."""
+
+    # Default arguments to pass to subprocess.Popen
+    _run_args: dict[str, Any] = {
+        'stdout': subprocess.PIPE,
+        'stderr': subprocess.PIPE,
+        'encoding': 'utf8',
+        'errors': 'replace',
+    }
+
+    def __init__(self, executable: str = '/usr/bin/bluetoothctl',
+                 scan_timeout: int = 5,
+                 cache: Optional[DeviceCache] = None,
+                 timeouts: Optional[dict[str, float]] = None,
+                 retry: RetryPolicy = RetryPolicy(),
+                 discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+                 adapter: Optional[str] = None) -> None:
+        """
+        Construct a Bluetoothctl instance.
+
+        executable: Path to the bluetoothctl executable on the host.
+        scan_timeout: Time (in seconds) to spend scanning for available
+            devices.
+        cache: Cache for device lists and information. Entries are
+            invalidated when a command changes device state.
+        timeouts: Dictionary of command: time (in seconds) after which the
+            command is stopped, for example {'pair': 30}. The entry 'default'
+            applies to commands without their own. Commands without a timeout
+            may run indefinitely.
+        retry: Policy for repeating commands which fail transiently.
+        discovery_filter: Which devices scans report, unless a scan is given
+            its own filter.
+        adapter: Address of the controller commands run on, unless a
+            command is given its own. By default the default controller.
+        """
+        super().__init__(executable=executable, scan_timeout=scan_timeout,
+                         cache=cache, timeouts=timeouts, retry=retry,
+                         discovery_filter=discovery_filter, adapter=adapter)
+        # Stops commands early when it returns True, when set, for example
+        # when the user cancels a dialog
+        self.cancel: Optional[Callable[[], bool]] = None
+
+        self._session: Optional[BluetoothctlSession] = None
+
+    @contextmanager
+    def session(self) -> Generator[Bluetoothctl, None, None]:
+        """
+        Run commands in a single, persistent bluetoothctl process.
+
+        Inside the context all commands are sent to one interactive
+        bluetoothctl process rather than each starting their own. The process
+        is started on the first command and stopped on leaving the context.
+        """
+        if self._session is not None:
+            # Already in a session, reuse it
+            yield self
+            return
+
+        self._session = BluetoothctlSession(self.executable)
+        try:
+            yield self
+        finally:
+            self._session.close()
+            self._session = None
+
+    def _run(self, command: list[str], duration: Optional[float] = None,
+             adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, timing it and using the cache.
 
-        Returns: A CompletedProcess instance containing the result of the
+        command: bluetoothctl command and its arguments.
+        duration: Time (in seconds) to let the command run for, for commands
+            which do not finish on their own such as 'scan on'.
+        adapter: Address of the controller to run the command on, by default
+            adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'devices']
+        adapter = self.command_adapter(command, adapter)
+        with self._span('command', self.command_key(command, adapter)) as span:
+            process = self._run_cached(command, duration, adapter)
+            self._record_span(span, process)
+        return process
 
-        process = subprocess.run(command, **self._run_args)
+    def _run_cached(self, command: list[str],
+                    duration: Optional[float] = None,
+                    adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, using and maintaining the cache.
+        """
+        cached = self.cached_result(command, adapter)
+        if cached is not None:
+            return cached
+        process = self._coordinated(command, duration, adapter)
+        self.cache_result(command, adapter, process)
         return process
 
-    def get_paired_devices(self) -> CompletedProcess[Any]:
+    def _coordinated(self, command: list[str],
+                     duration: Optional[float] = None,
+                     adapter: Optional[str] = None) -> CommandResult:
         """
-        List paired devices
+        Run a bluetoothctl command, coordinating with other processes if a
+        coordinator is set.
+
+        Queries already in flight elsewhere are not repeated, their result is
+        shared. Scans, and commands changing the same device, take turns.
+        """
+        if self.coordinator is None:
+            return self._attempt(command, duration, adapter)
+
+        if self._is_query(command):
+            process = self.coordinator.single_flight(
+                self.command_key(command, adapter),
+                lambda: self._attempt(command, duration, adapter),
+                self.cancel
+            )
+            if process is not None:
+                return process
+        else:
+            with self.coordinator.exclusive(self._lock_name(command, adapter),
+                                            self.cancel) as acquired:
+                if acquired:
+                    return self._attempt(command, duration, adapter)
+
+        return self._cancelled(command)
+
+    def _attempt(self, command: list[str], duration: Optional[float] = None,
+                 adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, repeating it with increasing delays while
+        it fails transiently, as set by the retry policy.
+        """
+        attempts = 0
+        while True:
+            started = time.monotonic()
+            process = self._execute(command, duration, adapter=adapter)
+            self._record_run(command, started, process)
+            attempts += process.attempts
+            process.attempts = attempts
+            if not self.retry.should_retry(process, attempts):
+                return process
+            if wait(self.retry.delay(attempts), self.cancel):
+                process.cancelled = True
+                return process
+
+    def _execute(self, command: list[str], duration: Optional[float] = None,
+                 poll: float = 0.1,
+                 adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a bluetoothctl command, in the session if one is open.
+
+        The command is killed if it outlasts its timeout, which for commands
+        with a duration starts once the duration has passed, or if it is
+        cancelled.
 
-        Returns: A CompletedProcess instance containing the result of the
+        command: bluetoothctl command and its arguments.
+        duration: Time (in seconds) to let the command run for, for commands
+            which do not finish on their own such as 'scan on'.
+        poll: Interval (in seconds) at which to check for cancellation.
+        adapter: Address of the controller to run the command on, by default
+            the default controller.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'paired-devices']
+        timeout = self.command_timeout(command)
+        discovery_filter = self._scan_filter(command, adapter)
+        # Whether a filtered scan was cancelled before its duration passed
+        stopped_early = False
+        if discovery_filter is not None:
+            # A filter only lasts as long as the process which set it, so
+            # filtered scans never share the session
+            process = self._start_scan(discovery_filter, duration, adapter,
+                                       **self._run_args)
+            args = [self.executable, *command]
+            stopped_early = wait(duration or 0, self.cancel)
+            self._stop_scan(process)
+        elif self._session is not None:
+            return self._session.run(command, duration=duration,
+                                     timeout=timeout, cancel=self.cancel,
+                                     adapter=adapter)
+        elif adapter is not None:
+            # bluetoothctl only selects a controller interactively
+            with BluetoothctlSession(self.executable) as session:
+                return session.run(command, duration=duration,
+                                   timeout=timeout, cancel=self.cancel,
+                                   adapter=adapter)
+        else:
+            args = [self.executable]
+            if duration is not None:
+                args += ['--timeout', str(int(duration))]
+                if timeout is not None:
+                    timeout += duration
+            args += command
+            process = subprocess.Popen(args, **self._run_args)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # Wake periodically to check for cancellation
+            wait_for = None if self.cancel is None else poll
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+                wait_for = (remaining if wait_for is None
+                            else min(wait_for, remaining))
+            try:
+                stdout, stderr = process.communicate(timeout=wait_for)
+                if stopped_early:
+                    # The scan exits normally once stopped, but only found
+                    # some of the devices
+                    return CommandResult(args, 1, stdout,
+                                         f'{stderr}cancelled\n',
+                                         cancelled=True)
+                return CommandResult(args, process.returncode, stdout, stderr)
+            except subprocess.TimeoutExpired:
+                pass
 
-        process = subprocess.run(command, **self._run_args)
+            cancelled = self.cancel is not None and self.cancel()
+            if cancelled or (deadline is not None
+                             and time.monotonic() >= deadline):
+                process.kill()
+                stdout, stderr = process.communicate()
+                return CommandResult(
+                    args, process.returncode, stdout,
+                    f'{stderr}{"cancelled" if cancelled else "timed out"}\n',
+                    timed_out=not cancelled, cancelled=cancelled
+                )
+
+    def _start_scan(self, discovery_filter: DiscoveryFilter,
+                    duration: Optional[float] = None,
+                    adapter: Optional[str] = None,
+                    **kwargs: Any) -> subprocess.Popen[str]:
+        """
+        Start a bluetoothctl process scanning for available devices.
+
+        Unfiltered scans on the default controller stop by themselves after
+        the duration. Other scans run interactively, with their commands and
+        'scan on' written to the process' input, and must be stopped with
+        _stop_scan.
+
+        discovery_filter: Which devices the scan reports.
+        duration: Time (in seconds) to scan for, by default scan_timeout.
+        adapter: Address of the controller to scan with, by default the
+            default controller.
+        kwargs: Arguments to pass to subprocess.Popen.
+        """
+        if duration is None:
+            duration = self.scan_timeout
+        if discovery_filter.empty and adapter is None:
+            return subprocess.Popen(
+                [self.executable, '--timeout', str(int(duration)),
+                 'scan', 'on'],
+                **kwargs
+            )
+
+        process = subprocess.Popen([self.executable],
+                                   stdin=subprocess.PIPE, **kwargs)
+        self._send(process, [*self._scan_script(discovery_filter, adapter),
+                             'scan on'])
         return process
 
+    def _stop_scan(self, process: subprocess.Popen[str]) -> None:
+        """
+        Stop an interactive scan started by _start_scan, and its process.
+        """
+        self._send(process, ['scan off', 'quit'])
+
+    @staticmethod
+    def _send(process: subprocess.Popen[str], lines: list[str]) -> None:
+        """Write commands to an interactive bluetoothctl process."""
+        if process.stdin is None:
+            return
+        try:
+            process.stdin.write(''.join(f'{line}\n' for line in lines))
+            process.stdin.flush()
+        except OSError:
+            pass
+
+    def scan(self, discovery_filter: Optional[DiscoveryFilter] = None,
+             adapter: Optional[str] = None) -> CommandResult:
+        """
+        Scan for available devices.
+
+        discovery_filter: Which devices the scan reports, by default
+            discovery_filter.
+        adapter: Address of the controller to scan with, by default
+            adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        if discovery_filter is None:
+            discovery_filter = self.discovery_filter
+        return self._run(['scan', 'on', *discovery_filter.arguments()],
+                         duration=self.scan_timeout, adapter=adapter)
+
+    def discover(
+        self,
+        until: Optional[Callable[[DiscoveredDevice], bool]] = None,
+        idle: Optional[float] = None,
+        cancel: Optional[Callable[[], bool]] = None,
+        discovery_filter: Optional[DiscoveryFilter] = None,
+        adapter: Optional[str] = None,
+    ) -> Generator[DiscoveredDevice, None, None]:
+        """
+        Scan for available devices, yielding them as they are found.
+
+        The scan lasts at most scan_timeout seconds but stops as soon as any
+        of the stop conditions is met, or the generator is closed.
+
+        until: Stop after yielding a device for which this returns True, for
+            example when a particular address appears.
+        idle: Stop when no new device has been found for this long (in
+            seconds).
+        cancel: Stop when this returns True, for example when the user
+            cancels a dialog.
+        discovery_filter: Which devices the scan reports, by default
+            discovery_filter.
+        adapter: Address of the controller to scan with, by default
+            adapter. Devices are reported with it.
+
+        Yields: A DiscoveredDevice for each new device and each change to a
+            device's name or RSSI.
+        """
+        if discovery_filter is None:
+            discovery_filter = self.discovery_filter
+        adapter = adapter or self.adapter
+        self.invalidate_discovered()
+
+        with ExitStack() as stack:
+            if self.coordinator is not None:
+                # Wait for any other scan to finish rather than race it
+                acquired = stack.enter_context(self.coordinator.exclusive(
+                    self._lock_name(['scan'], adapter),
+                    cancel if cancel is not None else self.cancel
+                ))
+                if not acquired:
+                    return
+            yield from self._recorded(self._discover(
+                until, idle, cancel, discovery_filter, adapter
+            ))
+
+    def _recorded(
+        self, devices: Iterable[DiscoveredDevice]
+    ) -> Generator[DiscoveredDevice, None, None]:
+        """
+        Yield discovered devices, recording in the history, if set, when each
+        was last seen once discovery stops.
+        """
+        seen: dict[str, DiscoveredDevice] = {}
+        try:
+            for device in devices:
+                seen[device.address] = device
+                yield device
+        finally:
+            if self.history is not None:
+                self.history.record_seen(seen.values())
+
+    def discover_all(
+        self,
+        adapters: Optional[Iterable[str]] = None,
+        until: Optional[Callable[[DiscoveredDevice], bool]] = None,
+        idle: Optional[float] = None,
+        cancel: Optional[Callable[[], bool]] = None,
+        discovery_filter: Optional[DiscoveryFilter] = None,
+        poll: float = 0.1,
+    ) -> Generator[DiscoveredDevice, None, None]:
+        """
+        Scan for available devices with several controllers at once,
+        yielding them as they are found, see discover.
+
+        Each controller scans in its own thread, so the scan takes as long as
+        a scan with one controller. A device found by several controllers is
+        merged into one, with the strongest signal received and the
+        controller which received it.
+
+        adapters: Addresses of the controllers to scan with, by default every
+            controller listed.
+        poll: Interval (in seconds) at which to check the stop conditions
+            while no device is found.
+
+        Yields: A DiscoveredDevice for each new device and each change to a
+            device's name, best RSSI or the controller receiving it.
+        """
+        if adapters is None:
+            adapters = [adapter.address
+                        for adapter in self.get_adapter_list()]
+        adapters = list(adapters)
+        if len(adapters) <= 1:
+            yield from self.discover(until, idle, cancel, discovery_filter,
+                                     adapters[0] if adapters else None)
+            return
+
+        stop = threading.Event()
+        events: queue.Queue[Optional[DiscoveredDevice]] = queue.Queue()
+
+        def stopped() -> bool:
+            return stop.is_set() or (cancel is not None and cancel())
+
+        def scan(adapter: str) -> None:
+            try:
+                for device in self.discover(cancel=stopped,
+                                            discovery_filter=discovery_filter,
+                                            adapter=adapter):
+                    events.put(device)
+            finally:
+                # Marks the end of this controller's scan
+                events.put(None)
+
+        threads = [threading.Thread(target=scan, args=(adapter,), daemon=True)
+                   for adapter in adapters]
+        for thread in threads:
+            thread.start()
+
+        # Last reported state of each device, by each controller
+        reports: dict[str, dict[Optional[str], DiscoveredDevice]] = {}
+        merged: dict[str, DiscoveredDevice] = {}
+        running = len(threads)
+        last_new = time.monotonic()
+        try:
+            while running:
+                try:
+                    report = events.get(timeout=poll)
+                except queue.Empty:
+                    report = None
+                else:
+                    if report is None:
+                        running -= 1
+
+                if report is not None:
+                    reports.setdefault(report.address, {})[report.adapter] = (
+                        report
+                    )
+                    device = self._merge_discovered(
+                        reports[report.address].values()
+                    )
+                    if device != merged.get(device.address):
+                        if device.address not in merged:
+                            last_new = time.monotonic()
+                        merged[device.address] = device
+                        yield device
+                        if until is not None and until(device):
+                            return
+
+                if cancel is not None and cancel():
+                    return
+                if idle is not None and time.monotonic() - last_new >= idle:
+                    return
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _discover(
+        self,
+        until: Optional[Callable[[DiscoveredDevice], bool]],
+        idle: Optional[float],
+        cancel: Optional[Callable[[], bool]],
+        discovery_filter: DiscoveryFilter,
+        adapter: Optional[str] = None,
+    ) -> Generator[DiscoveredDevice, None, None]:
+        """
+        Scan for available devices, yielding them as they are found, see
+        discover.
+        """
+        seen: dict[str, DiscoveredDevice] = {}
+        last_new = time.monotonic()
+
+        key = self.command_key(['discover'], adapter)
+        with self._span('command', key) as span, \
+                closing(self._discovery(discovery_filter,
+                                        adapter=adapter)) as events:
+            # The number of devices found is recorded as the output size
+            span.output_size = 0
+            for device in events:
+                now = time.monotonic()
+                if device is not None and adapter is not None:
+                    device = device._replace(adapter=adapter)
+
+                if device is not None and device != seen.get(device.address):
+                    if device.address not in seen:
+                        last_new = now
+                    seen[device.address] = device
+                    span.output_size = len(seen)
+                    yield device
+                    if until is not None and until(device):
+                        return
+
+                if cancel is not None and cancel():
+                    return
+                if idle is not None and now - last_new >= idle:
+                    return
+
+    def _discovery(
+        self, discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+        poll: float = 0.1, adapter: Optional[str] = None
+    ) -> Generator[Optional[DiscoveredDevice], None, None]:
+        """
+        Run a scan, yielding devices from its output as it arrives.
+
+        discovery_filter: Which devices the scan reports.
+        poll: Interval (in seconds) at which to yield None while there is no
+            output, so that the caller can check its stop conditions.
+        adapter: Address of the controller to scan with, by default the
+            default controller.
+        """
+        process = self._start_scan(discovery_filter, adapter=adapter,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL,
+                                   encoding='utf8', errors='replace')
+        deadline: Optional[float] = time.monotonic() + self.scan_timeout
+        lines: queue.Queue[Optional[str]] = queue.Queue()
+
+        def read() -> None:
+            assert process.stdout is not None
+            for line in process.stdout:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=read, daemon=True).start()
+
+        # Last known state of each device, changes are merged into this
+        devices: dict[str, DiscoveredDevice] = {}
+        try:
+            while True:
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._stop_scan(process)
+                    deadline = None
+                try:
+                    line = lines.get(timeout=poll)
+                except queue.Empty:
+                    yield None
+                    continue
+                if line is None:
+                    return
+
+                device = self._parse_discovery(line, devices)
+                if device is not None:
+                    devices[device.address] = device
+                yield device
+        finally:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+            if process.stdin is not None:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+    def get_adapters(self) -> CommandResult:
+        """
+        List controllers.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return self._run(['list'])
+
+    def get_adapter_list(self) -> list[Adapter]:
+        """
+        List controllers, none if they can not be listed.
+
+        Returns: List of Adapter, in the order listed.
+        """
+        process = self.get_adapters()
+        if process.returncode != 0:
+            return []
+        return self.parse_adapters(process.stdout)
+
+    def select(self, adapter: Optional[str]) -> bool:
+        """
+        Run later commands on a controller, unless they are given their own,
+        as bluetoothctl's `select` does.
+
+        adapter: Address of the controller, None for the default controller.
+
+        Returns: Whether the controller is available, otherwise the
+            selection is unchanged.
+        """
+        if adapter is not None:
+            adapter = adapter.upper()
+            if all(listed.address != adapter
+                   for listed in self.get_adapter_list()):
+                return False
+        self.adapter = adapter
+        return True
+
+    def get_devices(self, adapter: Optional[str] = None) -> CommandResult:
+        """
+        List available devices.
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return self._run(['devices'], adapter=adapter)
+
+    def get_paired_devices(self,
+                           adapter: Optional[str] = None) -> CommandResult:
+        """
+        List paired devices
+
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        return self._run(['paired-devices'], adapter=adapter)
+
     @staticmethod
     def parse_devices_list(stdout: str) -> dict[str, str]:
         """
         Identify devices from bluetoothctl `devices` or `paired-devices`
         output.
 
+        Devices sharing a name are merged, use parse_devices to keep them
+        apart.
+
         Returns: Dict of friendly_name: device_address.
         """
-        # The stdout of 'bluetoothctl devices' is in the format
-        # Device <device_address> <friendly_name>
-        devices = {
-            item[2]: item[1] for item in
-            (line.split() for line in stdout.splitlines())
-        }
+        return {device.name: device.address
+                for device in parse_devices(stdout)}
 
-        return devices
-
-    def connect(self, address: str) -> CompletedProcess[str]:
+    def connect(self, address: str,
+                adapter: Optional[str] = None) -> CommandResult:
         """
         Connect to a device.
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'connect', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['connect', address], adapter=adapter)
 
-    def disconnect(self, address: str) -> CompletedProcess[str]:
+    def disconnect(self, address: str,
+                   adapter: Optional[str] = None) -> CommandResult:
         """
         Disconnect from a device.
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'disconnect', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['disconnect', address], adapter=adapter)
 
-    def pair(self, address: str) -> CompletedProcess[str]:
+    def pair(self, address: str,
+             adapter: Optional[str] = None) -> CommandResult:
         """
         Pair with a device.
 
         This method only support non-interactive pairing.
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'pair', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['pair', address], adapter=adapter)
 
-    def remove(self, address: str) -> CompletedProcess[str]:
+    def remove(self, address: str,
+               adapter: Optional[str] = None) -> CommandResult:
         """
         Remove device (revoke pairing).
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'remove', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['remove', address], adapter=adapter)
 
-    def trust(self, address: str) -> CompletedProcess[str]:
+    def trust(self, address: str,
+              adapter: Optional[str] = None) -> CommandResult:
         """
         Trust a device.
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'trust', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['trust', address], adapter=adapter)
 
-    def untrust(self, address: str) -> CompletedProcess[str]:
+    def untrust(self, address: str,
+                adapter: Optional[str] = None) -> CommandResult:
         """
         Revoke trust in a device.
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'untrust', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['untrust', address], adapter=adapter)
 
-    def info(self, address: str) -> CompletedProcess[str]:
+    def info(self, address: str,
+             adapter: Optional[str] = None) -> CommandResult:
         """
         Get device information.
 
-        Returns: A CompletedProcess instance containing the result of the
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A CommandResult instance containing the result of the
             command.
         """
-        command = [self.executable, 'info', address]
-        return subprocess.run(command, **self._run_args)
+        return self._run(['info', address], adapter=adapter)
+
+    def setup(self, address: str,
+              on_step: Optional[Callable[[str], None]] = None,
+              adapter: Optional[str] = None) -> PipelineResult:
+        """
+        Pair with, trust and connect to a device, as one operation.
+
+        The steps run in one session, or the one already open, and stop at
+        the first which fails. Pairing a device which is paired already does
+        not stop the setup.
+
+        on_step: Function called with the name of each step, one of
+            SETUP_STEPS, before it runs, for example to show progress.
+        adapter: Address of the controller, by default adapter.
+
+        Returns: A PipelineResult instance containing the results of the
+            steps run.
+        """
+        steps: list[tuple[str, CommandResult]] = []
+        with self.session():
+            for step in SETUP_STEPS:
+                if on_step is not None:
+                    on_step(step)
+                process: CommandResult = getattr(self, step)(address,
+                                                             adapter=adapter)
+                steps.append((step, process))
+                if self._setup_failed(step, process):
+                    break
+        return PipelineResult([self.executable, 'setup', address], steps)
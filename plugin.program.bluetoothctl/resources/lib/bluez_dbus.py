@@ -0,0 +1,494 @@
+from __future__ import annotations
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import time
+from .bluetoothctl import Bluetoothctl, DiscoveredDevice, DiscoveryFilter
+from .cache import DeviceCache
+from .parser import Adapter, Device, DeviceIndex, DeviceInfo, ParsedOutput
+from .result import CommandResult, RetryPolicy, wait
+
+try:
+    import dbus  # type: ignore
+except ImportError:  # pragma: no cover
+    dbus = None
+
+BLUEZ = 'org.bluez'
+ADAPTER = 'org.bluez.Adapter1'
+DEVICE = 'org.bluez.Device1'
+BATTERY = 'org.bluez.Battery1'
+OBJECT_MANAGER = 'org.freedesktop.DBus.ObjectManager'
+PROPERTIES = 'org.freedesktop.DBus.Properties'
+
+# Type of the GetManagedObjects result, path: interface: property: value
+ManagedObjects = Dict[str, Dict[str, Dict[str, Any]]]
+# Type of a function running the D-Bus equivalent of a bluetoothctl command,
+# given its arguments, duration, timeout and controller
+Handler = Callable[
+    ['BluezDBus', List[str], Optional[float], float, Optional[str]],
+    Tuple[int, str]
+]
+# D-Bus errors raised when a method call outlasts its timeout
+_TIMED_OUT = {'org.freedesktop.DBus.Error.NoReply',
+              'org.freedesktop.DBus.Error.Timeout'}
+
+
+class BluezDBusException(Exception):
+    """
+    Exception for BluezDBus class.
+    """
+    pass
+
+
+def _device_call(method: str, message: str) -> Handler:
+    """Create a handler calling a Device1 method on the device."""
+    def handler(self: BluezDBus, args: list[str], duration: Optional[float],
+                timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        path = self._device_path(self._managed_objects(), args[0], adapter)
+        if path is None:
+            return 1, f'Device {args[0]} not available\n'
+        getattr(self._interface(path, DEVICE), method)(timeout=timeout)
+        return 0, f'{message}\n'
+    return handler
+
+
+def _set_trusted(value: bool, message: str) -> Handler:
+    """Create a handler setting the Trusted property of the device."""
+    def handler(self: BluezDBus, args: list[str], duration: Optional[float],
+                timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        path = self._device_path(self._managed_objects(), args[0], adapter)
+        if path is None:
+            return 1, f'Device {args[0]} not available\n'
+        self._interface(path, PROPERTIES).Set(
+            DEVICE, 'Trusted', dbus.Boolean(value), timeout=timeout
+        )
+        return 0, f'Changing {args[0]} {message} succeeded\n'
+    return handler
+
+
+class BluezDBus(Bluetoothctl):
+    """
+    Interact with BlueZ directly over D-Bus.
+
+    Provides the same interface as Bluetoothctl. Results are returned as
+    CommandResult instances with output formatted as bluetoothctl would
+    print it, so they can be used interchangeably. Device lists, device
+    information and controllers are built from the D-Bus properties and
+    carried by the output, so parsing it returns them without parsing the
+    text.
+    """
+
+    def __init__(self, scan_timeout: int = 5, bus: Any = None,
+                 call_timeout: float = 30,
+                 cache: Optional[DeviceCache] = None,
+                 timeouts: Optional[dict[str, float]] = None,
+                 retry: RetryPolicy = RetryPolicy(),
+                 discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+                 adapter: Optional[str] = None) -> None:
+        """
+        Construct a BluezDBus instance.
+
+        scan_timeout: Time (in seconds) to spend scanning for available
+            devices.
+        bus: D-Bus connection to use. By default the system bus. A session bus
+            may be given to test against a mock BlueZ, such as
+            python-dbusmock's bluez5 template.
+        call_timeout: Time (in seconds) to wait for a D-Bus method call to
+            return, for commands without a timeout of their own.
+        cache: Cache for device lists and information.
+        timeouts: Dictionary of command: time (in seconds) to wait for the
+            command's method call to return.
+        retry: Policy for repeating commands which fail transiently.
+        discovery_filter: Which devices scans report, unless a scan is given
+            its own filter.
+        adapter: Address of the controller commands run on, unless a
+            command is given its own. By default the first controller.
+        """
+        if dbus is None:
+            raise BluezDBusException('dbus-python is not installed')
+
+        super().__init__(executable=BLUEZ, scan_timeout=scan_timeout,
+                         cache=cache, timeouts=timeouts, retry=retry,
+                         discovery_filter=discovery_filter, adapter=adapter)
+        self._bus = bus
+        self.call_timeout = call_timeout
+
+    @property
+    def bus(self) -> Any:
+        """Return the D-Bus connection, connecting to the system bus first."""
+        if self._bus is None:
+            self._bus = dbus.SystemBus()
+        return self._bus
+
+    @contextmanager
+    def session(self) -> Generator[Bluetoothctl, None, None]:
+        """
+        D-Bus calls share one connection already, so there is no separate
+        session.
+        """
+        yield self
+
+    def _discovery(
+        self, discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+        poll: float = 0.1, adapter: Optional[str] = None
+    ) -> Generator[Optional[DiscoveredDevice], None, None]:
+        """
+        Run a discovery, yielding devices as BlueZ reports them.
+
+        Like bluetoothctl, a device is yielded when it first appears, which
+        for devices BlueZ already knows is at the start, and again only when
+        it changes, such as when its RSSI is updated.
+
+        discovery_filter: Which devices the discovery reports.
+        poll: Interval (in seconds) at which to yield None, so that the caller
+            can check its stop conditions. BlueZ is polled at most twice a
+            second.
+        adapter: Address of the controller to discover with, by default the
+            first controller.
+        """
+        path = self._adapter_path(self._managed_objects(), adapter)
+        if path is None:
+            return
+
+        controller = self._interface(path, ADAPTER)
+        self._set_discovery_filter(controller, discovery_filter)
+        controller.StartDiscovery(timeout=self.call_timeout)
+        deadline = time.monotonic() + self.scan_timeout
+        # Last yielded state of each device
+        reported: dict[str, DiscoveredDevice] = {}
+        try:
+            while time.monotonic() < deadline:
+                for device_path, interfaces in self._managed_objects().items():
+                    properties = interfaces.get(DEVICE)
+                    # Only devices known to the discovering controller
+                    if properties is None or not str(device_path).startswith(
+                        f'{path}/'
+                    ):
+                        continue
+                    device = self._discovered_device(properties)
+                    if reported.get(device.address) != device:
+                        reported[device.address] = device
+                        yield device
+                yield None
+                time.sleep(max(poll, 0.5))
+        finally:
+            controller.StopDiscovery(timeout=self.call_timeout)
+
+    @staticmethod
+    def _discovered_device(properties: dict[str, Any]) -> DiscoveredDevice:
+        """Return a device as reported by a discovery from its properties."""
+        rssi = properties.get('RSSI')
+        device_class = properties.get('Class')
+        icon = properties.get('Icon')
+        return DiscoveredDevice(
+            str(properties['Address']),
+            str(properties.get('Alias', properties['Address'])),
+            None if rssi is None else int(rssi),
+            None if device_class is None else int(device_class),
+            None if icon is None else str(icon),
+        )
+
+    def _execute(self, command: list[str], duration: Optional[float] = None,
+                 poll: float = 0.1,
+                 adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run the D-Bus equivalent of a bluetoothctl command.
+
+        Method calls can not be interrupted, so cancellation only shortens
+        the duration of commands such as 'scan on'.
+
+        command: bluetoothctl command and its arguments.
+        duration: Time (in seconds) to let the command run for, for commands
+            which do not finish on their own such as 'scan on'.
+        poll: Interval (in seconds) at which to check for cancellation.
+        adapter: Address of the controller to run the command on, by default
+            the first controller.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        handler = self._handlers.get(command[0])
+        if handler is None:
+            return self._result(command, 1, '', 'Invalid command\n')
+
+        timeout = self.command_timeout(command) or self.call_timeout
+        try:
+            returncode, stdout = handler(self, command[1:], duration, timeout,
+                                         adapter)
+        except dbus.exceptions.DBusException as exc:
+            name = exc.get_dbus_name()
+            result = self._result(command, 1, '',
+                                  f'Failed to {command[0]}: {name}\n')
+            result.timed_out = name in _TIMED_OUT
+            return result
+
+        return self._result(command, returncode, stdout, '')
+
+    def _result(self, command: list[str], returncode: int, stdout: str,
+                stderr: str) -> CommandResult:
+        return CommandResult([self.executable, *command], returncode, stdout,
+                             stderr)
+
+    def _managed_objects(self) -> ManagedObjects:
+        """
+        Fetch every BlueZ object and its properties in a single call.
+        """
+        manager = dbus.Interface(self.bus.get_object(BLUEZ, '/'),
+                                 OBJECT_MANAGER)
+        objects: ManagedObjects = manager.GetManagedObjects(
+            timeout=self.call_timeout
+        )
+        return objects
+
+    def _interface(self, path: str, interface: str) -> Any:
+        return dbus.Interface(self.bus.get_object(BLUEZ, path), interface)
+
+    @staticmethod
+    def _adapter_path(objects: ManagedObjects,
+                      adapter: Optional[str] = None) -> Optional[str]:
+        """
+        Return the path of the controller with an address, by default the
+        first controller, as bluetoothctl makes it the default.
+        """
+        for path, interfaces in objects.items():
+            properties = interfaces.get(ADAPTER)
+            if properties is not None and (
+                adapter is None
+                or str(properties.get('Address', '')) == adapter.upper()
+            ):
+                return str(path)
+        return None
+
+    @staticmethod
+    def _no_adapter(adapter: Optional[str]) -> str:
+        """Return bluetoothctl's output when a controller is missing."""
+        if adapter is None:
+            return 'No default controller available\n'
+        return f'Controller {adapter} not available\n'
+
+    @staticmethod
+    def _device_path(objects: ManagedObjects, address: str,
+                     adapter: Optional[str] = None) -> Optional[str]:
+        """
+        Return the path of the device with an address, known to a
+        controller if given.
+        """
+        prefix = '/'
+        if adapter is not None:
+            parent = BluezDBus._adapter_path(objects, adapter)
+            if parent is None:
+                return None
+            prefix = f'{parent}/'
+        address = address.upper()
+        for path, interfaces in objects.items():
+            device = interfaces.get(DEVICE)
+            if (device is not None and str(device['Address']) == address
+                    and str(path).startswith(prefix)):
+                return str(path)
+        return None
+
+    @staticmethod
+    def _format_devices(objects: ManagedObjects, paired: bool,
+                        adapter_path: Optional[str] = None) -> ParsedOutput:
+        """
+        Return the `devices` output listing the devices, known to a
+        controller if given, carrying their DeviceIndex.
+        """
+        index = DeviceIndex()
+        for path, device in objects.items():
+            properties = device.get(DEVICE)
+            if properties is None or (paired
+                                      and not properties.get('Paired')):
+                continue
+            if adapter_path is not None and not str(path).startswith(
+                f'{adapter_path}/'
+            ):
+                continue
+            address = str(properties['Address'])
+            index.add(Device(address, str(
+                properties.get('Alias', properties.get('Name', address))
+            ) or address))
+        return ParsedOutput(''.join(f'Device {device.address} {device.name}\n'
+                                    for device in index), index)
+
+    @staticmethod
+    def _device_info(interfaces: dict[str, dict[str, Any]]) -> DeviceInfo:
+        """Return the properties of a device from its D-Bus objects."""
+        device = interfaces[DEVICE]
+        info = DeviceInfo(str(device['Address']))
+        if 'Name' in device:
+            info.name = str(device['Name'])
+        if 'Alias' in device:
+            info.alias = str(device['Alias'])
+        if 'Class' in device:
+            info.device_class = int(device['Class'])
+        if 'Icon' in device:
+            info.icon = str(device['Icon'])
+        info.paired = bool(device.get('Paired', False))
+        info.trusted = bool(device.get('Trusted', False))
+        info.blocked = bool(device.get('Blocked', False))
+        info.connected = bool(device.get('Connected', False))
+        if 'RSSI' in device:
+            info.rssi = int(device['RSSI'])
+        battery = interfaces.get(BATTERY)
+        if battery is not None and 'Percentage' in battery:
+            info.battery = int(battery['Percentage'])
+        info.uuids = [str(uuid) for uuid in device.get('UUIDs', [])]
+        return info
+
+    @staticmethod
+    def _format_info(interfaces: dict[str, dict[str, Any]]) -> ParsedOutput:
+        """
+        Return the `info` output describing a device, carrying its
+        DeviceInfo.
+        """
+        device = interfaces[DEVICE]
+
+        def yes_no(value: Any) -> str:
+            return 'yes' if value else 'no'
+
+        lines = [f'Device {device["Address"]} '
+                 f'({device.get("AddressType", "public")})']
+        for key in ('Name', 'Alias'):
+            if key in device:
+                lines.append(f'\t{key}: {device[key]}')
+        if 'Class' in device:
+            lines.append(f'\tClass: 0x{int(device["Class"]):08x}')
+        if 'Icon' in device:
+            lines.append(f'\tIcon: {device["Icon"]}')
+        for key in ('Paired', 'Trusted', 'Blocked', 'Connected',
+                    'LegacyPairing'):
+            if key in device:
+                lines.append(f'\t{key}: {yes_no(device[key])}')
+        for uuid in device.get('UUIDs', []):
+            lines.append(f'\tUUID: {uuid}')
+        if 'Modalias' in device:
+            lines.append(f'\tModalias: {device["Modalias"]}')
+        if 'RSSI' in device:
+            lines.append(f'\tRSSI: {int(device["RSSI"])}')
+        battery = interfaces.get(BATTERY)
+        if battery is not None and 'Percentage' in battery:
+            percentage = int(battery['Percentage'])
+            lines.append(
+                f'\tBattery Percentage: 0x{percentage:02x} ({percentage})'
+            )
+        return ParsedOutput(''.join(f'{line}\n' for line in lines),
+                            BluezDBus._device_info(interfaces))
+
+    def _list(self, args: list[str], duration: Optional[float],
+              timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        adapters: list[Adapter] = []
+        for interfaces in self._managed_objects().values():
+            properties = interfaces.get(ADAPTER)
+            if properties is None:
+                continue
+            # bluetoothctl makes the first controller the default
+            adapters.append(Adapter(
+                str(properties.get('Address', '')).upper(),
+                str(properties.get('Alias', properties.get('Name', ''))),
+                default=not adapters
+            ))
+        return 0, ParsedOutput(
+            ''.join(f'Controller {adapter.address} {adapter.name}'
+                    f'{" [default]" if adapter.default else ""}\n'
+                    for adapter in adapters),
+            adapters
+        )
+
+    def _scan(self, args: list[str], duration: Optional[float],
+              timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        objects = self._managed_objects()
+        path = self._adapter_path(objects, adapter)
+        if path is None:
+            return 1, self._no_adapter(adapter)
+
+        controller = self._interface(path, ADAPTER)
+        self._set_discovery_filter(
+            controller, DiscoveryFilter.from_arguments(args[1:])
+        )
+        controller.StartDiscovery(timeout=self.call_timeout)
+        try:
+            wait(self.scan_timeout if duration is None else duration,
+                 self.cancel)
+        finally:
+            controller.StopDiscovery(timeout=self.call_timeout)
+        return 0, 'Discovery started\nDiscovery stopped\n'
+
+    def _set_discovery_filter(self, adapter: Any,
+                              discovery_filter: DiscoveryFilter) -> None:
+        """
+        Set, or clear, this connection's discovery filter. BlueZ keeps a
+        filter per D-Bus client, so one is always set before discovering.
+        """
+        properties: dict[str, Any] = {}
+        if discovery_filter.transport != 'auto':
+            properties['Transport'] = dbus.String(discovery_filter.transport)
+        if discovery_filter.rssi is not None:
+            properties['RSSI'] = dbus.Int16(discovery_filter.rssi)
+        if discovery_filter.uuids:
+            properties['UUIDs'] = dbus.Array(discovery_filter.uuids,
+                                             signature='s')
+        if discovery_filter.pattern:
+            properties['Pattern'] = dbus.String(discovery_filter.pattern)
+        if not discovery_filter.duplicate_data:
+            properties['DuplicateData'] = dbus.Boolean(False)
+        adapter.SetDiscoveryFilter(dbus.Dictionary(properties,
+                                                   signature='sv'),
+                                   timeout=self.call_timeout)
+
+    def _devices(self, args: list[str], duration: Optional[float],
+                 timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        return self._device_list(paired=False, adapter=adapter)
+
+    def _paired_devices(self, args: list[str], duration: Optional[float],
+                        timeout: float,
+                        adapter: Optional[str]) -> tuple[int, str]:
+        return self._device_list(paired=True, adapter=adapter)
+
+    def _device_list(self, paired: bool,
+                     adapter: Optional[str]) -> tuple[int, str]:
+        # Like bluetoothctl, only list the devices known to the controller,
+        # by default the default controller
+        objects = self._managed_objects()
+        path = self._adapter_path(objects, adapter)
+        if path is None:
+            return 1, self._no_adapter(adapter)
+        return 0, self._format_devices(objects, paired, path)
+
+    def _info(self, args: list[str], duration: Optional[float],
+              timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        objects = self._managed_objects()
+        path = self._device_path(objects, args[0], adapter)
+        if path is None:
+            return 1, f'Device {args[0]} not available\n'
+        return 0, self._format_info(objects[path])
+
+    def _remove(self, args: list[str], duration: Optional[float],
+                timeout: float, adapter: Optional[str]) -> tuple[int, str]:
+        objects = self._managed_objects()
+        path = self._device_path(objects, args[0], adapter)
+        if path is None:
+            return 1, f'Device {args[0]} not available\n'
+        # The device is removed from the controller which knows it
+        parent = path.rsplit('/', 1)[0]
+        if parent not in objects or ADAPTER not in objects[parent]:
+            return 1, self._no_adapter(adapter)
+        self._interface(parent, ADAPTER).RemoveDevice(
+            dbus.ObjectPath(path), timeout=timeout
+        )
+        return 0, 'Device has been removed\n'
+
+    # bluetoothctl command: handler
+    _handlers: dict[str, Handler] = {
+        'list': _list,
+        'scan': _scan,
+        'devices': _devices,
+        'paired-devices': _paired_devices,
+        'info': _info,
+        'connect': _device_call('Connect', 'Connection successful'),
+        'disconnect': _device_call('Disconnect', 'Successful disconnected'),
+        'pair': _device_call('Pair', 'Pairing successful'),
+        'remove': _remove,
+        'trust': _set_trusted(True, 'trust'),
+        'untrust': _set_trusted(False, 'untrust'),
+    }
@@ -1,6 +1,9 @@
 from collections.abc import Generator
 from contextlib import contextmanager
+from typing import Optional
+import time
 import xbmc  # type: ignore
+import xbmcgui  # type: ignore
 
 
 @contextmanager
@@ -13,3 +16,61 @@ def busy_dialog() -> Generator[None, None, None]:
         yield
     finally:
         xbmc.executebuiltin('Dialog.Close(busydialognocancel)')
+
+
+class Progress:
+    """
+    A progress dialog box which the user may cancel, see progress_dialog.
+    """
+
+    def __init__(self, dialog: xbmcgui.DialogProgress,
+                 duration: Optional[float] = None) -> None:
+        self._dialog = dialog
+        self._duration = duration
+        self._start = time.monotonic()
+
+    @property
+    def percent(self) -> int:
+        """Return how full the progress bar is, from the time elapsed"""
+        if not self._duration:
+            return 0
+        elapsed = time.monotonic() - self._start
+        return min(100, int(100 * elapsed / self._duration))
+
+    def __call__(self) -> bool:
+        """
+        Return whether the user has cancelled, advancing the progress bar.
+        """
+        if self._duration:
+            self._dialog.update(self.percent)
+        return bool(self._dialog.iscanceled())
+
+    def update(self, message: str) -> None:
+        """
+        Replace the message of the dialog, for example with the current step
+        of an operation.
+        """
+        self._dialog.update(self.percent, message)
+
+
+@contextmanager
+def progress_dialog(
+    heading: str, message: str = '', duration: Optional[float] = None
+) -> Generator[Progress, None, None]:
+    """
+    Display a progress dialog box which the user may cancel.
+
+    heading: Heading of the dialog.
+    message: Message of the dialog.
+    duration: Longest time (in seconds) the operation may take. If given, the
+        progress bar fills over this time.
+
+    Yields: A Progress, which called returns whether the user has cancelled
+        and advances the progress bar. It should be called regularly.
+    """
+    dialog = xbmcgui.DialogProgress()
+    dialog.create(heading, message)
+    try:
+        yield Progress(dialog, duration)
+    finally:
+        dialog.close()
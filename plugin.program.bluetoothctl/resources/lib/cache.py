@@ -0,0 +1,189 @@
+from __future__ import annotations
+from typing import Any, Callable, Optional
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+class DeviceCache:
+    """
+    A small on-disk cache of device state with per-entry expiry.
+
+    Entries are stored as JSON in a single file, which may be shared by
+    several processes, such as concurrent plugin invocations. Every change
+    re-reads the file and applies the change to it while holding a lock on
+    the file, so that processes never undo each other's changes, and the
+    file is re-read whenever another process has changed it. Instances may
+    be shared between threads.
+    """
+
+    def __init__(self, path: Optional[str], ttl: float = 60,
+                 log: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Construct a DeviceCache instance.
+
+        path: Path to the cache file. If None, entries are only held in
+            memory.
+        ttl: Default time (in seconds) for which entries are valid.
+        log: Function to send debug messages to, for example cache hits and
+            misses.
+        """
+        self._path = path
+        self.ttl = ttl
+        self._log = log
+        self._entries: Optional[dict[str, dict[str, Any]]] = None
+        # Identity of the file version the entries were read from
+        self._version: Optional[tuple[int, int, int]] = None
+        self._lock = threading.RLock()
+
+    @property
+    def path(self) -> Optional[str]:
+        """Return the path to the cache file"""
+        return self._path
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Get an entry.
+
+        key: Name of the entry.
+
+        Returns: The cached value, or None if there is no valid entry.
+        """
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None:
+            self._debug(f'cache miss: {key}')
+            return None
+        if entry['expires'] < time.time():
+            self._debug(f'cache expired: {key}')
+            return None
+
+        self._debug(f'cache hit: {key}')
+        return entry['value']
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Add or replace an entry.
+
+        key: Name of the entry.
+        value: JSON serialisable value.
+        ttl: Time (in seconds) for which the entry is valid. By default the
+            cache's ttl.
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+
+        def change(entries: dict[str, dict[str, Any]]) -> bool:
+            entries[key] = {'expires': expires, 'value': value}
+            return True
+        self._update(change)
+
+    def invalidate(self, prefix: str = '') -> None:
+        """
+        Remove entries.
+
+        prefix: Remove only entries whose names start with this. By default
+            all entries are removed.
+        """
+        def change(entries: dict[str, dict[str, Any]]) -> bool:
+            keys = [key for key in entries if key.startswith(prefix)]
+            for key in keys:
+                del entries[key]
+            return bool(keys)
+
+        if self._update(change):
+            self._debug(f'cache invalidated: {prefix or "all"}')
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        """Return the entries, re-reading the file if it has changed."""
+        if self.path is None:
+            if self._entries is None:
+                self._entries = {}
+            return self._entries
+
+        version = self._stat()
+        if self._entries is None or version != self._version:
+            self._entries = self._read()
+            self._version = version
+        return self._entries
+
+    def _update(
+        self, change: Callable[[dict[str, dict[str, Any]]], bool]
+    ) -> bool:
+        """
+        Apply a change to the entries, and to the file, merged with changes
+        made by other processes.
+
+        change: Function changing the entries in place, returning whether it
+            changed anything.
+
+        Returns: Whether the change changed anything.
+        """
+        with self._lock:
+            if self.path is None:
+                return change(self._load())
+
+            try:
+                lock = os.open(f'{self.path}.lock',
+                               os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as exc:
+                self._debug(f'failed to lock cache: {exc}')
+                return change(self._load())
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Start from the file as other processes left it
+                version = self._stat()
+                entries = self._read()
+                changed = change(entries)
+                if changed:
+                    now = time.time()
+                    entries = {key: entry for key, entry in entries.items()
+                               if entry['expires'] >= now}
+                    if self._save(entries):
+                        version = self._stat()
+                self._entries = entries
+                self._version = version
+                return changed
+            finally:
+                os.close(lock)
+
+    def _stat(self) -> Optional[tuple[int, int, int]]:
+        """Return the identity of the file's current version."""
+        if self.path is None:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> dict[str, dict[str, Any]]:
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, encoding='utf8') as cache_file:
+                entries: dict[str, dict[str, Any]] = json.load(cache_file)
+            return entries
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries: dict[str, dict[str, Any]]) -> bool:
+        if self.path is None:
+            return False
+
+        # Write to a temporary file and move it into place so that concurrent
+        # readers never see a partial file
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'w', encoding='utf8') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(temporary, self.path)
+        except OSError as exc:
+            self._debug(f'failed to write cache: {exc}')
+            return False
+        return True
+
+    def _debug(self, message: str) -> None:
+        if self._log is not None:
+            self._log(message)
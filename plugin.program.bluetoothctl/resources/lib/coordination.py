@@ -0,0 +1,228 @@
+from __future__ import annotations
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+import fcntl
+import hashlib
+import json
+import os
+import time
+from .result import CommandResult
+
+# Name of the lock directory in the addon profile directory
+LOCK_DIRECTORY = 'locks'
+
+
+class Coordinator:
+    """
+    Coordinate bluetoothctl commands between processes, such as concurrent
+    plugin invocations and the service, using lock files in a shared
+    directory.
+
+    Identical queries in flight at the same time are run once. The first
+    process to ask runs the query while holding its lock and writes the
+    result to a file, which processes waiting on the lock then read.
+    Conflicting operations, such as two scans, take turns holding a lock.
+
+    Locks are released by the operating system if a process dies, so a
+    crashed invocation never leaves others waiting.
+    """
+
+    def __init__(self, directory: str, wait_timeout: float = 60,
+                 poll: float = 0.05) -> None:
+        """
+        Construct a Coordinator instance.
+
+        directory: Directory for lock and result files, shared by all
+            processes to coordinate. It is created if needed.
+        wait_timeout: Longest time (in seconds) to wait for another process,
+            after which the operation goes ahead regardless.
+        poll: Interval (in seconds) at which to retry taking a lock.
+        """
+        self._directory = directory
+        self.wait_timeout = wait_timeout
+        self.poll = poll
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        """Return the path to the lock directory"""
+        return self._directory
+
+    @contextmanager
+    def exclusive(
+        self, name: str, cancel: Optional[Callable[[], bool]] = None
+    ) -> Generator[bool, None, None]:
+        """
+        Hold a named lock, waiting for any other holder to release it.
+
+        name: Name of the lock, for example 'scan'.
+        cancel: Function returning True to stop waiting.
+
+        Yields: False if waiting was cancelled, in which case the operation
+            should not go ahead, otherwise True.
+        """
+        fd, cancelled = self._lock(self._path(name, '.lock'), cancel)
+        try:
+            yield not cancelled
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def try_hold(self, name: str) -> Optional[int]:
+        """
+        Take a named lock without waiting, to be held by whichever process
+        holds the returned file descriptor, for example a child process
+        inheriting it. The lock is released once every copy is closed.
+
+        name: Name of the lock, for example 'scan'.
+
+        Returns: The locked file descriptor, or None if the lock is held.
+        """
+        return self._try_lock(self._path(name, '.lock'))
+
+    def single_flight(
+        self, key: str, run: Callable[[], CommandResult],
+        cancel: Optional[Callable[[], bool]] = None
+    ) -> Optional[CommandResult]:
+        """
+        Run a query, or share the result of an identical one in flight.
+
+        key: Identifies the query, for example 'info AA:BB:CC:DD:EE:FF'.
+        run: Function running the query.
+        cancel: Function returning True to stop waiting for another process.
+
+        Returns: The query's result, or None if waiting was cancelled.
+        """
+        lock = self._path(key, '.lock')
+        requested = time.time()
+
+        fd = self._try_lock(lock)
+        if fd is None:
+            # Another process is running the query, wait for its result
+            fd, cancelled = self._lock(lock, cancel)
+            if cancelled:
+                return None
+            shared = self._read_result(key, since=requested)
+            if shared is not None:
+                if fd is not None:
+                    os.close(fd)
+                return shared
+
+        try:
+            result = run()
+            # A cancelled result reflects one user's choice, not the query
+            if not result.cancelled:
+                self._write_result(key, result)
+            return result
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _path(self, name: str, suffix: str) -> str:
+        digest = hashlib.sha1(name.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f'{digest}{suffix}')
+
+    @staticmethod
+    def _try_lock(path: str) -> Optional[int]:
+        """
+        Take a lock without waiting.
+
+        Returns: The locked file descriptor, or None if the lock is held.
+        """
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return None
+            # The file may have been pruned before it was locked, in which
+            # case another process may lock its replacement
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)
+
+    def _lock(
+        self, path: str, cancel: Optional[Callable[[], bool]]
+    ) -> tuple[Optional[int], bool]:
+        """
+        Take a lock, waiting at most wait_timeout.
+
+        Returns: The locked file descriptor, or None if waiting was cancelled
+            or timed out, and whether waiting was cancelled.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            fd = self._try_lock(path)
+            if fd is not None:
+                return fd, False
+            if cancel is not None and cancel():
+                return None, True
+            if time.monotonic() >= deadline:
+                return None, False
+            time.sleep(self.poll)
+
+    def _read_result(self, key: str,
+                     since: float) -> Optional[CommandResult]:
+        """
+        Read a shared result, if one finished after a time.
+        """
+        try:
+            with open(self._path(key, '.json'), encoding='utf8') as file:
+                shared: dict[str, Any] = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if shared.get('key') != key or shared.get('finished', 0) < since:
+            return None
+        return CommandResult(**shared['result'])
+
+    def _write_result(self, key: str, result: CommandResult) -> None:
+        """
+        Write a result for waiting processes to share.
+        """
+        path = self._path(key, '.json')
+        # Write to a temporary file and move it into place so that readers
+        # never see a partial file
+        temporary = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'w', encoding='utf8') as file:
+                json.dump({'key': key, 'finished': time.time(),
+                           'result': result.as_dict()}, file)
+            os.replace(temporary, path)
+        except OSError:
+            pass
+        self._prune()
+
+    def _prune(self) -> None:
+        """
+        Remove files last changed longer than wait_timeout ago, which no
+        process waits for any more, so that the directory does not keep a
+        file for every query ever run. Lock files are only removed while
+        nobody holds them.
+        """
+        expired = time.time() - self.wait_timeout
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime >= expired:
+                    continue
+                if not entry.name.endswith('.lock'):
+                    os.unlink(entry.path)
+                    continue
+                fd = self._try_lock(entry.path)
+                if fd is None:
+                    continue
+                try:
+                    os.unlink(entry.path)
+                finally:
+                    os.close(fd)
+            except OSError:
+                # Removed by another process in the meantime
+                continue
@@ -0,0 +1,392 @@
+from __future__ import annotations
+from collections.abc import Iterable, Mapping
+from typing import Any, Callable, NamedTuple, Optional
+import json
+import sqlite3
+import threading
+import time
+from .bluetoothctl import DiscoveredDevice
+from .history import DeviceStats
+from .parser import DeviceIndex, DeviceInfo
+
+# Name of the device store database in the addon profile directory
+STORE_NAME = 'available.db'
+
+# Sort orders of listings, in the order of the device_sort setting
+SORT_ORDERS = ('rssi', 'name', 'last_seen', 'discovery', 'reliability')
+
+# Most filtered views to keep, the least recently used are dropped
+_MAX_VIEWS = 8
+
+# Columns of the devices table, in the order of StoredDevice's arguments
+_COLUMNS = ('address', 'name', 'rssi', 'device_class', 'icon', 'last_seen',
+            'adapter', 'reliability')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    address TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    rssi INTEGER,
+    device_class INTEGER,
+    icon TEXT,
+    last_seen REAL NOT NULL,
+    adapter TEXT,
+    reliability REAL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    sort TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    PRIMARY KEY (sort, position)
+);
+CREATE TABLE IF NOT EXISTS views (
+    key TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    PRIMARY KEY (key, position)
+);
+CREATE TABLE IF NOT EXISTS view_use (
+    key TEXT PRIMARY KEY,
+    used INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    updated REAL NOT NULL
+);
+'''
+
+
+class StoredDevice:
+    """A device in the store, with what is known of it from discovery."""
+
+    __slots__ = ('address', 'name', 'rssi', 'device_class', 'icon',
+                 'last_seen', 'adapter', 'reliability')
+
+    def __init__(self, address: str, name: str,
+                 rssi: Optional[int] = None,
+                 device_class: Optional[int] = None,
+                 icon: Optional[str] = None,
+                 last_seen: float = 0,
+                 adapter: Optional[str] = None,
+                 reliability: Optional[float] = None) -> None:
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.device_class = device_class
+        self.icon = icon
+        self.last_seen = last_seen
+        # Controller with the strongest signal from the device, when
+        # scanning with several
+        self.adapter = adapter
+        # Share of the commands on the device which succeeded, from the
+        # history, None if there were none
+        self.reliability = reliability
+
+    @property
+    def named(self) -> bool:
+        """
+        Return whether the device has a name of its own, rather than one made
+        from its address as for most BLE advertisers
+        """
+        return self.name.replace('-', ':').upper() != self.address
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the device's fields, to be passed back to the constructor"""
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f'StoredDevice({self.address!r}, {self.name!r})'
+
+
+class DeviceFilter(NamedTuple):
+    """Which devices a listing shows."""
+    # Only devices whose name contains this, ignoring case
+    name: str = ''
+    # Only devices with at least this RSSI (in dBm)
+    min_rssi: Optional[int] = None
+    # Only devices of this type, the first part of their icon such as
+    # 'audio' for 'audio-headset'
+    device_type: str = ''
+    # Only devices with names of their own
+    named_only: bool = False
+
+    def matches(self, device: StoredDevice) -> bool:
+        """Return whether a device passes the filter."""
+        if self.named_only and not device.named:
+            return False
+        if self.min_rssi is not None and (device.rssi is None
+                                          or device.rssi < self.min_rssi):
+            return False
+        if self.device_type and (device.icon is None
+                                 or device.icon.split('-')[0]
+                                 != self.device_type):
+            return False
+        return (not self.name
+                or self.name.casefold() in device.name.casefold())
+
+
+# Sort key of each order, taking devices in discovery order
+_SORT_KEYS: dict[str, Callable[[tuple[int, StoredDevice]], Any]] = {
+    # Strongest signal first, devices without one last
+    'rssi': lambda item: (item[1].rssi is None, -(item[1].rssi or 0),
+                          item[0]),
+    'name': lambda item: (item[1].name.casefold(), item[0]),
+    # Most recently seen first
+    'last_seen': lambda item: (-item[1].last_seen, item[0]),
+    'discovery': lambda item: item[0],
+    # Most reliable first, devices never used last
+    'reliability': lambda item: (item[1].reliability is None,
+                                 -(item[1].reliability or 0), item[0]),
+}
+
+
+class DeviceStore:
+    """
+    Devices found by discovery, indexed so that listings can be paged.
+
+    Each page of a listing is rendered by a separate plugin invocation, so
+    the store is kept in an SQLite database. Every sort order is computed
+    once when a scan replaces the devices, and each filtered view once when
+    its first page is requested. Later pages only read their slice of a
+    view, so cost time proportional to the page size rather than the number
+    of devices. Instances may be shared between threads.
+    """
+
+    def __init__(self, path: Optional[str]) -> None:
+        """
+        Construct a DeviceStore instance.
+
+        path: Path to the database. If None, devices are only held in
+            memory.
+        """
+        self._path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Optional[str]:
+        """Return the path to the database"""
+        return self._path
+
+    @property
+    def updated(self) -> float:
+        """Return when a scan last replaced the devices"""
+        rows = self._read('SELECT updated FROM scans')
+        return float(rows[0][0]) if rows else 0.0
+
+    def replace(self, devices: DeviceIndex,
+                discovered: Mapping[str, DiscoveredDevice],
+                history: Optional[Mapping[str, DeviceStats]] = None) -> None:
+        """
+        Replace the devices with those listed after a scan.
+
+        What is known of devices already in the store is kept. Devices
+        reported during the scan are marked as seen now.
+
+        devices: Devices listed by bluetoothctl, in discovery order.
+        discovered: Dict of device_address: state reported during the scan.
+        history: Dict of device_address: what the device history holds on
+            the device, for its reliability and, for devices new to the
+            store but not reported during the scan, when it was last seen.
+        """
+        now = time.time()
+        stats = history if history is not None else {}
+
+        def write(connection: sqlite3.Connection) -> None:
+            previous = {row[0]: StoredDevice(*row) for row in
+                        connection.execute(self._select('devices'))}
+            replaced: list[StoredDevice] = []
+            for device in devices:
+                stored = previous.get(device.address)
+                recorded = stats.get(device.address)
+                if stored is None:
+                    last_seen = (None if recorded is None
+                                 else recorded.last_seen)
+                    stored = StoredDevice(device.address, device.name,
+                                          last_seen=last_seen or now)
+                stored.name = device.name
+                if recorded is not None:
+                    stored.reliability = recorded.reliability
+
+                state = discovered.get(device.address)
+                if state is not None:
+                    stored.last_seen = now
+                    stored.adapter = state.adapter
+                    if state.rssi is not None:
+                        stored.rssi = state.rssi
+                    if state.device_class is not None:
+                        stored.device_class = state.device_class
+                    if state.icon is not None:
+                        stored.icon = state.icon
+                replaced.append(stored)
+
+            for table in ('devices', 'orders', 'views', 'view_use'):
+                connection.execute(f'DELETE FROM {table}')
+            connection.executemany(
+                f'INSERT OR REPLACE INTO devices ({", ".join(_COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(_COLUMNS))})',
+                [tuple(getattr(device, column) for column in _COLUMNS)
+                 for device in replaced]
+            )
+            items = list(enumerate(replaced))
+            for order, key in _SORT_KEYS.items():
+                connection.executemany(
+                    'INSERT INTO orders (sort, position, address) '
+                    'VALUES (?, ?, ?)',
+                    [(order, position, item[1].address)
+                     for position, item in enumerate(sorted(items, key=key))]
+                )
+            connection.execute('INSERT OR REPLACE INTO scans (id, updated) '
+                               'VALUES (0, ?)', (now,))
+        self._write(write)
+
+    def update_info(self, infos: Iterable[DeviceInfo]) -> None:
+        """
+        Record device properties from `info` output.
+
+        Orders and views are left as they are, so that pages already shown
+        stay put until the next scan.
+        """
+        rows = [(info.rssi, info.device_class, info.icon, info.address)
+                for info in infos]
+        if not rows:
+            return
+
+        def write(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                'UPDATE devices SET rssi = coalesce(?, rssi), '
+                'device_class = coalesce(?, device_class), '
+                'icon = coalesce(?, icon) WHERE address = ?', rows
+            )
+        self._write(write)
+
+    def get(self, address: str) -> Optional[StoredDevice]:
+        """Return the device with an address."""
+        rows = self._read(f'{self._select("devices")} WHERE address = ?',
+                          (address,))
+        return StoredDevice(*rows[0]) if rows else None
+
+    def view(self, device_filter: DeviceFilter = DeviceFilter(),
+             order: str = 'discovery') -> list[str]:
+        """
+        Return the addresses of the devices passing a filter, in a sort
+        order.
+
+        device_filter: Which devices to include.
+        order: One of SORT_ORDERS.
+        """
+        key = self._view(device_filter, order)
+        return [address for address, in self._read(
+            'SELECT address FROM views WHERE key = ? ORDER BY position',
+            (key,)
+        )]
+
+    def page(self, device_filter: DeviceFilter = DeviceFilter(),
+             order: str = 'discovery', number: int = 0,
+             size: int = 50) -> tuple[list[StoredDevice], bool]:
+        """
+        Return a page of devices.
+
+        device_filter: Which devices to include.
+        order: One of SORT_ORDERS.
+        number: Number of the page, starting at 0.
+        size: Number of devices per page, 0 for all on one page.
+
+        Returns: The page's devices, and whether there are more pages.
+        """
+        key = self._view(device_filter, order)
+        start = 0 if size <= 0 else number * size
+        end = -1 if size <= 0 else start + size
+        rows = self._read(
+            f'{self._select("views JOIN devices USING (address)")} '
+            'WHERE key = ? AND position >= ? AND (? < 0 OR position < ?) '
+            'ORDER BY position', (key, start, end, end)
+        )
+        more = end >= 0 and bool(self._read(
+            'SELECT 1 FROM views WHERE key = ? AND position = ?', (key, end)
+        ))
+        return [StoredDevice(*row) for row in rows], more
+
+    def close(self) -> None:
+        """
+        Close the database.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def __len__(self) -> int:
+        rows = self._read('SELECT count(*) FROM devices')
+        return int(rows[0][0]) if rows else 0
+
+    def _view(self, device_filter: DeviceFilter, order: str) -> str:
+        """
+        Compute a filtered view, unless it was already, and mark it as the
+        most recently used.
+
+        Returns: The key of the view's rows in the views table.
+        """
+        key = json.dumps([order, *device_filter])
+
+        def write(connection: sqlite3.Connection) -> None:
+            if connection.execute('SELECT 1 FROM view_use WHERE key = ?',
+                                  (key,)).fetchone() is None:
+                devices = [StoredDevice(*row) for row in connection.execute(
+                    f'{self._select("orders JOIN devices USING (address)")} '
+                    'WHERE sort = ? ORDER BY position', (order,)
+                )]
+                connection.executemany(
+                    'INSERT INTO views (key, position, address) '
+                    'VALUES (?, ?, ?)',
+                    [(key, position, device.address) for position, device
+                     in enumerate(filter(device_filter.matches, devices))]
+                )
+            connection.execute(
+                'INSERT OR REPLACE INTO view_use (key, used) VALUES '
+                '(?, (SELECT coalesce(max(used), 0) + 1 FROM view_use))',
+                (key,)
+            )
+            # Drop the least recently used views
+            connection.execute(
+                'DELETE FROM views WHERE key IN (SELECT key FROM view_use '
+                'ORDER BY used DESC LIMIT -1 OFFSET ?)', (_MAX_VIEWS,)
+            )
+            connection.execute(
+                'DELETE FROM view_use WHERE key NOT IN (SELECT key FROM '
+                'view_use ORDER BY used DESC LIMIT ?)', (_MAX_VIEWS,)
+            )
+        self._write(write)
+        return key
+
+    @staticmethod
+    def _select(source: str) -> str:
+        """Return a query of the devices' columns from a table or join."""
+        return f'SELECT {", ".join(_COLUMNS)} FROM {source}'
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # Pages of the same listing may be rendered at the same time
+            self._connection = sqlite3.connect(
+                self.path if self.path is not None else ':memory:',
+                timeout=5, check_same_thread=False
+            )
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+    def _read(self, query: str,
+              parameters: tuple[Any, ...] = ()) -> list[tuple[Any, ...]]:
+        with self._lock:
+            try:
+                return list(self._connect().execute(query, parameters))
+            except sqlite3.Error:
+                return []
+
+    def _write(self, write: Callable[[sqlite3.Connection], None]) -> None:
+        with self._lock:
+            try:
+                connection = self._connect()
+                with connection:
+                    write(connection)
+            except sqlite3.Error:
+                pass
@@ -0,0 +1,187 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import codecs
+import copy
+import os
+import re
+import subprocess
+import threading
+from .parser import DeviceInfo, set_property
+
+# Remove terminal colour and readline control sequences from output
+_CONTROL = re.compile(r'\x1b\[[0-9;]*[A-Za-z]|[\x01\x02\r]')
+# A device event, for example
+# [NEW] Device AA:BB:CC:DD:EE:FF JBL Flip
+# [CHG] Device AA:BB:CC:DD:EE:FF Connected: yes
+# [DEL] Device AA:BB:CC:DD:EE:FF JBL Flip
+_EVENT = re.compile(
+    r'\[(NEW|CHG|DEL)\] Device ((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}) ?(.*)'
+)
+# The property change of a [CHG] event, <property>: <value>
+_CHANGE = re.compile(r'([A-Za-z][A-Za-z ]*): (.*)')
+
+
+class EventMonitor:
+    """
+    Follow BlueZ device events, keeping a table of device state.
+
+    A long-running, interactive bluetoothctl process prints an event line
+    whenever a device appears, changes or is removed. The table is updated
+    from these lines as they arrive, so it is current without polling.
+    """
+
+    def __init__(
+        self, executable: str = '/usr/bin/bluetoothctl',
+        on_change: Optional[Callable[[DeviceInfo], None]] = None
+    ) -> None:
+        """
+        Construct an EventMonitor instance.
+
+        executable: Path to the bluetoothctl executable on the host.
+        on_change: Function called, from the monitor's thread, with the new
+            state of a device whenever an event changes it. A removed device
+            is passed with its last state.
+        """
+        self._executable = executable
+        self.on_change = on_change
+
+        self._devices: dict[str, DeviceInfo] = {}
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen[bytes]] = None
+        self._reader: Optional[threading.Thread] = None
+
+    @property
+    def executable(self) -> str:
+        """Return the path to the bluetoothctl executable"""
+        return self._executable
+
+    @property
+    def running(self) -> bool:
+        """Return whether the bluetoothctl process is alive"""
+        return self._process is not None and self._process.poll() is None
+
+    def start(self) -> None:
+        """
+        Start the bluetoothctl process and follow its events.
+        """
+        if self.running:
+            return
+
+        self._process = subprocess.Popen(
+            [self.executable],
+            # bluetoothctl exits when stdin closes, keep it open and unused
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+        )
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def stop(self) -> None:
+        """
+        Stop the bluetoothctl process.
+        """
+        process = self._process
+        if process is None:
+            return
+        self._process = None
+
+        try:
+            if process.poll() is None and process.stdin is not None:
+                process.stdin.write(b'quit\n')
+                process.stdin.close()
+            process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+        if self._reader is not None:
+            self._reader.join(timeout=1)
+            self._reader = None
+
+    def devices(self) -> list[DeviceInfo]:
+        """
+        Return copies of the state of all known devices.
+        """
+        with self._lock:
+            return [copy.copy(info) for info in self._devices.values()]
+
+    def get(self, address: str) -> Optional[DeviceInfo]:
+        """
+        Return a copy of the state of a device, if known.
+        """
+        with self._lock:
+            info = self._devices.get(address.upper())
+            return None if info is None else copy.copy(info)
+
+    def update(self, info: DeviceInfo) -> None:
+        """
+        Replace the state of a device, for example from `info` output when
+        the monitor starts, before any events have been seen.
+        """
+        with self._lock:
+            self._devices[info.address] = copy.copy(info)
+        self._changed(info)
+
+    def handle(self, line: str) -> Optional[DeviceInfo]:
+        """
+        Apply an event line to the table.
+
+        line: A line of bluetoothctl output, which may not be an event.
+
+        Returns: The new state of the device the event changed, or None if the
+            line changed nothing.
+        """
+        event = _EVENT.search(line)
+        if event is None:
+            return None
+        kind, address, detail = event.groups()
+        address = address.upper()
+        detail = detail.rstrip()
+
+        with self._lock:
+            info = self._devices.get(address)
+            if kind == 'DEL':
+                if info is None:
+                    return None
+                del self._devices[address]
+            else:
+                if info is None:
+                    info = self._devices[address] = DeviceInfo(address)
+                if kind == 'NEW':
+                    info.name = detail or info.name
+                else:
+                    change = _CHANGE.match(detail)
+                    if change is None or not set_property(info,
+                                                          *change.groups()):
+                        return None
+            info = copy.copy(info)
+
+        self._changed(info)
+        return info
+
+    def _changed(self, info: DeviceInfo) -> None:
+        if self.on_change is not None:
+            self.on_change(info)
+
+    def _read(self) -> None:
+        """Apply the process' output to the table (reader thread)."""
+        process = self._process
+        if process is None or process.stdout is None:
+            return
+        fd = process.stdout.fileno()
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+
+        partial = ''
+        while True:
+            try:
+                chunk = os.read(fd, 4096)
+            except OSError:
+                chunk = b''
+            text = _CONTROL.sub('', decoder.decode(chunk, final=not chunk))
+            *lines, partial = (partial + text).split('\n')
+            for line in lines:
+                self.handle(line)
+            if not chunk:
+                return
@@ -0,0 +1,50 @@
+from __future__ import annotations
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from .bluetoothctl import Bluetoothctl
+from .result import CommandResult
+
+
+def fetch_device_lists(
+    bt: Bluetoothctl, adapter: Optional[str] = None
+) -> tuple[CommandResult, CommandResult]:
+    """
+    Fetch the available and paired device lists concurrently.
+
+    adapter: Address of the controller whose devices to list, by default
+        the backend's.
+
+    Returns: CommandResult instances for 'devices' and 'paired-devices'.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        devices = executor.submit(bt.get_devices, adapter)
+        paired_devices = executor.submit(bt.get_paired_devices, adapter)
+        return devices.result(), paired_devices.result()
+
+
+def fetch_info(bt: Bluetoothctl, addresses: Iterable[str],
+               max_workers: int = 4,
+               adapters: Optional[Mapping[str, str]] = None
+               ) -> dict[str, CommandResult]:
+    """
+    Fetch information on several devices concurrently.
+
+    addresses: Addresses of the devices.
+    max_workers: Maximum number of commands to run at once.
+    adapters: Dict of device_address: address of the controller to ask,
+        devices missing from it are asked about on the backend's.
+
+    Returns: Dict of device_address: CommandResult instance of 'info'.
+    """
+    addresses = list(addresses)
+    if not addresses:
+        return {}
+
+    controllers = adapters if adapters is not None else {}
+    workers = max(1, min(max_workers, len(addresses)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(addresses, executor.map(
+            lambda address: bt.info(address, controllers.get(address)),
+            addresses
+        )))
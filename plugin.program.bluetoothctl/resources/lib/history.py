@@ -0,0 +1,267 @@
+from __future__ import annotations
+from collections.abc import Iterable
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple, Optional
+import sqlite3
+import threading
+import time
+from .result import CommandResult
+
+if TYPE_CHECKING:
+    from .bluetoothctl import DiscoveredDevice
+
+# Name of the history database in the addon profile directory
+HISTORY_NAME = 'history.db'
+
+# Commands on a device whose outcomes are recorded
+RECORDED = ('connect', 'disconnect', 'pair', 'remove', 'trust', 'untrust')
+
+# Fewest successful runs of a command on a device from which its timeout is
+# fitted to the device
+_MIN_SAMPLES = 3
+# Multiple of the longest recent successful run allowed for the next
+_TIMEOUT_FACTOR = 2
+# Shortest timeout (in seconds) a command is given
+_MIN_TIMEOUT = 5
+
+# Time (in seconds) after which devices not seen again are forgotten
+_MAX_AGE = 30 * 24 * 60 * 60
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    address TEXT NOT NULL,
+    command TEXT NOT NULL,
+    time REAL NOT NULL,
+    duration REAL NOT NULL,
+    returncode INTEGER NOT NULL,
+    timed_out INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_device ON runs (address, command);
+CREATE TABLE IF NOT EXISTS sightings (
+    address TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL,
+    rssi INTEGER
+);
+'''
+
+
+class DeviceStats(NamedTuple):
+    """What the history holds on a device."""
+    address: str
+    # Number of commands recorded, and how many of them failed
+    runs: int = 0
+    failures: int = 0
+    # Mean time (in seconds) taken by the commands which succeeded
+    mean_duration: Optional[float] = None
+    # When the device was last seen in a scan, and its RSSI (in dBm) then
+    last_seen: Optional[float] = None
+    rssi: Optional[int] = None
+
+    @property
+    def reliability(self) -> Optional[float]:
+        """
+        Return the share of the device's commands which succeeded, or None
+        if none were recorded
+        """
+        return (self.runs - self.failures) / self.runs if self.runs else None
+
+
+class DeviceHistory:
+    """
+    Outcomes of commands on each device, and when each device was last seen,
+    kept in an SQLite database so that they outlive plugin invocations.
+
+    Only the most recent runs of each command on each device are kept, and
+    devices not seen for a long time are forgotten, so the database stays
+    small however long it is used. Instances may be shared between threads.
+    """
+
+    def __init__(self, path: Optional[str], max_runs: int = 20,
+                 adaptive_timeouts: bool = False,
+                 log: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Construct a DeviceHistory instance.
+
+        path: Path to the database. If None, the history is only held in
+            memory.
+        max_runs: Number of runs of each command on each device to keep.
+        adaptive_timeouts: Whether timeout fits commands' timeouts to how
+            long they took on the device before.
+        log: Function to send debug messages to, for example database errors.
+        """
+        self._path = path
+        self.max_runs = max_runs
+        self.adaptive_timeouts = adaptive_timeouts
+        self._log = log
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Optional[str]:
+        """Return the path to the database"""
+        return self._path
+
+    def record(self, command: list[str], duration: float,
+               process: CommandResult) -> None:
+        """
+        Record the outcome of a command, if it is one of RECORDED. Cancelled
+        commands are not recorded, as they say nothing of the device.
+
+        command: bluetoothctl command and its arguments.
+        duration: Time (in seconds) the command took.
+        process: Result of the command.
+        """
+        if command[0] not in RECORDED or len(command) < 2 or process.cancelled:
+            return
+        name, address = command[:2]
+
+        def write(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                'INSERT INTO runs (address, command, time, duration, '
+                'returncode, timed_out) VALUES (?, ?, ?, ?, ?, ?)',
+                (address, name, time.time(), duration, process.returncode,
+                 process.timed_out)
+            )
+            # Compact the device's runs of the command as they are added
+            connection.execute(
+                'DELETE FROM runs WHERE address = ? AND command = ? '
+                'AND id NOT IN (SELECT id FROM runs WHERE address = ? '
+                'AND command = ? ORDER BY id DESC LIMIT ?)',
+                (address, name, address, name, self.max_runs)
+            )
+        self._write(write)
+
+    def record_seen(self, devices: Iterable[DiscoveredDevice],
+                    when: Optional[float] = None) -> None:
+        """
+        Record that devices were seen in a scan, with their RSSI. A device
+        seen without one keeps the RSSI it was last seen with.
+
+        when: Time the devices were seen, by default now.
+        """
+        seen = time.time() if when is None else when
+        rows = [(device.address, seen, device.rssi, device.address)
+                for device in devices]
+        if not rows:
+            return
+
+        def write(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                'INSERT OR REPLACE INTO sightings (address, last_seen, rssi) '
+                'VALUES (?, ?, coalesce(?, (SELECT rssi FROM sightings '
+                'WHERE address = ?)))', rows
+            )
+            # Forget devices which have not been seen for a long time
+            connection.execute('DELETE FROM sightings WHERE last_seen < ?',
+                               (seen - _MAX_AGE,))
+            connection.execute(
+                'DELETE FROM runs WHERE time < ? AND address NOT IN '
+                '(SELECT address FROM sightings)', (seen - _MAX_AGE,)
+            )
+        self._write(write)
+
+    def stats(self, addresses: Iterable[str]) -> dict[str, DeviceStats]:
+        """
+        Return what the history holds on devices.
+
+        addresses: Addresses of the devices.
+
+        Returns: Dict of device_address: DeviceStats instance, for the
+            devices the history holds anything on.
+        """
+        wanted = set(addresses)
+        runs = self._read(
+            'SELECT address, count(*), sum(returncode != 0), '
+            'avg(CASE WHEN returncode = 0 THEN duration END) '
+            'FROM runs GROUP BY address'
+        )
+        sightings = self._read('SELECT address, last_seen, rssi '
+                               'FROM sightings')
+
+        stats: dict[str, DeviceStats] = {}
+        for address, count, failures, mean_duration in runs:
+            if address in wanted:
+                stats[address] = DeviceStats(address, count, failures,
+                                             mean_duration)
+        for address, last_seen, rssi in sightings:
+            if address in wanted:
+                stats[address] = stats.get(
+                    address, DeviceStats(address)
+                )._replace(last_seen=last_seen, rssi=rssi)
+        return stats
+
+    def timeout(self, command: list[str],
+                default: Optional[float]) -> Optional[float]:
+        """
+        Return the time (in seconds) after which to stop a command.
+
+        With adaptive timeouts, a command which has succeeded on the device
+        often enough is given a multiple of the longest time it recently
+        took, so that a device out of range fails, and may be retried,
+        sooner. The timeout is never longer than the default, nor shortened
+        after the command last timed out, in case the device now needs
+        longer.
+
+        command: bluetoothctl command and its arguments.
+        default: Timeout of the command when not fitted to the device, None
+            if it may run indefinitely.
+        """
+        if (not self.adaptive_timeouts or default is None
+                or command[0] not in RECORDED or len(command) < 2):
+            return default
+
+        runs = self._read(
+            'SELECT returncode, timed_out, duration FROM runs '
+            'WHERE address = ? AND command = ? ORDER BY id DESC LIMIT ?',
+            (command[1], command[0], self.max_runs)
+        )
+        if not runs or runs[0][1]:
+            return default
+        durations: list[float] = [duration for returncode, _, duration
+                                  in runs if returncode == 0]
+        if len(durations) < _MIN_SAMPLES:
+            return default
+        return min(default, max(_MIN_TIMEOUT,
+                                max(durations) * _TIMEOUT_FACTOR))
+
+    def close(self) -> None:
+        """
+        Close the database.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # Plugin invocations and the service may write at the same time,
+            # waiting for each other's transactions
+            self._connection = sqlite3.connect(
+                self.path if self.path is not None else ':memory:',
+                timeout=5, check_same_thread=False
+            )
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+    def _read(self, query: str,
+              parameters: tuple[Any, ...] = ()) -> list[tuple[Any, ...]]:
+        with self._lock:
+            try:
+                return list(self._connect().execute(query, parameters))
+            except sqlite3.Error as exc:
+                self._debug(f'failed to read history: {exc}')
+                return []
+
+    def _write(self, write: Callable[[sqlite3.Connection], None]) -> None:
+        with self._lock:
+            try:
+                connection = self._connect()
+                with connection:
+                    write(connection)
+            except sqlite3.Error as exc:
+                self._debug(f'failed to write history: {exc}')
+
+    def _debug(self, message: str) -> None:
+        if self._log is not None:
+            self._log(message)
@@ -0,0 +1,342 @@
+from __future__ import annotations
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from .bluetoothctl import (
+    COMMANDS, Bluetoothctl, DiscoveredDevice, DiscoveryFilter
+)
+from .result import CommandResult, RetryPolicy
+
+# Name of the service socket in the addon profile directory
+SOCKET_NAME = 'service.sock'
+
+
+class ServiceUnavailable(Exception):
+    """
+    The service is not running.
+    """
+    pass
+
+
+class ServiceRunning(Exception):
+    """
+    Another service is already serving on the socket.
+    """
+    pass
+
+
+def _encode(message: dict[str, Any]) -> bytes:
+    """Encode a message as a single line of JSON."""
+    return (json.dumps(message) + '\n').encode()
+
+
+def _decode(line: bytes) -> dict[str, Any]:
+    message: dict[str, Any] = json.loads(line)
+    return message
+
+
+class ServiceServer:
+    """
+    Serve bluetooth commands to plugin invocations over a Unix socket.
+
+    Each request is one line of JSON, answered by one line of JSON.
+    Requests are either
+        {"method": "run", "command": [...], "duration": null}
+    answered with the fields of a CommandResult, for the commands in
+    COMMANDS only, or
+        {"method": "invalidate", "prefix": "..."}
+    to drop cached results.
+
+    Queries run with one backend, typically in a session, and commands
+    changing device state and scans with another, so that a pairing taking
+    a minute does not hold up device lists asked for meanwhile.
+    """
+
+    def __init__(self, path: str, bt: Bluetoothctl,
+                 actions: Optional[Bluetoothctl] = None) -> None:
+        """
+        Construct a ServiceServer instance.
+
+        path: Path to the socket.
+        bt: Backend to run queries with.
+        actions: Backend to run other commands with, by default bt. It
+            should share bt's cache, so that the commands invalidate it.
+        """
+        self._path = path
+        self.bt = bt
+        self.actions = actions if actions is not None else bt
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> str:
+        """Return the path to the socket"""
+        return self._path
+
+    def start(self) -> None:
+        """
+        Start serving requests in a background thread.
+
+        Raises: ServiceRunning if another service answers on the socket.
+        """
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                for line in self.rfile:
+                    try:
+                        response = server.handle(_decode(line))
+                    except Exception as exc:
+                        response = {'error': repr(exc)}
+                    try:
+                        self.wfile.write(_encode(response))
+                    except OSError:
+                        # The client stopped waiting, see ServiceClient
+                        return
+
+        # Remove a socket left behind by a previous run, but never one
+        # another service is still listening on
+        if os.path.exists(self.path):
+            if self._listening():
+                raise ServiceRunning(f'a service is listening on {self.path}')
+            os.unlink(self.path)
+
+        # Only the user running Kodi may connect, from the moment the socket
+        # exists
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(self.path,
+                                                                  Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop serving requests and remove the socket.
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _listening(self, timeout: float = 0.5) -> bool:
+        """Return whether anything accepts connections on the socket."""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.settimeout(timeout)
+            probe.connect(self.path)
+        except OSError:
+            return False
+        finally:
+            probe.close()
+        return True
+
+    def handle(self, request: dict[str, Any]) -> dict[str, Any]:
+        """
+        Respond to a request.
+        """
+        method = request.get('method')
+        if method == 'run':
+            command = request.get('command')
+            if (not isinstance(command, list) or not command
+                    or not all(isinstance(arg, str) for arg in command)
+                    or command[0] not in COMMANDS):
+                return {'error': f'unknown command {command!r}'}
+            adapter = request.get('adapter')
+            if adapter is not None and not isinstance(adapter, str):
+                return {'error': f'invalid adapter {adapter!r}'}
+            # Scans last the duration, which may be no longer than the
+            # service's own
+            duration = request.get('duration')
+            if duration is not None and (
+                isinstance(duration, bool)
+                or not isinstance(duration, (int, float))
+                or not 0 <= duration <= self.bt.scan_timeout
+            ):
+                return {'error': f'invalid duration {duration!r}'}
+            bt = (self.bt if duration is None and self.bt._is_query(command)
+                  else self.actions)
+            process = bt._run(command, duration, adapter)
+            return process.as_dict()
+        if method == 'invalidate':
+            if self.bt.cache is not None:
+                self.bt.cache.invalidate(request.get('prefix', ''))
+            return {}
+        return {'error': f'unknown method {method}'}
+
+
+class ServiceClient(Bluetoothctl):
+    """
+    Run commands through the service, falling back to running them directly
+    when the service is not running.
+
+    The service applies its own timeouts and retries. The client stops waiting
+    for a response once the command's timeout has passed, or when cancelled,
+    but the command itself runs to completion in the service.
+    """
+
+    def __init__(self, path: str, fallback: Bluetoothctl,
+                 connect_timeout: float = 0.5) -> None:
+        """
+        Construct a ServiceClient instance.
+
+        path: Path to the service socket.
+        fallback: Backend to use when the service is not running.
+        connect_timeout: Time (in seconds) to wait to connect to the service.
+        """
+        # Set before the base class sets cancel, which is the fallback's
+        self._fallback = fallback
+        # Retries happen in the service, or in the fallback
+        super().__init__(executable=fallback.executable,
+                         scan_timeout=fallback.scan_timeout,
+                         timeouts=fallback.timeouts,
+                         retry=RetryPolicy(attempts=1),
+                         discovery_filter=fallback.discovery_filter,
+                         adapter=fallback.adapter)
+        self._path = path
+        self.connect_timeout = connect_timeout
+
+    @property
+    def path(self) -> str:
+        """Return the path to the service socket"""
+        return self._path
+
+    @property
+    def cancel(self) -> Optional[Callable[[], bool]]:
+        """Return the function cancelling commands"""
+        return self._fallback.cancel
+
+    @cancel.setter
+    def cancel(self, cancel: Optional[Callable[[], bool]]) -> None:
+        # Commands which fall back to running directly are cancelled too
+        self._fallback.cancel = cancel
+
+    @contextmanager
+    def session(self) -> Generator[Bluetoothctl, None, None]:
+        """
+        Use a session for commands which fall back to running directly.
+        """
+        with self._fallback.session():
+            yield self
+
+    def discover(
+        self,
+        until: Optional[Callable[[DiscoveredDevice], bool]] = None,
+        idle: Optional[float] = None,
+        cancel: Optional[Callable[[], bool]] = None,
+        discovery_filter: Optional[DiscoveryFilter] = None,
+        adapter: Optional[str] = None,
+    ) -> Generator[DiscoveredDevice, None, None]:
+        """
+        Discovery always runs directly, in the fallback, which records the
+        devices seen in its history. The service's cached results are
+        invalidated afterwards.
+        """
+        if discovery_filter is None:
+            discovery_filter = self.discovery_filter
+        adapter = adapter or self.adapter
+        try:
+            with self._span('command',
+                            self.command_key(['discover'], adapter)):
+                yield from self._fallback.discover(until, idle, cancel,
+                                                   discovery_filter, adapter)
+        finally:
+            self.invalidate_discovered()
+
+    def invalidate_discovered(self) -> None:
+        # Both the service's results and those cached for the fallback are
+        # stale
+        self._fallback.invalidate_discovered()
+        for prefix in ('devices', 'info'):
+            try:
+                self._request({'method': 'invalidate', 'prefix': prefix})
+            except ServiceUnavailable:
+                return
+
+    def _execute(self, command: list[str], duration: Optional[float] = None,
+                 poll: float = 0.1,
+                 adapter: Optional[str] = None) -> CommandResult:
+        timeout = self.command_timeout(command)
+        if timeout is not None and duration is not None:
+            timeout += duration
+        try:
+            response = self._request({'method': 'run', 'command': command,
+                                      'duration': duration,
+                                      'adapter': adapter},
+                                     timeout=timeout, poll=poll)
+        except ServiceUnavailable:
+            return self._fallback._run(command, duration, adapter)
+
+        if 'error' in response:
+            return CommandResult([self.executable, *command], 1, '',
+                                 response['error'],
+                                 timed_out=response.get('timed_out', False),
+                                 cancelled=response.get('cancelled', False))
+        process = CommandResult(**response)
+        if process.returncode == 0:
+            # The service only invalidates its own cache, results cached for
+            # the fallback are stale too
+            self._fallback.invalidate_changed(command)
+        return process
+
+    def _request(self, request: dict[str, Any],
+                 timeout: Optional[float] = None,
+                 poll: float = 0.1) -> dict[str, Any]:
+        """
+        Send a request to the service and wait for the response.
+
+        timeout: Maximum time (in seconds) to wait for the response.
+        poll: Interval (in seconds) at which to check for cancellation.
+
+        Returns: The response, or an error response with 'timed_out' or
+            'cancelled' set if waiting for it was stopped.
+
+        Raises: ServiceUnavailable if the service can not be reached.
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(self.connect_timeout)
+            connection.connect(self.path)
+            connection.sendall(_encode(request))
+
+            # Commands such as 'pair' may take a long time, wake periodically
+            # to check whether to stop waiting
+            deadline = None if timeout is None else time.monotonic() + timeout
+            connection.settimeout(poll)
+            line = b''
+            while not line.endswith(b'\n'):
+                try:
+                    chunk = connection.recv(65536)
+                except socket.timeout:
+                    if self.cancel is not None and self.cancel():
+                        return {'error': 'cancelled', 'cancelled': True}
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return {'error': 'timed out waiting for the service',
+                                'timed_out': True}
+                    continue
+                if not chunk:
+                    break
+                line += chunk
+        except OSError as exc:
+            # The service is not running, or stopped during the request, for
+            # example when it restarts
+            raise ServiceUnavailable(str(exc)) from exc
+        finally:
+            connection.close()
+
+        if not line.endswith(b'\n'):
+            raise ServiceUnavailable('service closed the connection')
+        return _decode(line)
@@ -0,0 +1,85 @@
+from __future__ import annotations
+from typing import Optional
+import logging
+import logging.handlers
+from .result import CommandResult
+
+# Name of the output capture file in the addon profile directory
+CAPTURE_NAME = 'output.log'
+
+
+def truncate(text: Optional[str], budget: int) -> str:
+    """
+    Shorten text to about a number of bytes (as UTF-8), keeping its start and
+    end, which hold a command's progress and its outcome.
+
+    text: Text to shorten.
+    budget: Number of bytes to keep, 0 keeps all of the text.
+
+    Returns: The text, with its middle replaced by a note of how many bytes
+        were left out if it was too long.
+    """
+    if not text:
+        return ''
+    # A character is at most four bytes, so short text needs no encoding
+    if budget <= 0 or len(text) * 4 <= budget:
+        return text
+    encoded = text.encode('utf8')
+    if len(encoded) <= budget:
+        return text
+
+    half = budget // 2
+    omitted = len(encoded) - 2 * half
+    # Characters cut in two at either edge are dropped
+    return (f'{encoded[:half].decode("utf8", errors="ignore")}\n'
+            f'[... {omitted} bytes omitted ...]\n'
+            f'{encoded[-half:].decode("utf8", errors="ignore")}')
+
+
+class Capture:
+    """
+    Record the full output of commands in a file, for diagnosis offline.
+
+    The file is rotated when it reaches its size limit, keeping a number of
+    previous files, so the capture never takes more than a bounded amount of
+    space.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 20,
+                 backups: int = 1) -> None:
+        """
+        Construct a Capture instance.
+
+        path: Path to the capture file.
+        max_bytes: Size (in bytes) at which the file is rotated.
+        backups: Number of rotated files to keep.
+        """
+        self._path = path
+        self._logger = logging.getLogger(f'{__name__}.{path}')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            # The file is only created once something is captured
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups,
+                encoding='utf8', delay=True
+            )
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self._logger.addHandler(handler)
+
+    @property
+    def path(self) -> str:
+        """Return the path to the capture file"""
+        return self._path
+
+    def write(self, process: CommandResult) -> None:
+        """
+        Record the result of a command.
+        """
+        self._logger.info(
+            '%s\nreturn code: %s, attempts: %s, timed out: %s, '
+            'cancelled: %s\nstdout:\n%s\nstderr:\n%s',
+            ' '.join(str(arg) for arg in process.args), process.returncode,
+            process.attempts, process.timed_out, process.cancelled,
+            process.stdout, process.stderr
+        )
@@ -0,0 +1,257 @@
+from __future__ import annotations
+from collections.abc import Iterator
+from typing import NamedTuple, Optional, Union
+import re
+
+# A line of 'devices' or 'paired-devices' output,
+# Device <device_address> <friendly_name>
+_DEVICE = re.compile(r'^Device ([0-9A-Fa-f:]{17}) ?(.*)$', re.MULTILINE)
+# A line of 'list' output, Controller <address> <name> [default]
+_CONTROLLER = re.compile(
+    r'^Controller ([0-9A-Fa-f:]{17}) ?(.*?)( \[default\])?[ \t]*$',
+    re.MULTILINE
+)
+# The first line of 'info' output, Device <device_address> (<type>)
+_INFO_DEVICE = re.compile(r'^Device ([0-9A-Fa-f:]{17})', re.MULTILINE)
+# A property line of 'info' output, <property>: <value>. Properties are
+# indented by a tab, which a session strips from its output.
+_INFO_PROPERTY = re.compile(r'^[ \t]*([A-Za-z][A-Za-z ]*): (.*)$',
+                            re.MULTILINE)
+# The numeric part of a value such as '0xffffffc2 (-62)'
+_BRACKETED = re.compile(r'\((-?\d+)\)')
+# The UUID in a value such as 'Audio Sink (0000110b-0000-1000-...)'
+_UUID = re.compile(r'\(([0-9A-Fa-f-]{36})\)')
+
+
+class Device:
+    """A device listed by bluetoothctl."""
+
+    __slots__ = ('address', 'name')
+
+    def __init__(self, address: str, name: str) -> None:
+        self.address = address
+        self.name = name
+
+    def __repr__(self) -> str:
+        return f'Device({self.address!r}, {self.name!r})'
+
+
+class DeviceIndex:
+    """
+    Devices indexed by address, with a secondary index by name.
+
+    Several devices may share a name, so the name index maps to lists.
+    """
+
+    __slots__ = ('by_address', 'by_name')
+
+    def __init__(self) -> None:
+        self.by_address: dict[str, Device] = {}
+        self.by_name: dict[str, list[Device]] = {}
+
+    def add(self, device: Device) -> None:
+        """Add a device, replacing any device with the same address."""
+        previous = self.by_address.get(device.address)
+        if previous is not None:
+            self.by_name[previous.name].remove(previous)
+            if not self.by_name[previous.name]:
+                del self.by_name[previous.name]
+
+        self.by_address[device.address] = device
+        self.by_name.setdefault(device.name, []).append(device)
+
+    def discard(self, address: str) -> None:
+        """Remove the device with an address, if present."""
+        device = self.by_address.pop(address, None)
+        if device is not None:
+            self.by_name[device.name].remove(device)
+            if not self.by_name[device.name]:
+                del self.by_name[device.name]
+
+    def get(self, address: str) -> Optional[Device]:
+        """Return the device with an address."""
+        return self.by_address.get(address)
+
+    def named(self, name: str) -> list[Device]:
+        """Return all devices with a name."""
+        return self.by_name.get(name, [])
+
+    def __iter__(self) -> Iterator[Device]:
+        return iter(self.by_address.values())
+
+    def __len__(self) -> int:
+        return len(self.by_address)
+
+    def __contains__(self, address: object) -> bool:
+        return address in self.by_address
+
+
+class Adapter(NamedTuple):
+    """A Bluetooth controller listed by bluetoothctl."""
+    address: str
+    name: str = ''
+    # Whether commands target this controller unless told otherwise
+    default: bool = False
+
+
+class DeviceInfo:
+    """Properties of a device from bluetoothctl `info` output."""
+
+    __slots__ = ('address', 'name', 'alias', 'device_class', 'icon',
+                 'paired', 'trusted', 'blocked', 'connected', 'rssi',
+                 'battery', 'uuids')
+
+    def __init__(self, address: str = '') -> None:
+        self.address = address
+        self.name: Optional[str] = None
+        self.alias: Optional[str] = None
+        self.device_class: Optional[int] = None
+        self.icon: Optional[str] = None
+        self.paired = False
+        self.trusted = False
+        self.blocked = False
+        self.connected = False
+        self.rssi: Optional[int] = None
+        self.battery: Optional[int] = None
+        self.uuids: list[str] = []
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{slot}={getattr(self, slot)!r}'
+                           for slot in self.__slots__)
+        return f'DeviceInfo({fields})'
+
+
+class ParsedOutput(str):
+    """
+    Command output which carries what it describes, for backends which build
+    it directly rather than print it, such as the D-Bus backend. The parse
+    functions return what it carries instead of parsing the text.
+
+    Only the text outlives caching or being sent to another process, where
+    the output is parsed as usual.
+    """
+
+    parsed: Union[DeviceIndex, DeviceInfo, list[Adapter]]
+
+    def __new__(
+        cls, text: str, parsed: Union[DeviceIndex, DeviceInfo, list[Adapter]]
+    ) -> ParsedOutput:
+        output = super().__new__(cls, text)
+        output.parsed = parsed
+        return output
+
+
+def parse_devices(stdout: str) -> DeviceIndex:
+    """
+    Identify devices from bluetoothctl `devices` or `paired-devices` output.
+
+    Lines which do not describe a device are ignored. Devices without a name
+    are named by their address.
+
+    Returns: DeviceIndex of the devices.
+    """
+    if isinstance(stdout, ParsedOutput) and isinstance(stdout.parsed,
+                                                       DeviceIndex):
+        return stdout.parsed
+
+    index = DeviceIndex()
+    by_address = index.by_address
+    for address, name in _DEVICE.findall(stdout):
+        address = address.upper()
+        by_address[address] = Device(address, name.rstrip() or address)
+
+    # Build the name index in one pass once duplicate addresses are resolved
+    by_name = index.by_name
+    for device in by_address.values():
+        named = by_name.get(device.name)
+        if named is None:
+            by_name[device.name] = [device]
+        else:
+            named.append(device)
+    return index
+
+
+def _number(value: str) -> Optional[int]:
+    """
+    Parse a number printed as decimal, hexadecimal or both, as in '-62',
+    '0x00240414' or '0x64 (100)'.
+    """
+    bracketed = _BRACKETED.search(value)
+    try:
+        if bracketed is not None:
+            return int(bracketed.group(1))
+        return int(value.split()[0], 0)
+    except (ValueError, IndexError):
+        return None
+
+
+def set_property(info: DeviceInfo, key: str, value: str) -> bool:
+    """
+    Set a device property from its bluetoothctl representation, as printed by
+    `info` or in a change event such as '[CHG] Device ... Connected: yes'.
+
+    key: Property name, for example 'Connected'.
+    value: Property value, for example 'yes'.
+
+    Returns: Whether the property is one DeviceInfo holds.
+    """
+    if key == 'UUID':
+        uuid = _UUID.search(value)
+        info.uuids.append(uuid.group(1) if uuid is not None else value)
+    elif key == 'Name':
+        info.name = value
+    elif key == 'Alias':
+        info.alias = value
+    elif key == 'Class':
+        info.device_class = _number(value)
+    elif key == 'Icon':
+        info.icon = value
+    elif key == 'Paired':
+        info.paired = value == 'yes'
+    elif key == 'Trusted':
+        info.trusted = value == 'yes'
+    elif key == 'Blocked':
+        info.blocked = value == 'yes'
+    elif key == 'Connected':
+        info.connected = value == 'yes'
+    elif key == 'RSSI':
+        info.rssi = _number(value)
+    elif key == 'Battery Percentage':
+        info.battery = _number(value)
+    else:
+        return False
+    return True
+
+
+def parse_adapters(stdout: str) -> list[Adapter]:
+    """
+    Identify controllers from bluetoothctl `list` output.
+
+    Returns: List of the controllers, in the order listed.
+    """
+    if isinstance(stdout, ParsedOutput) and isinstance(stdout.parsed, list):
+        return stdout.parsed
+    return [Adapter(address.upper(), name, bool(default))
+            for address, name, default in _CONTROLLER.findall(stdout)]
+
+
+def parse_info(stdout: str) -> DeviceInfo:
+    """
+    Identify device properties from bluetoothctl `info` output.
+
+    Returns: DeviceInfo of the device.
+    """
+    if isinstance(stdout, ParsedOutput) and isinstance(stdout.parsed,
+                                                       DeviceInfo):
+        return stdout.parsed
+
+    device = _INFO_DEVICE.search(stdout)
+    info = DeviceInfo(device.group(1).upper() if device is not None else '')
+
+    # Only lines after the header are properties, lines before it are
+    # messages such as 'Attempting to ...'
+    properties = stdout if device is None else stdout[device.end():]
+    for key, value in _INFO_PROPERTY.findall(properties):
+        set_property(info, key, value.rstrip())
+
+    return info
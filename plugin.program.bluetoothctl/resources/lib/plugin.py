@@ -1,9 +1,13 @@
+from contextlib import contextmanager
 import sys
-from typing import Any, Callable, Optional, Dict
+from typing import Any, Callable, Iterator, Optional, Dict, List, Tuple
 import urllib.parse
 import xbmc  # type: ignore
 import xbmcaddon  # type: ignore
 import xbmcgui  # type: ignore
+import xbmcplugin  # type: ignore
+import xbmcvfs  # type: ignore
+from .timing import Recorder
 
 
 class PluginException(Exception):
@@ -40,17 +44,32 @@ class Plugin:
         # Extract information from arguments
         self._base_url = sys.argv[0]
         self._handle = int(sys.argv[1])
-        self._params = urllib.parse.parse_qs(sys.argv[2][1:])
+        # Take only the first instance of a variable defined multiple times
+        self._params = {
+            key: value[0] for key, value in
+            urllib.parse.parse_qs(sys.argv[2][1:]).items()
+        }
 
         # Get Addon instance
         self._addon = xbmcaddon.Addon()
 
+        # Values fetched from Kodi, which do not change during an invocation
+        # unless the settings are changed, see invalidate
+        self._addon_info: Dict[str, str] = {}
+        self._settings: Dict[str, str] = {}
+        self._strings: Dict[int, str] = {}
+        self._debug_enabled: Optional[bool] = None
+        self._art: Optional[Dict[str, str]] = None
+
         # Get Dialog instance
         self._dialog = xbmcgui.Dialog()
 
         # Initialise actions dictionary
         self._actions: Dict[str, Callable[[Dict[str, str]], None]] = {}
 
+        # Timing of this invocation
+        self._recorder = Recorder()
+
     @property
     def handle(self) -> int:
         """
@@ -65,7 +84,7 @@ class Plugin:
 
         Takes only the first instance if a variable if defined multiple times.
         """
-        return {key: value[0] for key, value in self._params.items()}
+        return self._params
 
     @property
     def addon(self) -> xbmcaddon.Addon:
@@ -81,48 +100,119 @@ class Plugin:
         """
         return self._dialog
 
+    @property
+    def recorder(self) -> Recorder:
+        """
+        Return the Recorder timing this invocation.
+        """
+        return self._recorder
+
+    def get_addon_info(self, info_id: str) -> str:
+        """
+        Get addon information, fetched from Kodi once per invocation.
+
+        info_id: Name of the information, for example 'name'.
+        """
+        info = self._addon_info.get(info_id)
+        if info is None:
+            info = self._addon_info[info_id] = self.addon.getAddonInfo(
+                info_id
+            )
+        return info
+
     @property
     def name(self) -> str:
         """
         Return addon name.
         """
-        name: str = self.addon.getAddonInfo('name')
-        return name
+        return self.get_addon_info('name')
 
     @property
     def icon(self) -> str:
         """
         Return path to addon icon.
         """
-        icon: str = self.addon.getAddonInfo('icon')
-        return icon
+        return self.get_addon_info('icon')
+
+    @property
+    def profile(self) -> str:
+        """
+        Return path to the addon profile directory, creating it if needed.
+        """
+        profile = self._addon_info.get('profile_path')
+        if profile is None:
+            profile = xbmcvfs.translatePath(self.get_addon_info('profile'))
+            if not xbmcvfs.exists(profile):
+                xbmcvfs.mkdirs(profile)
+            self._addon_info['profile_path'] = profile
+        return profile
 
     def get_setting(self, setting_id: str) -> str:
         """
-        Get an addon setting.
+        Get an addon setting, fetched from Kodi once per invocation.
 
         setting_id: Name of setting.
         """
-        setting: str = self.addon.getSetting(setting_id)
+        setting = self._settings.get(setting_id)
+        if setting is None:
+            setting = self._settings[setting_id] = self.addon.getSetting(
+                setting_id
+            )
         return setting
 
     def localise(self, string_id: int) -> str:
         """
-        Localise a string.
+        Localise a string, fetched from Kodi once per invocation.
 
         string_id: ID of string
         """
-        string: str = self.addon.getLocalizedString(string_id)
+        string = self._strings.get(string_id)
+        if string is None:
+            string = self._strings[string_id] = self.addon.getLocalizedString(
+                string_id
+            )
         return string
 
-    def log(self, level: int, message: str) -> None:
+    def invalidate(self) -> None:
+        """
+        Forget memoised settings, strings and addon information, for example
+        after the settings have been changed.
+        """
+        # A new Addon instance is needed to see changed settings
+        self._addon = xbmcaddon.Addon()
+        self._addon_info.clear()
+        self._settings.clear()
+        self._strings.clear()
+        self._debug_enabled = None
+        self._art = None
+
+    @property
+    def debug_enabled(self) -> bool:
+        """
+        Return whether Kodi's debug logging is enabled.
+        """
+        if self._debug_enabled is None:
+            self._debug_enabled = bool(xbmc.getCondVisibility(
+                'System.GetBool(debug.showloginfo)'
+            ))
+        return self._debug_enabled
+
+    def log(self, level: int, message: str, *args: Any) -> None:
         """
         Send a message to the Kodi log.
 
+        Debug messages are dropped before formatting when debug logging is
+        disabled.
+
         level: log level.
-        message: log message.
+        message: log message, a %-format string if args are given.
+        args: Values to format into the message.
         """
         assert level in [LOGDEBUG, LOGINFO, LOGWARNING, LOGERROR, LOGFATAL]
+        if level == LOGDEBUG and not self.debug_enabled:
+            return
+        if args:
+            message = message % args
         xbmc.log(f'{self.name}: {message}', level)
 
     def notification(self, message: str,
@@ -154,7 +244,7 @@ class Plugin:
             if name in self._actions.keys():
                 raise PluginException(f'action {name} already registered')
 
-            self.log(LOGDEBUG, f'registering action: {name}')
+            self.log(LOGDEBUG, 'registering action: %s', name)
             self._actions[name] = func
 
             return func
@@ -178,16 +268,29 @@ class Plugin:
         url = ''.join([self._base_url, '?', params])
         return url
 
-    def run(self) -> None:
+    def run(self, startup_budget: Optional[float] = None) -> None:
         """
         Plugin entry point. Calls the appropriate action function based on the
             'action' query string parameter.
+
+        startup_budget: Time (in seconds) from constructing the Plugin to
+            calling the action, above which a warning is logged.
         """
-        self.log(LOGDEBUG, f'entering with parameters {self.params}')
-        self.log(LOGDEBUG, f'actions registered: {self._actions.keys()}')
+        startup = self.recorder.elapsed()
+        if startup_budget is not None and startup > startup_budget:
+            self.log(LOGWARNING, 'startup took %.3fs, over budget of %.3fs',
+                     startup, startup_budget)
+        self.log(LOGDEBUG, 'entering with parameters %s', self.params)
+        self.log(LOGDEBUG, 'actions registered: %s', self._actions.keys())
         action = self.params.get('action', 'root')
+        self.recorder.annotate(action=action, startup=round(startup, 6))
 
-        self._actions[action](self.params)
+        try:
+            with self.recorder.span('action', action):
+                self._actions[action](self.params)
+        finally:
+            # One structured line per invocation, to see where time goes
+            self.log(LOGINFO, f'timing {self.recorder.summary()}')
 
     def list_item(self, label: Optional[str] = None,
                   label2: Optional[str] = None,
@@ -199,7 +302,80 @@ class Plugin:
         label2: label2 to pass to xbmcgui.ListItem.
         path: path to pass to xbmcgui.ListItem.
         """
-        list_item = xbmcgui.ListItem(label, label2, path)
-        list_item.setArt({'icon': self.icon})
+        list_item = xbmcgui.ListItem(label, label2, path, offscreen=True)
+        list_item.setArt(self.art)
+
+        return list_item
+
+    @property
+    def art(self) -> Dict[str, str]:
+        """
+        Return the art shared by all list items.
+        """
+        if self._art is None:
+            self._art = {'icon': self.icon}
+        return self._art
+
+    @contextmanager
+    def listing(self, content: Optional[str] = None,
+                sort_methods: Tuple[int, ...] = (),
+                cache_to_disc: bool = True) -> Iterator['Listing']:
+        """
+        Build a directory listing, which is sent to Kodi in one call when the
+        block exits. If the block raises, the directory is ended as failed.
+
+        content: Content type of the directory, for example 'files'.
+        sort_methods: xbmcplugin.SORT_METHOD_* values offered to the user, the
+            first is the default.
+        cache_to_disc: Whether Kodi may cache the listing.
+
+        Yields: The Listing to add items to.
+        """
+        listing = Listing(self)
+        try:
+            yield listing
+        except BaseException:
+            xbmcplugin.endOfDirectory(self.handle, succeeded=False)
+            raise
+
+        if content is not None:
+            xbmcplugin.setContent(self.handle, content)
+        for sort_method in sort_methods:
+            xbmcplugin.addSortMethod(self.handle, sort_method)
+        xbmcplugin.addDirectoryItems(self.handle, listing.items,
+                                     len(listing.items))
+        xbmcplugin.endOfDirectory(self.handle, cacheToDisc=cache_to_disc)
+
+
+class Listing:
+    """
+    Directory items collected to be added to a directory together.
+    """
+
+    def __init__(self, plugin: Plugin) -> None:
+        """
+        Construct a Listing instance.
+
+        plugin: Plugin creating the list items.
+        """
+        self._plugin = plugin
+        self.items: List[Tuple[str, xbmcgui.ListItem, bool]] = []
 
+    def add(self, url: str, label: str, label2: Optional[str] = None,
+            is_folder: bool = False) -> xbmcgui.ListItem:
+        """
+        Add an item.
+
+        url: URL the item opens.
+        label: label of the item.
+        label2: label2 of the item.
+        is_folder: Whether the item opens a directory.
+
+        Returns: The list item, for further properties to be set.
+        """
+        list_item = self._plugin.list_item(label, label2)
+        self.items.append((url, list_item, is_folder))
         return list_item
+
+    def __len__(self) -> int:
+        return len(self.items)
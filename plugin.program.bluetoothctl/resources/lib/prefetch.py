@@ -0,0 +1,168 @@
+from __future__ import annotations
+from typing import Any, Callable, Optional
+import json
+import os
+import subprocess
+import time
+from .bluetoothctl import Bluetoothctl, DiscoveryFilter
+from .coordination import Coordinator
+from .result import wait
+
+# Name of the prefetch state file in the addon profile directory
+PREFETCH_NAME = 'scan.json'
+
+# Starts bluetoothctl in the background, given the executable and the scan
+# time, then exits
+_UNFILTERED = '"$1" --timeout "$2" scan on &'
+# As _UNFILTERED, for a filtered scan, or one on a particular controller,
+# whose commands follow the scan time. The filter only lasts as long as the
+# bluetoothctl process setting it, and a controller is only selected
+# interactively, so the commands are written to an interactive process,
+# which is told to stop once the scan time has passed.
+_FILTERED = ('exe=$1 seconds=$2; shift 2; '
+             '{ printf "%s\n" "$@" "scan on"; sleep "$seconds"; '
+             'printf "scan off\nquit\n"; } | "$exe" &')
+
+
+class ScanPrefetch:
+    """
+    A scan started ahead of need, which outlives the invocation starting it.
+
+    The scan is run by a detached bluetoothctl process. BlueZ remembers the
+    devices it finds, so a later invocation listing devices sees them
+    without scanning itself. When the scan started and when it will finish
+    are recorded in a shared state file.
+    """
+
+    def __init__(self, path: str, executable: str, scan_timeout: int,
+                 max_age: float = 60,
+                 coordinator: Optional[Coordinator] = None,
+                 discovery_filter: DiscoveryFilter = DiscoveryFilter(),
+                 adapter: Optional[str] = None) -> None:
+        """
+        Construct a ScanPrefetch instance.
+
+        path: Path to the state file.
+        executable: Path to the bluetoothctl executable on the host.
+        scan_timeout: Time (in seconds) to scan for.
+        max_age: Time (in seconds) after a scan finishes for which its
+            results are fresh.
+        coordinator: Coordinator whose scan lock the scan holds, so that
+            other scans wait for it.
+        discovery_filter: Which devices the scan reports.
+        adapter: Address of the controller to scan with, by default the
+            default controller.
+        """
+        self._path = path
+        self._executable = executable
+        self.scan_timeout = scan_timeout
+        self.max_age = max_age
+        self.coordinator = coordinator
+        self.discovery_filter = discovery_filter
+        self.adapter = adapter
+
+    @property
+    def path(self) -> str:
+        """Return the path to the state file"""
+        return self._path
+
+    @property
+    def _lock_name(self) -> str:
+        """Return the name of the lock held by the scan"""
+        return Bluetoothctl._lock_name(['scan'], self.adapter)
+
+    def _finished(self) -> float:
+        """Return when the last prefetch scan finishes, or 0 if none has"""
+        return float(self._state().get('finished', 0))
+
+    def _state(self) -> dict[str, Any]:
+        try:
+            with open(self.path, encoding='utf8') as state_file:
+                state: dict[str, Any] = json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+        return state
+
+    def running(self) -> bool:
+        """Return whether a prefetch scan is in progress"""
+        return time.time() < self._finished()
+
+    def fresh(self) -> bool:
+        """
+        Return whether a prefetch scan is in progress or finished recently
+        """
+        return time.time() <= self._finished() + self.max_age
+
+    def start(self) -> bool:
+        """
+        Start a prefetch scan, unless one is in progress or fresh, or another
+        scan holds the scan lock.
+
+        Returns: Whether a scan was started.
+        """
+        if self.fresh():
+            return False
+        if not os.access(self._executable, os.X_OK):
+            return False
+
+        lock = None
+        if self.coordinator is not None:
+            lock = self.coordinator.try_hold(self._lock_name)
+            if lock is None:
+                return False
+
+        if self.discovery_filter.empty and self.adapter is None:
+            script, commands = _UNFILTERED, []
+        else:
+            script, commands = _FILTERED, Bluetoothctl._scan_script(
+                self.discovery_filter, self.adapter
+            )
+        try:
+            # The shell starts bluetoothctl in the background and exits at
+            # once, so the scan is adopted by init rather than left for Kodi
+            # to reap. bluetoothctl inherits, and holds, the scan lock.
+            shell = subprocess.Popen(
+                ['/bin/sh', '-c', script, 'sh', self._executable,
+                 str(self.scan_timeout), *commands],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, start_new_session=True,
+                pass_fds=() if lock is None else (lock,)
+            )
+            shell.wait()
+        except OSError:
+            return False
+        finally:
+            if lock is not None:
+                os.close(lock)
+
+        started = time.time()
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'w', encoding='utf8') as state_file:
+                json.dump({'started': started,
+                           'finished': started + self.scan_timeout},
+                          state_file)
+            os.replace(temporary, self.path)
+        except OSError:
+            pass
+        return True
+
+    def wait(self, cancel: Optional[Callable[[], bool]] = None) -> bool:
+        """
+        Wait for a prefetch scan in progress to finish.
+
+        cancel: Function returning True to stop waiting.
+
+        Returns: Whether fresh prefetched results are available.
+        """
+        if self.running():
+            if self.coordinator is not None:
+                with self.coordinator.exclusive(self._lock_name,
+                                                cancel) as acquired:
+                    if not acquired:
+                        return False
+            else:
+                remaining = self._finished() - time.time()
+                if wait(remaining, cancel):
+                    return False
+        return self.fresh()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+import random
+import time
+from .bluetoothctl import Bluetoothctl
+from .fetch import fetch_info
+from .result import CommandResult, RetryPolicy, wait
+
+# Delays between connection attempts to a device. Devices out of range, or
+# still waking, may take several attempts.
+RECONNECT_POLICY = RetryPolicy(attempts=10, backoff=1, factor=2,
+                               max_backoff=15, jitter=0.5)
+
+
+class Reconnector:
+    """
+    Reconnect trusted devices, for example after Kodi starts or the system
+    wakes.
+
+    Every trusted, disconnected device is connected concurrently. Each device
+    is retried on its own schedule, with exponential backoff and jitter, until
+    it connects, runs out of attempts or the time limit passes.
+    """
+
+    def __init__(self, bt: Bluetoothctl,
+                 policy: RetryPolicy = RECONNECT_POLICY,
+                 timeout: float = 60, max_workers: int = 4,
+                 is_connected: Optional[Callable[[str], bool]] = None,
+                 log: Optional[Callable[[str], None]] = None) -> None:
+        """
+        Construct a Reconnector instance.
+
+        bt: Backend to connect with. Commands run concurrently, so it should
+            not be in a session, which would run them one at a time. Its
+            retry policy is set aside while reconnecting.
+        policy: Number of attempts per device and the delays between them.
+        timeout: Time (in seconds) after which to stop trying.
+        max_workers: Maximum number of devices to connect at once.
+        is_connected: Function returning whether a device is connected, for
+            example from live events, checked before each attempt so that
+            devices which connect by themselves are left alone.
+        log: Function to send debug messages to.
+        """
+        self.bt = bt
+        self.policy = policy
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.is_connected = is_connected
+        self._log = log
+
+    def trusted(self) -> list[str]:
+        """
+        Return the addresses of paired devices which are trusted but not
+        connected.
+        """
+        process = self.bt.get_paired_devices()
+        if process.returncode != 0:
+            return []
+        addresses = self.bt.parse_devices(process.stdout).by_address
+        trusted = []
+        for address, info_process in fetch_info(
+            self.bt, addresses, max_workers=self.max_workers
+        ).items():
+            if info_process.returncode != 0:
+                continue
+            info = self.bt.parse_info(info_process.stdout)
+            if info.trusted and not info.connected:
+                trusted.append(address)
+        return trusted
+
+    def run(self, cancel: Optional[Callable[[], bool]] = None
+            ) -> dict[str, Optional[CommandResult]]:
+        """
+        Reconnect all trusted, disconnected devices.
+
+        cancel: Function returning True to stop, for example when Kodi exits.
+
+        Returns: Dict of device_address: result of the last connection
+            attempt, or None if none was made because the device was
+            connected already or reconnection was cancelled.
+        """
+        addresses = self.trusted()
+        if not addresses:
+            return {}
+        self._debug(f'reconnecting {", ".join(addresses)}')
+
+        deadline = time.monotonic() + self.timeout
+        previous_cancel, previous_retry = self.bt.cancel, self.bt.retry
+        self.bt.cancel = cancel
+        # The policy spaces out the connection attempts, retries in the
+        # backend would multiply them
+        self.bt.retry = RetryPolicy(attempts=1)
+        try:
+            workers = max(1, min(self.max_workers, len(addresses)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(
+                    lambda address: self._reconnect(address, deadline,
+                                                    cancel),
+                    addresses
+                )
+                return dict(zip(addresses, results))
+        finally:
+            self.bt.cancel = previous_cancel
+            self.bt.retry = previous_retry
+
+    def _reconnect(self, address: str, deadline: float,
+                   cancel: Optional[Callable[[], bool]]
+                   ) -> Optional[CommandResult]:
+        """
+        Connect to a device, retrying until it connects or time runs out.
+        """
+        # Spread the first attempts so that devices do not all start at once
+        if wait(random.uniform(0, self.policy.backoff * self.policy.jitter),
+                cancel):
+            return None
+
+        result = None
+        for attempt in range(1, self.policy.attempts + 1):
+            if self.is_connected is not None and self.is_connected(address):
+                self._debug(f'{address} connected by itself')
+                return result
+
+            result = self.bt.connect(address)
+            if result.returncode == 0:
+                self._debug(f'{address} reconnected after {attempt} '
+                            'attempts')
+                return result
+
+            delay = self.policy.delay(attempt)
+            if time.monotonic() + delay >= deadline or result.cancelled:
+                break
+            if wait(delay, cancel):
+                break
+
+        self._debug(f'{address} not reconnected')
+        return result
+
+    def _debug(self, message: str) -> None:
+        if self._log is not None:
+            self._log(message)
@@ -0,0 +1,168 @@
+from __future__ import annotations
+from subprocess import CompletedProcess
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple, Optional
+import random
+import re
+import time
+
+if TYPE_CHECKING:
+    _CompletedProcess = CompletedProcess[str]
+else:
+    _CompletedProcess = CompletedProcess
+
+# Output of failures which are likely to succeed if the command is repeated
+_TRANSIENT = re.compile(
+    r'org\.bluez\.Error\.(?:InProgress|Busy|NotReady)'
+    r'|Operation already in progress|Resource temporarily unavailable'
+)
+
+
+class CommandResult(_CompletedProcess):
+    """
+    The result of a bluetoothctl command, with how it was run.
+
+    A CompletedProcess which also records whether the command was stopped at
+    its deadline or cancelled, and how many attempts it took.
+    """
+
+    def __init__(self, args: Any, returncode: int,
+                 stdout: Optional[str] = None, stderr: Optional[str] = None,
+                 timed_out: bool = False, cancelled: bool = False,
+                 attempts: int = 1) -> None:
+        """
+        Construct a CommandResult instance.
+
+        args: The command run.
+        returncode: Exit status of the command.
+        stdout: Output of the command.
+        stderr: Error output of the command.
+        timed_out: Whether the command was stopped at its deadline.
+        cancelled: Whether the command was stopped by the user.
+        attempts: Number of times the command was run.
+        """
+        super().__init__(args, returncode, stdout, stderr)
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.attempts = attempts
+
+    @property
+    def retries(self) -> int:
+        """Return the number of times the command was repeated"""
+        return self.attempts - 1
+
+    @property
+    def transient(self) -> bool:
+        """Return whether the command failed in a way worth retrying"""
+        return (self.returncode != 0
+                and not self.timed_out and not self.cancelled
+                and _TRANSIENT.search(f'{self.stdout}{self.stderr}')
+                is not None)
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the result's fields, to be passed back to the constructor"""
+        return {
+            'args': self.args,
+            'returncode': self.returncode,
+            'stdout': self.stdout,
+            'stderr': self.stderr,
+            'timed_out': self.timed_out,
+            'cancelled': self.cancelled,
+            'attempts': self.attempts,
+        }
+
+    def __repr__(self) -> str:
+        return (f'{super().__repr__()[:-1]}, timed_out={self.timed_out!r}, '
+                f'cancelled={self.cancelled!r}, attempts={self.attempts!r})')
+
+
+class PipelineResult(CommandResult):
+    """
+    The combined result of bluetoothctl commands run one after another,
+    stopping at the first failure.
+
+    Output is that of every step run, in order. The return code, and whether
+    the pipeline timed out or was cancelled, are those of the last step.
+    """
+
+    def __init__(self, args: Any,
+                 steps: list[tuple[str, CommandResult]]) -> None:
+        """
+        Construct a PipelineResult instance.
+
+        args: The pipeline run.
+        steps: List of (step name, result) of each step run.
+        """
+        last = steps[-1][1] if steps else CommandResult(args, 0, '', '')
+        super().__init__(
+            args, last.returncode,
+            ''.join(process.stdout or '' for _, process in steps),
+            ''.join(process.stderr or '' for _, process in steps),
+            timed_out=last.timed_out, cancelled=last.cancelled,
+            attempts=1 + sum(process.retries for _, process in steps)
+        )
+        self.steps = steps
+
+    @property
+    def failed(self) -> Optional[str]:
+        """Return the name of the step which failed, if one did"""
+        if not self.steps or self.returncode == 0:
+            return None
+        return self.steps[-1][0]
+
+
+class RetryPolicy(NamedTuple):
+    """
+    How often, and how soon, to repeat commands which failed transiently, for
+    example with org.bluez.Error.InProgress.
+    """
+    # Total number of times to run a command, 1 disables retries
+    attempts: int = 3
+    # Delay (in seconds) before the first retry
+    backoff: float = 0.5
+    # Factor by which the delay grows with each retry
+    factor: float = 2
+    # Longest delay (in seconds) between retries
+    max_backoff: float = 4
+    # Fraction of each delay which is random, so that commands failing
+    # together do not all retry together
+    jitter: float = 0
+
+    def delay(self, attempt: int) -> float:
+        """
+        Return the time (in seconds) to wait after a failed attempt.
+
+        attempt: Number of the failed attempt, starting at 1.
+        """
+        delay = min(self.max_backoff,
+                    self.backoff * self.factor ** (attempt - 1))
+        return float(delay * (1 - self.jitter * random.random()))
+
+    def should_retry(self, process: CommandResult, attempts: int) -> bool:
+        """
+        Return whether to repeat a command after an attempt.
+
+        process: Result of the attempt.
+        attempts: Number of attempts made so far.
+        """
+        return process.transient and attempts < self.attempts
+
+
+def wait(delay: float, cancel: Optional[Callable[[], bool]] = None,
+         poll: float = 0.1) -> bool:
+    """
+    Sleep, waking early if cancelled.
+
+    delay: Time (in seconds) to sleep for.
+    cancel: Function returning True to stop waiting.
+    poll: Interval (in seconds) at which to check for cancellation.
+
+    Returns: Whether the wait was cancelled.
+    """
+    deadline = time.monotonic() + delay
+    while True:
+        if cancel is not None and cancel():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(poll, remaining))
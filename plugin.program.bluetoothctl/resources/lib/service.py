@@ -0,0 +1,349 @@
+from __future__ import annotations
+from contextlib import ExitStack
+from typing import Optional
+import os
+import threading
+import xbmc  # type: ignore
+import xbmcaddon  # type: ignore
+import xbmcgui  # type: ignore
+import xbmcvfs  # type: ignore
+from .backend import create_backend
+from .bluetoothctl import Bluetoothctl
+from .cache import DeviceCache
+from .coordination import LOCK_DIRECTORY, Coordinator
+from .events import EventMonitor
+from .history import HISTORY_NAME, DeviceHistory
+from .ipc import SOCKET_NAME, ServiceRunning, ServiceServer
+from .parser import DeviceInfo
+from .reconnect import Reconnector
+
+# Window whose properties device state is published to, for skins and other
+# addons to read as Window(Home).Property(Bluetoothctl.Connected.Name)
+HOME_WINDOW = 10000
+PROPERTY_PREFIX = 'Bluetoothctl.'
+
+
+class Service(xbmc.Monitor):  # type: ignore
+    """
+    Long-running service owning the Bluetooth state.
+
+    Holds a backend with a persistent bluetoothctl session for queries, and
+    keeps the device lists in memory. Plugin invocations query it over a
+    Unix socket instead of starting bluetoothctl themselves. Commands
+    changing device state, and scans, run alongside in their own processes.
+
+    Device events are followed as they happen and the state of connected
+    devices is published as Home window properties.
+
+    Trusted devices are reconnected when Kodi starts and when the system
+    wakes.
+    """
+
+    def __init__(self) -> None:
+        """
+        Construct a Service instance.
+        """
+        super().__init__()
+        self._addon = xbmcaddon.Addon()
+        self._server: Optional[ServiceServer] = None
+        self._bt: Optional[Bluetoothctl] = None
+        self._resources = ExitStack()
+        self._name: Optional[str] = None
+        self._monitor: Optional[EventMonitor] = None
+        self._window = xbmcgui.Window(HOME_WINDOW)
+        # Published property values, so that only changes are written
+        self._properties: dict[str, str] = {}
+        self._publish_lock = threading.Lock()
+        self._reconnecting: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @property
+    def name(self) -> str:
+        """
+        Return addon name.
+        """
+        if self._name is None:
+            self._name = self._addon.getAddonInfo('name')
+        return self._name
+
+    @property
+    def profile(self) -> str:
+        """
+        Return path to the addon profile directory, creating it if needed.
+        """
+        profile: str = xbmcvfs.translatePath(
+            self._addon.getAddonInfo('profile')
+        )
+        if not xbmcvfs.exists(profile):
+            xbmcvfs.mkdirs(profile)
+        return profile
+
+    @property
+    def socket_path(self) -> str:
+        """
+        Return path to the service socket.
+        """
+        return os.path.join(self.profile, SOCKET_NAME)
+
+    def coordinator(self) -> Coordinator:
+        """
+        Construct a Coordinator for commands the service runs, shared with
+        plugin invocations running commands directly.
+        """
+        return Coordinator(os.path.join(self.profile, LOCK_DIRECTORY))
+
+    def history(self) -> Optional[DeviceHistory]:
+        """
+        Construct the history of each device for commands the service runs,
+        shared with plugin invocations, or None if the history is disabled.
+        """
+        if self._addon.getSetting('history_enabled') != 'true':
+            return None
+        return DeviceHistory(
+            os.path.join(self.profile, HISTORY_NAME),
+            adaptive_timeouts=(
+                self._addon.getSetting('adaptive_timeouts') == 'true'
+            ),
+            log=lambda message: self.log(xbmc.LOGDEBUG, message)
+        )
+
+    @property
+    def refresh_interval(self) -> int:
+        """
+        Return the time (in seconds) between refreshes of the device lists.
+        """
+        return max(1, int(self._addon.getSetting('service_refresh_interval')))
+
+    def log(self, level: int, message: str) -> None:
+        """
+        Send a message to the Kodi log.
+
+        level: log level.
+        message: log message.
+        """
+        xbmc.log(f'{self.name} service: {message}', level)
+
+    def run(self) -> None:
+        """
+        Service entry point. Serves requests until Kodi exits.
+        """
+        self.start()
+        self.reconnect()
+        try:
+            while not self.abortRequested():
+                self.refresh()
+                if self.waitForAbort(self.refresh_interval):
+                    break
+        finally:
+            self.stop()
+
+    def start(self) -> None:
+        """
+        Create the backend and start serving, if the service is enabled.
+        """
+        if self._addon.getSetting('service_enabled') != 'true':
+            self.log(xbmc.LOGINFO, 'disabled')
+            return
+        self._stopping.clear()
+
+        # Device state is held in memory, kept fresh by refresh
+        cache = DeviceCache(None, ttl=2 * self.refresh_interval)
+        bt = create_backend(self._addon.getSetting, cache=cache)
+        bt.coordinator = self.coordinator()
+        # Commands forwarded by plugin invocations are recorded here, where
+        # they run
+        bt.history = self.history()
+        if bt.history is not None:
+            self._resources.callback(bt.history.close)
+        self._resources.enter_context(bt.session())
+        self._bt = bt
+
+        # Commands changing device state, and scans, run outside the
+        # session, so that they do not hold up queries
+        actions = create_backend(self._addon.getSetting, cache=cache)
+        actions.coordinator = bt.coordinator
+        actions.history = bt.history
+
+        server = ServiceServer(self.socket_path, bt, actions)
+        try:
+            server.start()
+        except ServiceRunning as exc:
+            self.log(xbmc.LOGWARNING, str(exc))
+        else:
+            self._server = server
+            self.log(xbmc.LOGINFO, f'listening on {self.socket_path}')
+
+        if self._addon.getSetting('events_enabled') == 'true':
+            self._monitor = EventMonitor(
+                self._addon.getSetting('bluetoothctl_path'),
+                on_change=self.on_device_change
+            )
+            self.start_monitor()
+
+    def stop(self) -> None:
+        """
+        Stop serving and close the backend.
+        """
+        self._stopping.set()
+        if self._reconnecting is not None:
+            # Commands stop soon after being cancelled
+            self._reconnecting.join(timeout=5)
+            self._reconnecting = None
+        if self._monitor is not None:
+            self._monitor.stop()
+            self._monitor = None
+            self.publish([])
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        self._resources.close()
+        self._bt = None
+
+    def reconnect(self) -> None:
+        """
+        Reconnect trusted devices in the background, unless reconnection is
+        disabled or already under way.
+        """
+        if (self._bt is None
+                or self._addon.getSetting('reconnect_enabled') != 'true'
+                or (self._reconnecting is not None
+                    and self._reconnecting.is_alive())):
+            return
+
+        # A separate backend, outside the service's session, so that devices
+        # are connected concurrently
+        bt = create_backend(self._addon.getSetting)
+        bt.coordinator = self.coordinator()
+        # Reconnection attempts count towards each device's reliability
+        bt.history = self.history()
+        reconnector = Reconnector(
+            bt,
+            timeout=int(self._addon.getSetting('reconnect_timeout')),
+            is_connected=self._is_connected,
+            log=lambda message: self.log(xbmc.LOGDEBUG, message)
+        )
+
+        def reconnect() -> None:
+            try:
+                results = reconnector.run(
+                    cancel=lambda: (self._stopping.is_set()
+                                    or self.abortRequested())
+                )
+            finally:
+                if bt.history is not None:
+                    bt.history.close()
+            connected = sum(1 for result in results.values()
+                            if result is not None and result.returncode == 0)
+            self.log(xbmc.LOGINFO,
+                     f'reconnected {connected} of {len(results)} devices')
+
+        self._reconnecting = threading.Thread(target=reconnect, daemon=True)
+        self._reconnecting.start()
+
+    def _is_connected(self, address: str) -> bool:
+        """Return whether live events show a device as connected."""
+        if self._monitor is None:
+            return False
+        info = self._monitor.get(address)
+        return info is not None and info.connected
+
+    def start_monitor(self) -> None:
+        """
+        Start following device events, if not already, seeding the device
+        table with the state of paired devices.
+        """
+        if self._monitor is None or self._monitor.running:
+            return
+        self._monitor.start()
+        self.log(xbmc.LOGDEBUG, 'following device events')
+
+        # Events only report changes, so fetch the current state once
+        if self._bt is None:
+            return
+        from .fetch import fetch_info
+        process = self._bt.get_paired_devices()
+        if process.returncode != 0:
+            return
+        addresses = self._bt.parse_devices(process.stdout).by_address
+        for process in fetch_info(self._bt, addresses).values():
+            if process.returncode == 0:
+                self._monitor.update(self._bt.parse_info(process.stdout))
+
+    def on_device_change(self, info: DeviceInfo) -> None:
+        """
+        Handle a change of a device's state, reported by the event monitor.
+        """
+        # The service's cached information on the device is stale
+        if self._bt is not None and self._bt.cache is not None:
+            self._bt.cache.invalidate(f'info {info.address}')
+        if self._monitor is not None:
+            self.publish(self._monitor.devices())
+
+    def publish(self, devices: list[DeviceInfo]) -> None:
+        """
+        Publish the state of connected devices as Home window properties.
+
+        Connected is 'true' if any device is connected, Connected.Count is the
+        number connected and Connected.Names their names. Connected.Name,
+        .Address, .Battery and .Icon describe the first connected device by
+        name. Properties without a value are cleared.
+        """
+        connected = sorted(
+            (info for info in devices if info.connected),
+            key=lambda info: info.alias or info.name or info.address
+        )
+        names = [info.alias or info.name or info.address
+                 for info in connected]
+        first = connected[0] if connected else None
+        properties = {
+            'Connected': 'true' if connected else '',
+            'Connected.Count': str(len(connected)),
+            'Connected.Names': ', '.join(names),
+            'Connected.Name': names[0] if names else '',
+            'Connected.Address': first.address if first else '',
+            'Connected.Battery': (
+                str(first.battery)
+                if first is not None and first.battery is not None else ''
+            ),
+            'Connected.Icon': (first.icon or '') if first is not None else '',
+        }
+
+        with self._publish_lock:
+            for key, value in properties.items():
+                if self._properties.get(key) == value:
+                    continue
+                if value:
+                    self._window.setProperty(PROPERTY_PREFIX + key, value)
+                else:
+                    self._window.clearProperty(PROPERTY_PREFIX + key)
+                self._properties[key] = value
+
+    def refresh(self) -> None:
+        """
+        Fetch the device lists, replacing the held state.
+        """
+        # Restart following events if bluetoothctl exited
+        self.start_monitor()
+
+        if self._bt is None or self._bt.cache is None:
+            return
+        for prefix in ('devices', 'paired-devices'):
+            self._bt.cache.invalidate(prefix)
+        self._bt.get_devices()
+        self._bt.get_paired_devices()
+
+    def onNotification(self, sender: str, method: str, data: str) -> None:
+        """
+        Reconnect trusted devices when the system wakes.
+        """
+        if method == 'System.OnWake':
+            self.reconnect()
+
+    def onSettingsChanged(self) -> None:
+        """
+        Restart with the new settings.
+        """
+        self._addon = xbmcaddon.Addon()
+        self._name = None
+        self.stop()
+        self.start()
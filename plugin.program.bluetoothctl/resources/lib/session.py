@@ -0,0 +1,327 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import codecs
+import os
+import re
+import subprocess
+import threading
+import time
+from .result import CommandResult, wait
+
+# Remove terminal colour and readline control sequences from output
+_CONTROL = re.compile(r'\x1b\[[0-9;]*[A-Za-z]|[\x01\x02\r]')
+# An interactive prompt, for example '[bluetooth]# ' or '[JBL Flip]# '
+_PROMPT = re.compile(r'\[[^\]\n]*\][#>] ?')
+# A prompt on its own at the end of the output
+_TRAILING_PROMPT = re.compile(r'(?:^|\n)\[[^\]\n]*\][#>] ?$')
+
+# Commands which report their result asynchronously, after the prompt has
+# returned, and the patterns marking that result
+_RESULTS = {
+    'connect': re.compile(r'Connection successful|Failed to connect'),
+    'disconnect': re.compile(r'Successful disconnected|Failed to disconnect'),
+    'pair': re.compile(r'Pairing successful|Failed to pair'),
+    'remove': re.compile(r'Device has been removed|Failed to remove'),
+    'trust': re.compile(r'trust succeeded|Failed to set trusted'),
+    'untrust': re.compile(r'untrust succeeded|Failed to set trusted'),
+}
+
+# Line of output indicating that a command failed
+_FAILURE = re.compile(
+    r'^(?:Failed to|(?:Device|Controller) \S+ not available|Invalid command'
+    r'|Missing .* argument|No default controller available)', re.MULTILINE
+)
+# Output of selecting a controller which does not exist
+_NO_CONTROLLER = re.compile(r'^Controller \S+ not available', re.MULTILINE)
+# Line reporting an event, such as another device changing, rather than the
+# outcome of the command
+_EVENT = re.compile(r'\[(?:CHG|NEW|DEL)\]')
+
+
+class SessionException(Exception):
+    """
+    Exception for BluetoothctlSession class.
+    """
+    pass
+
+
+class BluetoothctlSession:
+    """
+    A persistent, interactive bluetoothctl process.
+
+    Commands are written to the process' stdin and its output is split at each
+    prompt into per-command results, so that consecutive commands do not each
+    pay the cost of starting bluetoothctl and connecting to D-Bus.
+    """
+
+    def __init__(self, executable: str = '/usr/bin/bluetoothctl',
+                 startup_timeout: float = 5) -> None:
+        """
+        Construct a BluetoothctlSession instance. The process is started
+        lazily, when the first command is run.
+
+        executable: Path to the bluetoothctl executable on the host.
+        startup_timeout: Time (in seconds) to wait for the first prompt.
+        """
+        self._executable = executable
+        self._startup_timeout = startup_timeout
+
+        self._process: Optional[subprocess.Popen[bytes]] = None
+        self._reader: Optional[threading.Thread] = None
+        self._buffer = ''
+        # Controller selected in the process, None for the default
+        self._adapter: Optional[str] = None
+        self._condition = threading.Condition()
+        # Only one command may be in flight at a time
+        self._lock = threading.Lock()
+
+    @property
+    def executable(self) -> str:
+        """Return the path to the bluetoothctl executable"""
+        return self._executable
+
+    @property
+    def running(self) -> bool:
+        """Return whether the bluetoothctl process is alive"""
+        return self._process is not None and self._process.poll() is None
+
+    def open(self) -> None:
+        """
+        Start the bluetoothctl process and wait for its first prompt.
+        """
+        if self.running:
+            return
+
+        self._buffer = ''
+        self._adapter = None
+        self._process = subprocess.Popen(
+            [self.executable],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+        if not self._wait(self._prompted, self._startup_timeout):
+            self.close()
+            raise SessionException('bluetoothctl did not present a prompt')
+
+    def close(self) -> None:
+        """
+        Stop the bluetoothctl process.
+        """
+        process = self._process
+        if process is None:
+            return
+        self._process = None
+
+        try:
+            if process.poll() is None and process.stdin is not None:
+                process.stdin.write(b'quit\n')
+                process.stdin.close()
+            process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+        if self._reader is not None:
+            self._reader.join(timeout=1)
+            self._reader = None
+
+    def run(self, command: list[str], duration: Optional[float] = None,
+            timeout: Optional[float] = None,
+            cancel: Optional[Callable[[], bool]] = None,
+            adapter: Optional[str] = None) -> CommandResult:
+        """
+        Run a command in the session.
+
+        If the command does not finish within the timeout, or is cancelled,
+        the process is stopped as its state is unknown. The next command
+        starts a new one.
+
+        command: bluetoothctl command and its arguments.
+        duration: Time (in seconds) to let the command run for before
+            collecting its output, for example for 'scan on'.
+        timeout: Maximum time (in seconds) to wait for the result, after the
+            duration.
+        cancel: Function returning True to stop waiting for the result.
+        adapter: Address of the controller to run the command on, by
+            default the default controller.
+
+        Returns: A CommandResult instance containing the result of the
+            command.
+        """
+        with self._lock:
+            if adapter != self._adapter and adapter is None:
+                # Only a new process returns to the default controller
+                self.close()
+            self.open()
+            if adapter != self._adapter:
+                error = self._select(adapter, cancel)
+                if error is not None:
+                    return CommandResult([self.executable, *command], 1,
+                                         error, '')
+
+            with self._condition:
+                self._buffer = ''
+            self._send(command)
+
+            if duration is not None:
+                wait(duration, cancel)
+                if command == ['scan', 'on']:
+                    self._send(['scan', 'off'])
+
+            result = _RESULTS.get(command[0])
+
+            def complete() -> bool:
+                output = self._command_output(self._buffer, command)
+                if not self._prompted():
+                    return (result is not None
+                            and result.search(output) is not None)
+                # Commands rejected outright never print an async result
+                return (result is None
+                        or result.search(output) is not None
+                        or _FAILURE.search(output) is not None)
+
+            finished = self._wait(complete, timeout, cancel)
+            with self._condition:
+                output = self._buffer
+                self._buffer = ''
+            if not finished:
+                self.close()
+
+        args = [self.executable, *command]
+        stdout = self._clean(output, command)
+        if not finished:
+            cancelled = cancel is not None and cancel()
+            return CommandResult(
+                args, 1, stdout,
+                'cancelled' if cancelled
+                else 'timed out waiting for bluetoothctl',
+                timed_out=not cancelled, cancelled=cancelled
+            )
+
+        failed = _FAILURE.search(self._command_output(output, command))
+        returncode = 1 if failed is not None else 0
+        return CommandResult(args, returncode, stdout, '')
+
+    def _select(self, adapter: Optional[str],
+                cancel: Optional[Callable[[], bool]] = None
+                ) -> Optional[str]:
+        """
+        Select the controller later commands run on.
+
+        Returns: None once the controller is selected, otherwise the output
+            explaining why it was not.
+        """
+        with self._condition:
+            self._buffer = ''
+        self._send(['select', str(adapter)])
+        if not self._wait(self._prompted, self._startup_timeout, cancel):
+            self.close()
+            return 'timed out selecting controller\n'
+        with self._condition:
+            output = self._clean(self._buffer, ['select', str(adapter)])
+            self._buffer = ''
+        if _NO_CONTROLLER.search(
+            self._command_output(output, ['select', str(adapter)])
+        ) is not None:
+            return output or f'Controller {adapter} not available\n'
+        self._adapter = adapter
+        return None
+
+    def __enter__(self) -> BluetoothctlSession:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def _send(self, command: list[str]) -> None:
+        """Write a command line to the process' stdin."""
+        if self._process is None or self._process.stdin is None:
+            raise SessionException('bluetoothctl session is not open')
+        try:
+            self._process.stdin.write((' '.join(command) + '\n').encode())
+        except OSError as exc:
+            self.close()
+            raise SessionException('bluetoothctl session closed') from exc
+
+    def _read(self) -> None:
+        """Collect the process' output into the buffer (reader thread)."""
+        process = self._process
+        if process is None or process.stdout is None:
+            return
+        fd = process.stdout.fileno()
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+
+        while True:
+            try:
+                chunk = os.read(fd, 4096)
+            except OSError:
+                chunk = b''
+            text = _CONTROL.sub('', decoder.decode(chunk, final=not chunk))
+            with self._condition:
+                self._buffer += text
+                self._condition.notify_all()
+            if not chunk:
+                return
+
+    def _prompted(self) -> bool:
+        """Return whether the output ends at a fresh prompt."""
+        return _TRAILING_PROMPT.search(self._buffer) is not None
+
+    def _wait(self, predicate: Callable[[], bool], timeout: Optional[float],
+              cancel: Optional[Callable[[], bool]] = None,
+              poll: float = 0.1) -> bool:
+        """
+        Wait for a predicate on the buffer to hold, or the process to exit.
+
+        cancel: Function returning True to stop waiting, checked every poll
+            seconds.
+
+        Returns: Whether the predicate held.
+        """
+        if cancel is None:
+            with self._condition:
+                return self._condition.wait_for(
+                    lambda: predicate() or not self.running, timeout
+                ) and predicate()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not (predicate() or not self.running):
+                if cancel():
+                    return False
+                interval = poll
+                if deadline is not None:
+                    interval = min(interval, deadline - time.monotonic())
+                    if interval <= 0:
+                        return False
+                self._condition.wait(interval)
+            return predicate()
+
+    @staticmethod
+    def _command_output(output: str, command: list[str]) -> str:
+        """
+        Return the lines of output printed by the command itself, without
+        events, which may name any device and arrive at any time.
+        """
+        return ''.join(
+            f'{line}\n'
+            for line in BluetoothctlSession._clean(output,
+                                                   command).splitlines()
+            if _EVENT.match(line) is None
+        )
+
+    @staticmethod
+    def _clean(output: str, command: list[str]) -> str:
+        """Remove prompts and the echoed command from the output."""
+        echo = ' '.join(command)
+        lines = []
+        for line in output.split('\n'):
+            line = _PROMPT.sub('', line).strip()
+            if line and line != echo:
+                lines.append(line)
+        return ''.join(f'{line}\n' for line in lines)
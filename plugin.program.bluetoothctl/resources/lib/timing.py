@@ -0,0 +1,119 @@
+from __future__ import annotations
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import Any, Optional
+import json
+import os
+import threading
+import time
+
+
+class Span:
+    """A timed operation, such as an action or a bluetoothctl command."""
+
+    __slots__ = ('name', 'command', 'start', 'duration', 'returncode',
+                 'output_size', 'retries', 'timed_out', 'cancelled')
+
+    def __init__(self, name: str, command: str = '') -> None:
+        self.name = name
+        self.command = command
+        self.start = time.time()
+        self.duration = 0.0
+        self.returncode: Optional[int] = None
+        self.output_size: Optional[int] = None
+        # Only set for commands which were repeated or stopped early
+        self.retries: Optional[int] = None
+        self.timed_out: Optional[bool] = None
+        self.cancelled: Optional[bool] = None
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the span's fields, omitting those which were not set."""
+        span = {slot: getattr(self, slot) for slot in self.__slots__}
+        span['duration'] = round(self.duration, 6)
+        return {key: value for key, value in span.items()
+                if value is not None and value != ''}
+
+
+class Recorder:
+    """
+    Collect timing spans over one invocation.
+
+    Spans may be recorded from several threads.
+    """
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        # Fields describing the whole invocation, such as the action
+        self.fields: dict[str, Any] = {}
+        self._created = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str,
+             command: str = '') -> Generator[Span, None, None]:
+        """
+        Time the enclosed block. The span is recorded even if the block
+        raises.
+
+        name: Kind of operation, for example 'action' or 'command'.
+        command: The specific operation, for example 'connect AA:BB:...'.
+
+        Yields: The Span, so that the block can set its returncode and
+            output_size.
+        """
+        span = Span(name, command)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            with self._lock:
+                self.spans.append(span)
+
+    def annotate(self, **fields: Any) -> None:
+        """
+        Add fields describing the whole invocation to the summary.
+        """
+        self.fields.update(fields)
+
+    def elapsed(self) -> float:
+        """
+        Return the time (in seconds) since the Recorder was created.
+        """
+        return time.perf_counter() - self._created
+
+    def summary(self, **fields: Any) -> str:
+        """
+        Summarise the invocation as a single line of JSON.
+
+        fields: Additional fields to include, beside those annotated.
+        """
+        with self._lock:
+            spans = [span.as_dict() for span in self.spans]
+        summary = dict(
+            self.fields,
+            **fields,
+            total=round(self.elapsed(), 6),
+            spans=spans,
+        )
+        return json.dumps(summary, separators=(',', ':'))
+
+    def append_to(self, path: str, max_bytes: int = 256 * 1024,
+                  **fields: Any) -> None:
+        """
+        Append the summary to a metrics file, one line per invocation.
+
+        When the file grows beyond max_bytes it is moved to path.1, replacing
+        any previous one, and a new file is started.
+
+        fields: Additional fields to include in the summary.
+        """
+        try:
+            if os.path.getsize(path) > max_bytes:
+                os.replace(path, f'{path}.1')
+        except OSError:
+            pass
+
+        with open(path, 'a', encoding='utf8') as metrics_file:
+            metrics_file.write(self.summary(time=time.time(), **fields))
+            metrics_file.write('\n')
@@ -0,0 +1,4 @@
+from resources.lib.service import Service
+
+if __name__ == "__main__":
+    Service().run()
@@ -0,0 +1,57 @@
+"""
+Shared fixtures of the addon's tests.
+
+The tests import the addon's library as Kodi does, from the addon directory,
+and drive the bluetoothctl backends with the fake bluetoothctl used by the
+benchmarks. The benchmarks' stand-ins for the xbmc* modules are used by tests
+of the service.
+"""
+from __future__ import annotations
+from pathlib import Path
+import json
+import os
+import sys
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADDON = os.path.join(HERE, os.pardir, 'plugin.program.bluetoothctl')
+FAKE_BLUETOOTHCTL = os.path.join(HERE, os.pardir, 'benchmarks',
+                                 'fake_bluetoothctl.py')
+STUBS = os.path.join(HERE, os.pardir, 'benchmarks', 'stubs')
+
+sys.path.insert(0, ADDON)
+sys.path.append(STUBS)
+
+
+@pytest.fixture
+def fake_bluetoothctl(monkeypatch: pytest.MonkeyPatch) -> str:
+    """
+    Return the path to the fake bluetoothctl, configured for quick runs with
+    10 devices of which the first 3 are paired and the first is connected.
+    """
+    monkeypatch.setenv('FAKE_BT_LATENCY', '0')
+    monkeypatch.setenv('FAKE_BT_DEVICES', '10')
+    monkeypatch.setenv('FAKE_BT_PAIRED', '3')
+    monkeypatch.setenv('FAKE_BT_FAILURE_RATE', '0')
+    monkeypatch.setenv('FAKE_BT_SCAN_SPREAD', '0.2')
+    monkeypatch.delenv('FAKE_BT_ADAPTERS', raising=False)
+    monkeypatch.delenv('FAKE_BT_LOG', raising=False)
+    return FAKE_BLUETOOTHCTL
+
+
+@pytest.fixture
+def kodi_profile(monkeypatch: pytest.MonkeyPatch, tmp_path: Path,
+                 fake_bluetoothctl: str) -> Path:
+    """
+    Return the addon profile directory of the xbmc* stand-ins, whose settings
+    are the defaults, using the fake bluetoothctl, with events not followed
+    and trusted devices not reconnected.
+    """
+    profile = tmp_path / 'profile'
+    monkeypatch.setenv('BENCH_PROFILE', str(profile))
+    monkeypatch.setenv('BENCH_SETTINGS', json.dumps({
+        'bluetoothctl_path': fake_bluetoothctl,
+        'events_enabled': 'false',
+        'reconnect_enabled': 'false',
+    }))
+    return profile
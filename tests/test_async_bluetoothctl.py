@@ -0,0 +1,123 @@
+from __future__ import annotations
+from pathlib import Path
+import asyncio
+import os
+import time
+import pytest
+from resources.lib.async_bluetoothctl import AsyncBluetoothctl
+from resources.lib.bluetoothctl import Bluetoothctl
+from resources.lib.cache import DeviceCache
+from resources.lib.coordination import Coordinator
+from resources.lib.result import CommandResult
+
+ADDRESSES = ['00:1A:7D:00:00:00', '00:1A:7D:00:00:01', '00:1A:7D:00:00:02']
+
+
+def spawned(log: Path) -> int:
+    """Return the number of bluetoothctl processes started."""
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+
+@pytest.mark.parametrize('coordinated', [False, True])
+def test_gather(tmp_path: Path, fake_bluetoothctl: str,
+                coordinated: bool) -> None:
+    bt = AsyncBluetoothctl(fake_bluetoothctl)
+    if coordinated:
+        bt.coordinator = Coordinator(str(tmp_path / 'locks'))
+
+    async def gather() -> list[CommandResult]:
+        return list(await asyncio.gather(
+            bt.get_paired_devices(), bt.trust(ADDRESSES[1]),
+            *(bt.info(address) for address in ADDRESSES)
+        ))
+
+    paired, trusted, *infos = asyncio.run(gather())
+    assert len(bt.parse_devices(paired.stdout)) == 3
+    assert trusted.returncode == 0
+    assert [bt.parse_info(info.stdout).paired
+            for info in infos] == [True, True, True]
+
+
+def test_cancel_stops_command(monkeypatch: pytest.MonkeyPatch,
+                              fake_bluetoothctl: str) -> None:
+    monkeypatch.setenv('FAKE_BT_LATENCY', '10')
+    bt = AsyncBluetoothctl(fake_bluetoothctl)
+
+    async def cancel() -> None:
+        task = asyncio.ensure_future(bt.connect(ADDRESSES[0]))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await task
+
+    started = time.monotonic()
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel())
+    assert time.monotonic() - started < 5
+
+
+def test_shares_cache_and_coordinator(monkeypatch: pytest.MonkeyPatch,
+                                      tmp_path: Path,
+                                      fake_bluetoothctl: str) -> None:
+    log = tmp_path / 'spawns.log'
+    monkeypatch.setenv('FAKE_BT_LOG', str(log))
+    bt = Bluetoothctl(fake_bluetoothctl,
+                      cache=DeviceCache(str(tmp_path / 'devices.json')))
+    bt.coordinator = Coordinator(str(tmp_path / 'locks'))
+    async_bt = AsyncBluetoothctl.like(bt)
+    assert async_bt.coordinator is bt.coordinator
+
+    assert asyncio.run(async_bt.info(ADDRESSES[0])).returncode == 0
+    assert spawned(log) == 1
+    # Cached by one, read by the other
+    assert bt.info(ADDRESSES[0]).returncode == 0
+    assert spawned(log) == 1
+
+    # A command changing a device makes the other's results stale
+    assert asyncio.run(async_bt.disconnect(ADDRESSES[0])).returncode == 0
+    bt.info(ADDRESSES[0])
+    assert spawned(log) == 3
+
+
+def test_scan_takes_turns(monkeypatch: pytest.MonkeyPatch, tmp_path: Path,
+                          fake_bluetoothctl: str) -> None:
+    log = tmp_path / 'spawns.log'
+    monkeypatch.setenv('FAKE_BT_LOG', str(log))
+    coordinator = Coordinator(str(tmp_path / 'locks'))
+    bt = AsyncBluetoothctl(fake_bluetoothctl, scan_timeout=1)
+    bt.coordinator = coordinator
+    held = coordinator.try_hold('scan')
+    assert held is not None
+
+    async def scan_later() -> int:
+        task = asyncio.ensure_future(bt.scan())
+        await asyncio.sleep(0.3)
+        # Waits for the scan in flight elsewhere
+        assert not task.done() and spawned(log) == 0
+        os.close(held)
+        return (await task).returncode
+
+    assert asyncio.run(scan_later()) == 0
+    assert spawned(log) == 1
+
+
+def test_cancel_waiting_for_lock(tmp_path: Path,
+                                 fake_bluetoothctl: str) -> None:
+    coordinator = Coordinator(str(tmp_path / 'locks'))
+    bt = AsyncBluetoothctl(fake_bluetoothctl)
+    bt.coordinator = coordinator
+    held = coordinator.try_hold('device 00:1A:7D:00:00:00')
+    assert held is not None
+
+    async def cancel() -> None:
+        task = asyncio.ensure_future(bt.pair(ADDRESSES[0]))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel())
+    os.close(held)
+    # The lock is not left held by the cancelled command
+    again = coordinator.try_hold('device 00:1A:7D:00:00:00')
+    assert again is not None
+    os.close(again)
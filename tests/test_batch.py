@@ -0,0 +1,40 @@
+from __future__ import annotations
+import pytest
+from resources.lib.batch import BatchException, run_batch
+from resources.lib.bluetoothctl import Bluetoothctl
+from resources.lib.result import CommandResult
+
+ADDRESSES = [f'00:1A:7D:00:00:0{i}' for i in range(4)]
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_runs_on_each_device(fake_bluetoothctl: str,
+                             max_workers: int) -> None:
+    bt = Bluetoothctl(executable=fake_bluetoothctl)
+    finished: list[str] = []
+
+    def on_result(address: str, process: CommandResult) -> None:
+        finished.append(address)
+
+    # Duplicate addresses run once
+    results = run_batch(bt, 'trust', ADDRESSES + ADDRESSES[:1],
+                        max_workers=max_workers, on_result=on_result)
+    assert list(results) == ADDRESSES
+    assert all(process.returncode == 0 for process in results.values())
+    assert all(process.args[-1] == address
+               for address, process in results.items())
+    assert sorted(finished) == ADDRESSES
+
+
+def test_cancel_skips_devices(fake_bluetoothctl: str) -> None:
+    bt = Bluetoothctl(executable=fake_bluetoothctl)
+    bt.cancel = lambda: True
+    results = run_batch(bt, 'connect', ADDRESSES)
+    assert list(results) == ADDRESSES
+    assert all(process.cancelled for process in results.values())
+
+
+def test_rejects_other_commands(fake_bluetoothctl: str) -> None:
+    bt = Bluetoothctl(executable=fake_bluetoothctl)
+    with pytest.raises(BatchException):
+        run_batch(bt, 'info', ADDRESSES)
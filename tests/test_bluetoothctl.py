@@ -0,0 +1,13 @@
+from __future__ import annotations
+import time
+from resources.lib.bluetoothctl import Bluetoothctl, DiscoveryFilter
+
+
+def test_cancel_filtered_scan(fake_bluetoothctl: str) -> None:
+    bt = Bluetoothctl(fake_bluetoothctl, scan_timeout=10)
+    started = time.monotonic()
+    bt.cancel = lambda: time.monotonic() - started > 0.5
+    process = bt.scan(DiscoveryFilter(rssi=-60))
+    # Stopped midway, the scan is not passed off as a complete one
+    assert time.monotonic() - started < 5
+    assert process.cancelled and process.returncode != 0
@@ -0,0 +1,146 @@
+"""
+Tests of the D-Bus backend against python-dbusmock's BlueZ template, on a
+private system bus. They are skipped when dbus-python or python-dbusmock is
+not installed.
+"""
+from __future__ import annotations
+from collections.abc import Generator, Iterator
+from typing import Any, Optional
+import subprocess
+import pytest
+from resources.lib.bluetoothctl import DiscoveredDevice
+from resources.lib.bluez_dbus import DEVICE, BluezDBus
+from resources.lib.parser import ParsedOutput, parse_info
+
+dbus = pytest.importorskip('dbus')
+dbusmock = pytest.importorskip('dbusmock')
+
+ADAPTER_PATH = '/org/bluez/hci0'
+ADDRESSES = ['00:1A:7D:00:00:00', '00:1A:7D:00:00:01', '00:1A:7D:00:00:02']
+
+
+@pytest.fixture(scope='module')
+def system_bus() -> Generator[Any, None, None]:
+    """Return a connection to a private system bus."""
+    dbusmock.DBusTestCase.start_system_bus()
+    yield dbusmock.DBusTestCase.get_dbus(system_bus=True)
+    dbusmock.DBusTestCase.tearDownClass()
+
+
+@pytest.fixture
+def bluez(system_bus: Any) -> Generator[Any, None, None]:
+    """
+    Return the mock interface of a mock BlueZ with one controller, hci0,
+    which knows a device for each of ADDRESSES.
+    """
+    server, manager = dbusmock.DBusTestCase.spawn_server_template(
+        'bluez5', {}, subprocess.DEVNULL, system_bus=True
+    )
+    mock = dbus.Interface(manager, 'org.bluez.Mock')
+    mock.AddAdapter('hci0', 'Kodi')
+    for index, address in enumerate(ADDRESSES):
+        mock.AddDevice('hci0', address, f'Speaker {index}')
+    yield mock
+    server.terminate()
+    server.wait()
+
+
+def device_path(address: str) -> str:
+    return f'{ADAPTER_PATH}/dev_{address.replace(":", "_")}'
+
+
+def set_rssi(bus: Any, address: str, rssi: int) -> None:
+    bus.get_object('org.bluez', device_path(address)).UpdateProperties(
+        DEVICE, {'RSSI': dbus.Int16(rssi)},
+        dbus_interface='org.freedesktop.DBus.Mock'
+    )
+
+
+def poll_once(
+    events: Iterator[Optional[DiscoveredDevice]]
+) -> list[DiscoveredDevice]:
+    """Return the devices a discovery yields up to its next poll."""
+    devices = []
+    for device in events:
+        if device is None:
+            break
+        devices.append(device)
+    return devices
+
+
+def test_discovery_yields_changes(bluez: Any, system_bus: Any) -> None:
+    bt = BluezDBus(scan_timeout=60, bus=system_bus)
+    events = bt._discovery()
+    try:
+        first = poll_once(events)
+        assert [device.address for device in first] == ADDRESSES
+        assert first[0] == DiscoveredDevice(ADDRESSES[0], 'Speaker 0', -79,
+                                            first[0].device_class, 'phone')
+
+        # Devices are not yielded again until they change
+        assert poll_once(events) == []
+        set_rssi(system_bus, ADDRESSES[1], -40)
+        assert poll_once(events) == [first[1]._replace(rssi=-40)]
+        assert poll_once(events) == []
+    finally:
+        events.close()
+
+
+def test_discover(bluez: Any, system_bus: Any) -> None:
+    bt = BluezDBus(scan_timeout=5, bus=system_bus)
+    devices = list(bt.discover(idle=1))
+    assert sorted(device.address for device in devices) == ADDRESSES
+
+
+def test_lists_controllers_and_devices(bluez: Any, system_bus: Any) -> None:
+    bluez.PairDevice('hci0', ADDRESSES[0])
+    bt = BluezDBus(bus=system_bus)
+    adapters = bt.get_adapter_list()
+    assert [(adapter.name, adapter.default) for adapter in adapters] == [
+        ('Kodi', True)
+    ]
+
+    devices = bt.get_devices()
+    assert isinstance(devices.stdout, ParsedOutput)
+    assert [(device.address, device.name)
+            for device in bt.parse_devices(devices.stdout)] == [
+        (address, f'Speaker {index}')
+        for index, address in enumerate(ADDRESSES)
+    ]
+    paired = bt.parse_devices(bt.get_paired_devices().stdout)
+    assert list(paired.by_address) == [ADDRESSES[0]]
+    assert list(bt.parse_devices(
+        bt.get_devices(adapter=adapters[0].address).stdout
+    ).by_address) == ADDRESSES
+
+
+def test_lists_default_controllers_devices(bluez: Any,
+                                           system_bus: Any) -> None:
+    bluez.AddAdapter('hci1', 'Other')
+    bluez.AddDevice('hci1', '00:1A:7D:00:00:09', 'Other speaker')
+    bt = BluezDBus(bus=system_bus)
+    assert list(bt.parse_devices(
+        bt.get_devices().stdout
+    ).by_address) == ADDRESSES
+
+
+def test_info_built_from_properties(bluez: Any, system_bus: Any) -> None:
+    bt = BluezDBus(bus=system_bus)
+    assert bt.trust(ADDRESSES[1]).returncode == 0
+    assert bt.connect(ADDRESSES[1]).returncode == 0
+    # The template's Connect does not update the Connected property
+    bluez.ConnectDevice('hci0', ADDRESSES[1])
+
+    process = bt.info(ADDRESSES[1])
+    info = bt.parse_info(process.stdout)
+    assert isinstance(process.stdout, ParsedOutput)
+    assert info is process.stdout.parsed
+    assert (info.address, info.alias, info.rssi) == (ADDRESSES[1],
+                                                     'Speaker 1', -79)
+    assert info.trusted and info.connected and not info.paired
+    # The text describes the same device
+    parsed = parse_info(str(process.stdout))
+    for slot in info.__slots__:
+        assert getattr(parsed, slot) == getattr(info, slot), slot
+
+    assert bt.info('00:00:00:00:00:00').returncode == 1
@@ -0,0 +1,100 @@
+from __future__ import annotations
+from pathlib import Path
+import multiprocessing
+import os
+from resources.lib.bluetoothctl import Bluetoothctl
+from resources.lib.cache import DeviceCache
+from resources.lib.ipc import ServiceClient, ServiceServer
+
+ADDRESS = '00:1A:7D:00:00:01'
+
+
+def test_get_set_and_expiry(tmp_path: Path) -> None:
+    cache = DeviceCache(os.path.join(tmp_path, 'devices.json'))
+    cache.set('devices', 'listed')
+    cache.set('info', 'expired', ttl=-1)
+    assert cache.get('devices') == 'listed'
+    assert cache.get('info') is None
+    assert cache.get('missing') is None
+
+
+def test_memory_only() -> None:
+    cache = DeviceCache(None)
+    cache.set('info A', 1)
+    cache.set('info B', 2)
+    cache.invalidate('info A')
+    assert cache.get('info A') is None
+    assert cache.get('info B') == 2
+
+
+def test_instances_merge_changes(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, 'devices.json')
+    first, second = DeviceCache(path), DeviceCache(path)
+    assert first.get('a') is None and second.get('b') is None
+
+    first.set('a', 1)
+    second.set('b', 2)
+    # Neither write undoes the other, and each instance sees the other's
+    assert first.get('b') == 2
+    assert DeviceCache(path).get('a') == 1
+    assert DeviceCache(path).get('b') == 2
+
+
+def test_invalidation_is_not_undone(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, 'devices.json')
+    first, second = DeviceCache(path), DeviceCache(path)
+    first.set('info A', 'stale')
+    assert second.get('info A') == 'stale'
+
+    first.invalidate('info')
+    # A write from an instance which read the entry before it was
+    # invalidated does not bring it back
+    second.set('devices', 'listed')
+    assert second.get('info A') is None
+    assert DeviceCache(path).get('info A') is None
+    assert DeviceCache(path).get('devices') == 'listed'
+
+
+def _write_keys(path: str, prefix: str, count: int) -> None:
+    cache = DeviceCache(path)
+    for i in range(count):
+        cache.set(f'{prefix} {i}', i)
+
+
+def test_concurrent_processes(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, 'devices.json')
+    processes = [
+        multiprocessing.Process(target=_write_keys, args=(path, str(n), 25))
+        for n in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    cache = DeviceCache(path)
+    assert all(cache.get(f'{n} {i}') == i
+               for n in range(4) for i in range(25))
+
+
+def test_service_commands_invalidate_fallback_cache(
+    tmp_path: Path, fake_bluetoothctl: str
+) -> None:
+    path = os.path.join(tmp_path, 'devices.json')
+    fallback = Bluetoothctl(fake_bluetoothctl,
+                            cache=DeviceCache(path))
+    assert fallback.info(ADDRESS).returncode == 0
+    assert DeviceCache(path).get(f'info {ADDRESS}') is not None
+
+    server = ServiceServer(os.path.join(tmp_path, 'service.sock'),
+                           Bluetoothctl(fake_bluetoothctl,
+                                        cache=DeviceCache(None)))
+    server.start()
+    try:
+        client = ServiceClient(server.path, fallback=fallback)
+        assert client.connect(ADDRESS).returncode == 0
+    finally:
+        server.stop()
+
+    # The command ran in the service, but the fallback's results are stale
+    assert DeviceCache(path).get(f'info {ADDRESS}') is None
@@ -0,0 +1,121 @@
+from __future__ import annotations
+from pathlib import Path
+import os
+import threading
+import time
+from resources.lib.coordination import Coordinator
+from resources.lib.result import CommandResult
+
+KEY = 'info 00:1A:7D:00:00:00'
+
+
+def result(stdout: str, cancelled: bool = False) -> CommandResult:
+    return CommandResult(['bluetoothctl', 'info'], 0, stdout, '',
+                         cancelled=cancelled)
+
+
+def in_flight(coordinator: Coordinator, stdout: str,
+              cancelled: bool = False) -> tuple[threading.Thread,
+                                                threading.Event]:
+    """
+    Start running a query in another thread, which finishes once the
+    returned event is set.
+    """
+    started, finish = threading.Event(), threading.Event()
+
+    def run() -> CommandResult:
+        started.set()
+        finish.wait(5)
+        return result(stdout, cancelled)
+
+    thread = threading.Thread(target=coordinator.single_flight,
+                              args=(KEY, run))
+    thread.start()
+    started.wait(5)
+    return thread, finish
+
+
+def test_single_flight_shares_result(tmp_path: Path) -> None:
+    # Each Coordinator opens its own lock files, as separate processes do
+    first, second = Coordinator(str(tmp_path)), Coordinator(str(tmp_path))
+    thread, finish = in_flight(first, 'shared')
+    runs: list[str] = []
+
+    def run() -> CommandResult:
+        runs.append('second')
+        return result('own')
+
+    threading.Timer(0.2, finish.set).start()
+    shared = second.single_flight(KEY, run)
+    thread.join()
+    assert shared is not None and shared.stdout == 'shared'
+    assert not runs
+
+
+def test_single_flight_runs_after_earlier_result(tmp_path: Path) -> None:
+    coordinator = Coordinator(str(tmp_path))
+    coordinator.single_flight(KEY, lambda: result('earlier'))
+    # A result which finished before the query was asked for is stale
+    fresh = coordinator.single_flight(KEY, lambda: result('fresh'))
+    assert fresh is not None and fresh.stdout == 'fresh'
+
+
+def test_cancelled_result_is_not_shared(tmp_path: Path) -> None:
+    coordinator = Coordinator(str(tmp_path))
+    thread, finish = in_flight(coordinator, 'cancelled', cancelled=True)
+    threading.Timer(0.2, finish.set).start()
+    own = coordinator.single_flight(KEY, lambda: result('own'))
+    thread.join()
+    assert own is not None and own.stdout == 'own'
+
+
+def test_single_flight_cancel(tmp_path: Path) -> None:
+    coordinator = Coordinator(str(tmp_path))
+    thread, finish = in_flight(coordinator, 'shared')
+    try:
+        assert coordinator.single_flight(KEY, lambda: result('own'),
+                                         cancel=lambda: True) is None
+    finally:
+        finish.set()
+        thread.join()
+
+
+def test_exclusive_takes_turns(tmp_path: Path) -> None:
+    coordinator = Coordinator(str(tmp_path), wait_timeout=0.2)
+    with coordinator.exclusive('scan') as acquired:
+        assert acquired
+        assert coordinator.try_hold('scan') is None
+        # Waiting may be cancelled, or gives up after wait_timeout
+        with coordinator.exclusive('scan', cancel=lambda: True) as acquired:
+            assert not acquired
+        started = time.monotonic()
+        with coordinator.exclusive('scan') as acquired:
+            assert acquired
+        assert time.monotonic() - started >= 0.2
+
+    with coordinator.exclusive('scan', cancel=lambda: True) as acquired:
+        assert acquired
+
+
+def test_prunes_old_files(tmp_path: Path) -> None:
+    coordinator = Coordinator(str(tmp_path), wait_timeout=10)
+    coordinator.single_flight('old', lambda: result('old'))
+    held = coordinator.try_hold('scan')
+    assert held is not None
+    try:
+        old = time.time() - 20
+        for name in os.listdir(tmp_path):
+            os.utime(os.path.join(tmp_path, name), (old, old))
+
+        coordinator.single_flight(KEY, lambda: result('new'))
+        # The new query's files and the held lock are kept
+        assert sorted(os.listdir(tmp_path)) == sorted([
+            os.path.basename(coordinator._path(KEY, '.json')),
+            os.path.basename(coordinator._path(KEY, '.lock')),
+            os.path.basename(coordinator._path('scan', '.lock')),
+        ])
+    finally:
+        os.close(held)
+    held = coordinator.try_hold('scan')
+    assert held is not None
+    os.close(held)
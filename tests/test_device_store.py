@@ -0,0 +1,71 @@
+from __future__ import annotations
+from pathlib import Path
+import os
+import sqlite3
+from resources.lib.bluetoothctl import DiscoveredDevice
+from resources.lib.device_store import DeviceFilter, DeviceStore
+from resources.lib.parser import Device, DeviceIndex, DeviceInfo
+
+ADDRESSES = [f'00:1A:7D:00:00:{i:02X}' for i in range(10)]
+
+
+def fill(store: DeviceStore) -> None:
+    """Replace the store's devices, the later found with stronger signal."""
+    devices = DeviceIndex()
+    for index, address in enumerate(ADDRESSES):
+        devices.add(Device(address, f'Speaker {index}'))
+    store.replace(devices, {
+        address: DiscoveredDevice(address, rssi=-90 + index,
+                                  icon='audio-card' if index % 2 else None)
+        for index, address in enumerate(ADDRESSES)
+    })
+
+
+def test_pages(tmp_path: Path) -> None:
+    fill(DeviceStore(os.path.join(tmp_path, 'available.db')))
+    # Each page is rendered by a new plugin invocation
+    store = DeviceStore(os.path.join(tmp_path, 'available.db'))
+    assert len(store) == 10 and store.updated > 0
+
+    first, more = store.page(order='rssi', number=0, size=4)
+    assert [device.address for device in first] == ADDRESSES[:5:-1]
+    assert more
+    last, more = store.page(order='rssi', number=2, size=4)
+    assert [device.address for device in last] == ADDRESSES[1::-1]
+    assert not more
+
+    audio, _ = store.page(DeviceFilter(device_type='audio'), size=0)
+    assert [device.address for device in audio] == ADDRESSES[1::2]
+
+
+def test_pages_stay_put_until_scan(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, 'available.db')
+    store = DeviceStore(path)
+    fill(store)
+    device_filter = DeviceFilter(min_rssi=-85)
+    first, _ = store.page(device_filter, 'rssi', 0, 2)
+
+    # A device on the first page now has a weak signal
+    info = DeviceInfo(first[0].address)
+    info.rssi = -100
+    store.update_info([info])
+    updated = DeviceStore(path).get(first[0].address)
+    assert updated is not None and updated.rssi == -100
+    second, _ = DeviceStore(path).page(device_filter, 'rssi', 1, 2)
+    assert [device.address for device in first + second] == \
+        ADDRESSES[:5:-1]
+
+
+def test_keeps_recent_views(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, 'available.db')
+    store = DeviceStore(path)
+    fill(store)
+    for min_rssi in range(-95, -80):
+        store.view(DeviceFilter(min_rssi=min_rssi))
+    store.close()
+
+    with sqlite3.connect(path) as connection:
+        views, = connection.execute(
+            'SELECT count(DISTINCT key) FROM views'
+        ).fetchone()
+    assert views == 8
@@ -0,0 +1,97 @@
+from __future__ import annotations
+from pathlib import Path
+import pytest
+from resources.lib.bluetoothctl import Bluetoothctl, DiscoveredDevice
+from resources.lib.history import HISTORY_NAME, DeviceHistory
+from resources.lib.ipc import ServiceClient
+from resources.lib.result import CommandResult
+from resources.lib.service import Service
+
+ADDRESS = '00:1A:7D:00:00:00'
+
+
+def result(returncode: int = 0, timed_out: bool = False,
+           cancelled: bool = False) -> CommandResult:
+    return CommandResult(['bluetoothctl'], returncode, '', '',
+                         timed_out=timed_out, cancelled=cancelled)
+
+
+def runs(history: DeviceHistory, address: str = ADDRESS) -> int:
+    stats = history.stats([address])
+    return stats[address].runs if address in stats else 0
+
+
+def test_records_commands_on_devices() -> None:
+    history = DeviceHistory(None)
+    history.record(['connect', ADDRESS], 2, result())
+    history.record(['connect', ADDRESS], 4, result())
+    history.record(['connect', ADDRESS], 30, result(1, timed_out=True))
+    # Not recorded: not on a device, not recorded, cancelled
+    history.record(['devices'], 1, result())
+    history.record(['info', ADDRESS], 1, result())
+    history.record(['pair', ADDRESS], 1, result(cancelled=True))
+
+    stats = history.stats([ADDRESS, '00:00:00:00:00:00'])
+    assert list(stats) == [ADDRESS]
+    assert stats[ADDRESS].runs == 3
+    assert stats[ADDRESS].failures == 1
+    assert stats[ADDRESS].mean_duration == 3
+    assert stats[ADDRESS].reliability == pytest.approx(2 / 3)
+
+
+def test_keeps_recent_runs() -> None:
+    history = DeviceHistory(None, max_runs=5)
+    for _ in range(12):
+        history.record(['connect', ADDRESS], 1, result())
+    history.record(['trust', ADDRESS], 1, result())
+    assert runs(history) == 6
+
+
+def test_record_seen_keeps_rssi() -> None:
+    history = DeviceHistory(None)
+    history.record_seen([DiscoveredDevice(ADDRESS, 'JBL Flip', -40)], 100)
+    history.record_seen([DiscoveredDevice(ADDRESS, 'JBL Flip', None)], 200)
+    stats = history.stats([ADDRESS])[ADDRESS]
+    assert (stats.last_seen, stats.rssi, stats.reliability) == (200, -40,
+                                                                None)
+
+
+def test_adaptive_timeout() -> None:
+    history = DeviceHistory(None, adaptive_timeouts=True)
+    command = ['connect', ADDRESS]
+    assert history.timeout(command, 60) == 60
+    for duration in (1, 4, 2):
+        history.record(command, duration, result())
+    assert history.timeout(command, 60) == 8
+    assert history.timeout(command, 6) == 6
+    assert history.timeout(command, None) is None
+    assert history.timeout(['info', ADDRESS], 60) == 60
+
+    # Not shortened once the command times out
+    history.record(command, 60, result(1, timed_out=True))
+    assert history.timeout(command, 60) == 60
+
+    assert DeviceHistory(None).timeout(command, 60) == 60
+
+
+def test_records_in_fallback(tmp_path: Path, fake_bluetoothctl: str) -> None:
+    fallback = Bluetoothctl(fake_bluetoothctl)
+    fallback.history = DeviceHistory(str(tmp_path / HISTORY_NAME))
+    client = ServiceClient(str(tmp_path / 'service.sock'), fallback=fallback)
+    assert client.trust(ADDRESS).returncode == 0
+    assert runs(fallback.history) == 1
+
+
+def test_records_in_service(kodi_profile: Path) -> None:
+    service = Service()
+    service.start()
+    try:
+        fallback = Bluetoothctl('/nonexistent')
+        fallback.history = DeviceHistory(str(kodi_profile / HISTORY_NAME))
+        client = ServiceClient(service.socket_path, fallback=fallback)
+        assert client.trust(ADDRESS).returncode == 0
+        assert client.disconnect(ADDRESS).returncode == 0
+    finally:
+        service.stop()
+    # Recorded once, by the service, in the history the plugin reads
+    assert runs(fallback.history) == 2
@@ -0,0 +1,166 @@
+from __future__ import annotations
+from collections.abc import Generator
+from pathlib import Path
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+import pytest
+from resources.lib.bluetoothctl import Bluetoothctl
+from resources.lib.ipc import ServiceClient, ServiceRunning, ServiceServer
+
+ADDRESS = '00:1A:7D:00:00:00'
+
+
+@pytest.fixture
+def server(tmp_path: Path,
+           fake_bluetoothctl: str) -> Generator[ServiceServer, None, None]:
+    """Return a running service server on the fake bluetoothctl."""
+    server = ServiceServer(str(tmp_path / 'service.sock'),
+                           Bluetoothctl(fake_bluetoothctl))
+    server.start()
+    yield server
+    server.stop()
+
+
+def serve_once(path: str, reply: bytes) -> threading.Thread:
+    """
+    Accept one connection on a socket, read the request, send a reply and
+    close the connection, as a service stopping mid-request would.
+    """
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+
+    def serve() -> None:
+        connection, _ = listener.accept()
+        connection.recv(65536)
+        if reply:
+            connection.sendall(reply)
+        # Close without reading anything further, resetting the connection
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                              b'\x01\x00\x00\x00\x00\x00\x00\x00')
+        connection.close()
+        listener.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_runs_commands(server: ServiceServer, fake_bluetoothctl: str) -> None:
+    client = ServiceClient(server.path,
+                           fallback=Bluetoothctl('/nonexistent'))
+    process = client.info(ADDRESS)
+    assert process.returncode == 0
+    assert client.parse_info(process.stdout).connected
+
+
+@pytest.mark.parametrize('command', [
+    ['power', 'off'],
+    ['system-alias', 'x'],
+    [],
+    'devices',
+    ['devices', 1],
+])
+def test_rejects_unknown_commands(server: ServiceServer,
+                                  command: object) -> None:
+    response = server.handle({'method': 'run', 'command': command})
+    assert 'unknown command' in response['error']
+
+
+def test_rejects_invalid_adapter(server: ServiceServer) -> None:
+    response = server.handle({'method': 'run', 'command': ['devices'],
+                              'adapter': ['hci0']})
+    assert 'invalid adapter' in response['error']
+
+
+@pytest.mark.parametrize('duration', [-1, 6, 'x', True, [1]])
+def test_rejects_invalid_duration(server: ServiceServer,
+                                  duration: object) -> None:
+    response = server.handle({'method': 'run', 'command': ['scan', 'on'],
+                              'duration': duration})
+    assert 'invalid duration' in response['error']
+
+
+def test_actions_do_not_hold_up_queries(tmp_path: Path,
+                                        fake_bluetoothctl: str) -> None:
+    # Commands changing device state take a second to start
+    slow = tmp_path / 'bluetoothctl'
+    slow.write_text('#!/bin/sh\nsleep 1\n'
+                    f'exec {sys.executable} {fake_bluetoothctl} "$@"\n')
+    os.chmod(slow, slow.stat().st_mode | stat.S_IEXEC)
+    bt = Bluetoothctl(fake_bluetoothctl)
+    server = ServiceServer(str(tmp_path / 'service.sock'), bt,
+                           Bluetoothctl(str(slow), cache=bt.cache))
+
+    with bt.session():
+        connecting = threading.Thread(target=server.handle, args=({
+            'method': 'run', 'command': ['connect', ADDRESS]
+        },))
+        connecting.start()
+        started = time.monotonic()
+        response = server.handle({'method': 'run', 'command': ['devices']})
+        assert time.monotonic() - started < 0.5
+        assert response['returncode'] == 0
+        connecting.join()
+
+
+def test_socket_only_for_user(server: ServiceServer) -> None:
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+
+
+def test_keeps_socket_of_running_service(server: ServiceServer,
+                                         fake_bluetoothctl: str) -> None:
+    other = ServiceServer(server.path, Bluetoothctl(fake_bluetoothctl))
+    with pytest.raises(ServiceRunning):
+        other.start()
+    client = ServiceClient(server.path,
+                           fallback=Bluetoothctl('/nonexistent'))
+    assert client.info(ADDRESS).returncode == 0
+
+
+def test_replaces_stale_socket(tmp_path: Path,
+                               fake_bluetoothctl: str) -> None:
+    # A socket left behind by a service which stopped without removing it
+    path = str(tmp_path / 'service.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    server = ServiceServer(path, Bluetoothctl(fake_bluetoothctl))
+    server.start()
+    try:
+        client = ServiceClient(path, fallback=Bluetoothctl('/nonexistent'))
+        assert client.info(ADDRESS).returncode == 0
+    finally:
+        server.stop()
+
+
+def test_unknown_command_over_socket(server: ServiceServer) -> None:
+    client = ServiceClient(server.path,
+                           fallback=Bluetoothctl('/nonexistent'))
+    assert 'unknown command' in client._request(
+        {'method': 'run', 'command': ['power', 'off']}
+    )['error']
+
+
+def test_falls_back_without_service(tmp_path: Path,
+                                    fake_bluetoothctl: str) -> None:
+    client = ServiceClient(str(tmp_path / 'service.sock'),
+                           fallback=Bluetoothctl(fake_bluetoothctl))
+    assert client.info(ADDRESS).returncode == 0
+
+
+@pytest.mark.parametrize('reply', [b'', b'{"args": ["bluetoothctl"'])
+def test_falls_back_when_service_stops(tmp_path: Path, fake_bluetoothctl: str,
+                                       reply: bytes) -> None:
+    path = str(tmp_path / 'service.sock')
+    thread = serve_once(path, reply)
+    client = ServiceClient(path, fallback=Bluetoothctl(fake_bluetoothctl))
+    process = client.info(ADDRESS)
+    thread.join()
+    assert process.returncode == 0
+    assert client.parse_info(process.stdout).address == ADDRESS
@@ -0,0 +1,37 @@
+from __future__ import annotations
+from pathlib import Path
+import os
+from resources.lib.output import Capture, truncate
+from resources.lib.result import CommandResult
+
+
+def test_truncate_keeps_start_and_end() -> None:
+    text = 'start' + 'x' * 1000 + 'end'
+    short = truncate(text, 20)
+    assert short.startswith('start') and short.endswith('end')
+    assert '[... 988 bytes omitted ...]' in short
+    assert truncate(text, 0) == text
+    assert truncate('short', 20) == 'short'
+    assert truncate(None, 20) == ''
+
+
+def test_truncate_drops_split_characters() -> None:
+    # Each character is two bytes, so an odd half cuts one in two
+    text = 'é' * 100
+    short = truncate(text, 22)
+    assert short.startswith('é' * 5 + '\n')
+    assert short.endswith('\n' + 'é' * 5)
+
+
+def test_capture_rotates(tmp_path: Path) -> None:
+    path = os.path.join(tmp_path, 'output.log')
+    capture = Capture(path, max_bytes=1000, backups=1)
+    assert not os.path.exists(path)
+
+    process = CommandResult(['bluetoothctl', 'info'], 0, 'x' * 600, '')
+    for _ in range(3):
+        capture.write(process)
+    assert os.path.exists(path) and os.path.exists(path + '.1')
+    assert not os.path.exists(path + '.2')
+    with open(path, encoding='utf8') as file:
+        assert 'bluetoothctl info\nreturn code: 0' in file.read()
@@ -0,0 +1,160 @@
+from __future__ import annotations
+from typing import Any
+import json
+from resources.lib.bluetoothctl import Bluetoothctl
+from resources.lib.bluez_dbus import BATTERY, DEVICE, BluezDBus, ManagedObjects
+from resources.lib.parser import (
+    ParsedOutput, parse_adapters, parse_devices, parse_info
+)
+from resources.lib.session import BluetoothctlSession
+
+ADDRESS = '00:1A:7D:00:00:00'
+
+INFO = (
+    f'Device {ADDRESS} (public)\n'
+    '\tName: JBL Flip\n'
+    '\tAlias: JBL Flip\n'
+    '\tClass: 0x00240414\n'
+    '\tIcon: audio-card\n'
+    '\tPaired: yes\n'
+    '\tTrusted: yes\n'
+    '\tBlocked: no\n'
+    '\tConnected: yes\n'
+    '\tUUID: Audio Sink                (0000110b-0000-1000-8000-'
+    '00805f9b34fb)\n'
+    '\tRSSI: 0xffffffc2 (-62)\n'
+    '\tBattery Percentage: 0x50 (80)\n'
+)
+
+
+def test_parse_devices() -> None:
+    devices = parse_devices(
+        'Device 00:1a:7d:00:00:01 JBL Flip\n'
+        '[CHG] Controller 00:1A:7D:DA:71:13 Discovering: yes\n'
+        'Device 00:1A:7D:00:00:02 JBL Flip\n'
+        'Device 00:1A:7D:00:00:03\n'
+    )
+    assert list(devices.by_address) == ['00:1A:7D:00:00:01',
+                                        '00:1A:7D:00:00:02',
+                                        '00:1A:7D:00:00:03']
+    assert len(devices.named('JBL Flip')) == 2
+    # Devices without a name are named by their address
+    assert devices.by_address['00:1A:7D:00:00:03'].name == (
+        '00:1A:7D:00:00:03'
+    )
+
+
+def test_parse_adapters() -> None:
+    adapters = parse_adapters(
+        'Controller 00:1A:7D:DA:71:13 kodi [default]\n'
+        'Controller 00:1a:7d:da:71:14 kodi #2\n'
+    )
+    assert [(adapter.address, adapter.name, adapter.default)
+            for adapter in adapters] == [
+        ('00:1A:7D:DA:71:13', 'kodi', True),
+        ('00:1A:7D:DA:71:14', 'kodi #2', False),
+    ]
+
+
+def test_parse_info() -> None:
+    info = parse_info(INFO)
+    assert info.address == ADDRESS
+    assert info.name == 'JBL Flip'
+    assert info.device_class == 0x00240414
+    assert info.icon == 'audio-card'
+    assert info.paired and info.trusted and info.connected
+    assert not info.blocked
+    assert info.rssi == -62
+    assert info.battery == 80
+    assert info.uuids == ['0000110b-0000-1000-8000-00805f9b34fb']
+
+
+def test_parse_info_from_session() -> None:
+    # A session echoes the command, prints prompts with colour codes and
+    # strips indentation from each line
+    raw = ('\x01\x1b[0;94m\x02[bluetooth]\x01\x1b[0m\x02# '
+           f'info {ADDRESS}\r\n{INFO}[JBL Flip]# ')
+    stdout = BluetoothctlSession._clean(raw.replace('\x01', '')
+                                        .replace('\x02', ''),
+                                        ['info', ADDRESS])
+    assert not stdout.startswith('\t')
+
+    info = parse_info(stdout)
+    assert info.address == ADDRESS
+    assert info.name == 'JBL Flip'
+    assert info.connected
+    assert info.battery == 80
+
+
+def test_parse_info_ignores_lines_before_header() -> None:
+    info = parse_info(f'Name: Other\n{INFO}')
+    assert info.name == 'JBL Flip'
+
+
+def test_session_info_matches_one_shot(fake_bluetoothctl: str) -> None:
+    bt = Bluetoothctl(fake_bluetoothctl)
+    one_shot = bt.parse_info(bt.info(ADDRESS).stdout)
+    with bt.session():
+        in_session = bt.parse_info(bt.info(ADDRESS).stdout)
+
+    assert one_shot.connected and one_shot.battery == 80
+    for slot in one_shot.__slots__:
+        assert getattr(in_session, slot) == getattr(one_shot, slot), slot
+
+
+def test_parsed_output() -> None:
+    info = parse_info(INFO)
+    stdout = ParsedOutput(INFO, info)
+    assert parse_info(stdout) is info
+    # Only the text is kept once the output is cached or sent elsewhere
+    decoded = json.loads(json.dumps(stdout))
+    assert type(decoded) is str
+    assert parse_info(decoded) is not info
+    assert parse_info(decoded).battery == 80
+
+
+def test_dbus_info_matches_parsed_text() -> None:
+    interfaces: dict[str, dict[str, Any]] = {
+        DEVICE: {
+            'Address': ADDRESS, 'AddressType': 'public',
+            'Name': 'JBL Flip', 'Alias': 'Speaker', 'Class': 0x00240414,
+            'Icon': 'audio-card', 'Paired': True, 'Trusted': True,
+            'Blocked': False, 'Connected': True, 'RSSI': -62,
+            'UUIDs': ['0000110b-0000-1000-8000-00805f9b34fb'],
+        },
+        BATTERY: {'Percentage': 80},
+    }
+    stdout = BluezDBus._format_info(interfaces)
+    built, parsed = parse_info(stdout), parse_info(str(stdout))
+    assert built is stdout.parsed
+    assert built.alias == 'Speaker' and built.battery == 80
+    for slot in built.__slots__:
+        assert getattr(built, slot) == getattr(parsed, slot), slot
+
+
+def test_dbus_devices_match_parsed_text() -> None:
+    objects: ManagedObjects = {
+        '/org/bluez/hci0': {},
+        f'/org/bluez/hci0/dev_{ADDRESS.replace(":", "_")}': {DEVICE: {
+            'Address': ADDRESS, 'Alias': 'JBL Flip', 'Paired': True,
+        }},
+        '/org/bluez/hci0/dev_00_1A_7D_00_00_01': {DEVICE: {
+            'Address': '00:1A:7D:00:00:01', 'Paired': False,
+        }},
+        '/org/bluez/hci1/dev_00_1A_7D_00_00_02': {DEVICE: {
+            'Address': '00:1A:7D:00:00:02', 'Name': 'Phone',
+        }},
+    }
+    stdout = BluezDBus._format_devices(objects, paired=False,
+                                       adapter_path='/org/bluez/hci0')
+    built, parsed = parse_devices(stdout), parse_devices(str(stdout))
+    assert built is stdout.parsed
+    assert [(device.address, device.name) for device in built] == [
+        (ADDRESS, 'JBL Flip'), ('00:1A:7D:00:00:01', '00:1A:7D:00:00:01')
+    ]
+    assert [(device.address, device.name) for device in parsed] == [
+        (device.address, device.name) for device in built
+    ]
+    assert list(parse_devices(BluezDBus._format_devices(
+        objects, paired=True
+    )).by_address) == [ADDRESS]
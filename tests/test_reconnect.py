@@ -0,0 +1,41 @@
+from __future__ import annotations
+from pathlib import Path
+import os
+import stat
+import sys
+from resources.lib.bluetoothctl import Bluetoothctl
+from resources.lib.reconnect import Reconnector
+from resources.lib.result import RetryPolicy
+
+# Paired devices of the fake bluetoothctl, which are all trusted, the first
+# of them connected
+ADDRESSES = ['00:1A:7D:00:00:01', '00:1A:7D:00:00:02']
+
+
+def test_policy_alone_retries(tmp_path: Path, fake_bluetoothctl: str) -> None:
+    # Connecting always fails transiently, other commands use the fake
+    log = tmp_path / 'connects.log'
+    executable = tmp_path / 'bluetoothctl'
+    executable.write_text(
+        '#!/bin/sh\n'
+        'if [ "$1" = connect ]; then\n'
+        f'  echo "$2" >> {log}\n'
+        '  echo "Failed to connect: org.bluez.Error.InProgress"\n'
+        '  exit 1\n'
+        'fi\n'
+        f'exec {sys.executable} {fake_bluetoothctl} "$@"\n'
+    )
+    os.chmod(executable, executable.stat().st_mode | stat.S_IEXEC)
+
+    retry = RetryPolicy(attempts=3, backoff=0)
+    bt = Bluetoothctl(executable=str(executable), retry=retry)
+    policy = RetryPolicy(attempts=2, backoff=0.01, jitter=0)
+    results = Reconnector(bt, policy=policy).run()
+
+    assert sorted(results) == ADDRESSES
+    assert all(result is not None and result.attempts == 1
+               for result in results.values())
+    # Each device is connected to as often as the policy says, and the
+    # backend's own policy is restored
+    assert sorted(log.read_text().split()) == sorted(ADDRESSES * 2)
+    assert bt.retry == retry
@@ -0,0 +1,118 @@
+from __future__ import annotations
+from pathlib import Path
+import os
+import stat
+import sys
+import pytest
+from resources.lib.session import BluetoothctlSession
+
+ADDRESS = '00:1A:7D:00:00:01'
+# Second controller of the fake, which device 9 only reaches, while device 4
+# only reaches the default controller
+CONTROLLER = '00:1A:7D:DA:71:14'
+
+# A bluetoothctl which reports other devices, named like failures, while
+# trusting a device
+EVENTS = f'''#!{sys.executable}
+import sys
+PROMPT = '[bluetooth]# '
+sys.stdout.write(PROMPT)
+sys.stdout.flush()
+for line in sys.stdin:
+    if line.startswith('quit'):
+        break
+    sys.stdout.write(
+        '[NEW] Device 00:1A:7D:00:00:09 Service not available\\n'
+        '[CHG] Device 00:1A:7D:00:00:08 Alias: Failed to connect\\n'
+        'Changing {ADDRESS} trust succeeded\\n' + PROMPT
+    )
+    sys.stdout.flush()
+'''
+
+
+def script(tmp_path: Path, source: str) -> str:
+    path = tmp_path / 'bluetoothctl'
+    path.write_text(source)
+    os.chmod(path, path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def processes(log: Path) -> int:
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+
+def test_waits_for_result_after_prompt(monkeypatch: pytest.MonkeyPatch,
+                                       fake_bluetoothctl: str) -> None:
+    monkeypatch.setenv('FAKE_BT_RESULT_DELAY', '0.2')
+    with BluetoothctlSession(fake_bluetoothctl) as session:
+        process = session.run(['connect', ADDRESS], timeout=5)
+        assert process.returncode == 0
+        assert 'Connection successful' in process.stdout
+        # Nothing of the command is left to be taken for the next one's
+        assert session.run(['info', ADDRESS]).stdout.startswith('Device')
+
+
+def test_failure_from_command_output(fake_bluetoothctl: str) -> None:
+    with BluetoothctlSession(fake_bluetoothctl) as session:
+        assert session.run(['trust', ADDRESS]).returncode == 0
+        missing = session.run(['trust', '00:1A:7D:00:00:FF'])
+        assert missing.returncode == 1
+        assert 'not available' in missing.stdout
+        assert session.run(['frobnicate']).returncode == 1
+
+
+def test_events_are_not_failures(tmp_path: Path) -> None:
+    with BluetoothctlSession(script(tmp_path, EVENTS)) as session:
+        process = session.run(['trust', ADDRESS])
+    assert process.returncode == 0
+    assert 'Service not available' in process.stdout
+
+
+@pytest.mark.parametrize('cancelled', [False, True])
+def test_unfinished_command_restarts_process(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, fake_bluetoothctl: str,
+    cancelled: bool
+) -> None:
+    log = tmp_path / 'spawns.log'
+    monkeypatch.setenv('FAKE_BT_LOG', str(log))
+    monkeypatch.setenv('FAKE_BT_RESULT_DELAY', '2')
+    with BluetoothctlSession(fake_bluetoothctl) as session:
+        process = session.run(['connect', ADDRESS], timeout=0.2,
+                              cancel=lambda: cancelled)
+        assert process.returncode == 1
+        assert process.cancelled == cancelled
+        assert process.timed_out != cancelled
+        assert not session.running
+
+        assert session.run(['info', ADDRESS]).returncode == 0
+    assert processes(log) == 2
+
+
+def test_select_missing_controller(monkeypatch: pytest.MonkeyPatch,
+                                   fake_bluetoothctl: str) -> None:
+    monkeypatch.setenv('FAKE_BT_ADAPTERS', '2')
+    with BluetoothctlSession(fake_bluetoothctl) as session:
+        process = session.run(['devices'], adapter='00:00:00:00:00:00')
+        assert process.returncode == 1
+        assert 'Controller 00:00:00:00:00:00 not available' in process.stdout
+        assert session.run(['devices']).returncode == 0
+
+
+def test_returns_to_default_controller(monkeypatch: pytest.MonkeyPatch,
+                                       tmp_path: Path,
+                                       fake_bluetoothctl: str) -> None:
+    log = tmp_path / 'spawns.log'
+    monkeypatch.setenv('FAKE_BT_LOG', str(log))
+    monkeypatch.setenv('FAKE_BT_ADAPTERS', '2')
+    with BluetoothctlSession(fake_bluetoothctl) as session:
+        selected = session.run(['devices'], adapter=CONTROLLER).stdout
+        assert '00:1A:7D:00:00:09' in selected
+        assert '00:1A:7D:00:00:04' not in selected
+        # The same controller is kept for later commands
+        assert session.run(['devices'], adapter=CONTROLLER).stdout == selected
+        assert processes(log) == 1
+
+        default = session.run(['devices']).stdout
+        assert '00:1A:7D:00:00:04' in default
+        assert '00:1A:7D:00:00:09' not in default
+    assert processes(log) == 2